@@ -0,0 +1,327 @@
+"""
+Annotate large lists of IP addresses with PoP, location and PTR.
+
+    python annotate.py ips.txt > annotated.csv
+    python annotate.py --format csv --column dst_addr flows.csv
+    cat results.jsonl | python annotate.py --format jsonl --field from
+
+Input is read in chunks of lines. Each chunk goes to a worker process and
+the results are written in input order. Addresses are parsed to integers
+and matched a whole chunk at a time with numpy against the flattened
+ranges of geoip-pops-ptr-latest.csv (see PrefixIndex). Dotted quads are
+parsed column by column in numpy. IPv6 addresses go through inet_pton and
+are matched on their upper 64 bits, which is exact as long as no prefix is
+longer than /64. Otherwise they fall back to a binary search per address.
+Throughput goes to stderr.
+"""
+
+import os
+import io
+import sys
+import csv
+import json
+import time
+import socket
+import argparse
+import contextlib
+
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import context
+from util import PrefixIndex
+
+
+# relative to the data directory of the run
+GEOIP_LATEST_FILE = "geoip/geoip-pops-ptr-latest.csv"
+
+FIELDS = ["country", "region", "city", "pop", "code", "dns_ptr"]
+DEFAULT_FIELDS = ["pop", "city", "dns_ptr"]
+CHUNK_SIZE = 4 * 1024 * 1024
+# longest dotted quad, 255.255.255.255
+IPV4_WIDTH = 15
+LOW_64 = (1 << 64) - 1
+
+
+def csv_escape(value: str) -> str:
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def load_table(path: Path | None = None, fields: list[str] = DEFAULT_FIELDS) -> dict:
+    """
+    Flatten the prefixes of the geoip CSV into sorted ranges. Record -1 means
+    no match, so the value arrays end with an empty string.
+    """
+    path = path or context.data_path(GEOIP_LATEST_FILE)
+    records: dict[tuple, tuple] = {}
+    cidrs = []
+    values = []
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            key = tuple(row.get(field) or "" for field in fields)
+            values.append(records.setdefault(key, key))
+            cidrs.append(row["cidr"])
+    index = PrefixIndex(cidrs, values)
+    record_ids = {key: i for i, key in enumerate(records)}
+
+    v4_starts, v4_ends, v4_values = index.ranges(4)
+    v6_starts, v6_ends, v6_values = index.ranges(6)
+    columns = [[key[i] for key in records] + [""] for i in range(len(fields))]
+    # prefixes up to /64 start and end on 64 bit boundaries
+    v6_high_only = all(
+        s & LOW_64 == 0 and e & LOW_64 == LOW_64 for s, e in zip(v6_starts, v6_ends)
+    )
+    return {
+        "fields": fields,
+        "values": [np.array(column, dtype=object) for column in columns],
+        # the same values, ready to be joined into CSV lines
+        "csv_values": [np.array([csv_escape(v) for v in column], dtype=object) for column in columns],
+        "v4_starts": np.array(v4_starts, dtype=np.int64),
+        "v4_ends": np.array(v4_ends, dtype=np.int64),
+        "v4_records": np.array([record_ids[v] for v in v4_values], dtype=np.int64),
+        "v6_high_only": v6_high_only,
+        "v6_start_high": np.array([s >> 64 for s in v6_starts], dtype=np.uint64),
+        "v6_end_high": np.array([e >> 64 for e in v6_ends], dtype=np.uint64),
+        "v6_starts": v6_starts,
+        "v6_ends": v6_ends,
+        "v6_records": np.array([record_ids[v] for v in v6_values], dtype=np.int64),
+    }
+
+
+def parse_ipv4(ips: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Parse dotted quads column by column over the whole batch. Return the
+    integer addresses and a mask of the entries that were valid IPv4.
+    """
+    n = len(ips)
+    lengths = np.fromiter(map(len, ips), dtype=np.int64, count=n)
+    # fixed width UCS-4, shorter strings are padded with zeros
+    chars = np.array(ips, dtype=f"U{IPV4_WIDTH}").view(np.uint32).reshape(n, IPV4_WIDTH)
+    # one contiguous row per character position
+    chars = np.ascontiguousarray(chars.T).astype(np.int64)
+
+    ok = (lengths >= 7) & (lengths <= IPV4_WIDTH)
+    value = np.zeros(n, dtype=np.int64)
+    octet = np.zeros(n, dtype=np.int64)
+    digits = np.zeros(n, dtype=np.int64)
+    dots = np.zeros(n, dtype=np.int64)
+    for position, column in enumerate(chars):
+        is_digit = (column >= 48) & (column <= 57)
+        is_dot = column == 46
+        # only the padding may be zero, numpy drops trailing NULs of the input
+        ok &= is_digit | is_dot | (position >= lengths)
+        # leading zeros are ambiguous (octal in some parsers), ipaddress rejects them
+        ok &= ~(is_digit & (digits > 0) & (octet == 0))
+        octet = np.where(is_digit, octet * 10 + column - 48, octet)
+        digits += is_digit
+        ok &= ~is_dot | ((digits >= 1) & (digits <= 3) & (octet <= 255))
+        value = np.where(is_dot, (value << 8) | octet, value)
+        octet[is_dot] = 0
+        digits[is_dot] = 0
+        dots += is_dot
+    ok &= (dots == 3) & (digits >= 1) & (digits <= 3) & (octet <= 255)
+    return (value << 8) | octet, ok
+
+
+def parse_ipv6(ips: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return the upper and lower 64 bits and a mask of the valid addresses."""
+    packed = []
+    ok = np.ones(len(ips), dtype=bool)
+    zero = bytes(16)
+    for i, ip in enumerate(ips):
+        try:
+            packed.append(socket.inet_pton(socket.AF_INET6, ip))
+        except (OSError, ValueError):
+            packed.append(zero)
+            ok[i] = False
+    words = np.frombuffer(b"".join(packed), dtype=">u8").reshape(len(ips), 2)
+    return words[:, 0].astype(np.uint64), words[:, 1].astype(np.uint64), ok
+
+
+def _match(keys: np.ndarray, ok: np.ndarray, starts: np.ndarray, ends: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    matched = np.full(len(keys), -1, dtype=np.int64)
+    if len(starts):
+        i = np.searchsorted(starts, keys, side="right").astype(np.int64) - 1
+        safe = i.clip(0)
+        hit = ok & (i >= 0) & (keys <= ends[safe])
+        matched[hit] = ids[safe[hit]]
+    return matched
+
+
+def resolve(table: dict, ips: list[str]) -> np.ndarray:
+    """Record id of every address, -1 when invalid or not covered."""
+    if not ips:
+        return np.full(0, -1, dtype=np.int64)
+
+    value, is_v4 = parse_ipv4(ips)
+    records = _match(value, is_v4, table["v4_starts"], table["v4_ends"], table["v4_records"])
+
+    rest = np.flatnonzero(~is_v4)
+    if len(rest):
+        high, low, is_v6 = parse_ipv6([ips[j] for j in rest])
+        if table["v6_high_only"]:
+            records[rest] = _match(
+                high, is_v6, table["v6_start_high"], table["v6_end_high"], table["v6_records"]
+            )
+        else:
+            for j, h, lo, ok in zip(rest, high.tolist(), low.tolist(), is_v6):
+                ip = (h << 64) | lo
+                k = bisect_right(table["v6_starts"], ip) - 1
+                if ok and k >= 0 and ip <= table["v6_ends"][k]:
+                    records[j] = table["v6_records"][k]
+    return records
+
+
+_table: dict | None = None
+
+
+def init_worker(table: dict):
+    global _table
+    _table = table
+
+
+def annotate_chunk(chunk: bytes, input_format: str, key, table: dict | None = None) -> tuple[bytes, int, int]:
+    """Return the output, the number of addresses and the number matched."""
+    table = table or _table
+    text = chunk.decode("utf-8", errors="replace")
+
+    if input_format == "text":
+        ips = [line.strip() for line in text.split("\n")]
+        ips = [ip for ip in ips if ip]
+        records = resolve(table, ips)
+        if any(c in text for c in ',"'):
+            ips = [csv_escape(ip) for ip in ips]
+        lines = map(",".join, zip(ips, *(values[records] for values in table["csv_values"])))
+        output = "\n".join(lines) + "\n" if ips else ""
+    elif input_format == "csv":
+        lines = [line.rstrip("\r") for line in text.split("\n") if line.strip()]
+        ips = [row[key].strip() if len(row) > key else "" for row in csv.reader(lines)]
+        records = resolve(table, ips)
+        # rows are passed through as they are, the annotations are appended
+        lines = map(",".join, zip(lines, *(values[records] for values in table["csv_values"])))
+        output = "\n".join(lines) + "\n" if ips else ""
+    else:
+        objects = [json.loads(line) for line in text.split("\n") if line.strip()]
+        ips = [str(obj.get(key) or "").strip() for obj in objects]
+        records = resolve(table, ips)
+        columns = [values[records] for values in table["values"]]
+        out = io.StringIO()
+        for i, obj in enumerate(objects):
+            for field, column in zip(table["fields"], columns):
+                obj[field] = column[i] or None
+            out.write(json.dumps(obj))
+            out.write("\n")
+        output = out.getvalue()
+    return output.encode("utf-8"), len(ips), int((records >= 0).sum())
+
+
+def read_chunks(stream, size: int = CHUNK_SIZE):
+    """Yield blocks of about size bytes that end on a line boundary."""
+    rest = b""
+    while True:
+        block = stream.read(size)
+        if not block:
+            break
+        block = rest + block
+        cut = block.rfind(b"\n") + 1
+        if cut == 0:
+            rest = block
+            continue
+        rest = block[cut:]
+        yield block[:cut]
+    if rest:
+        yield rest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate IP addresses with Starlink PoP, location and PTR")
+    parser.add_argument("inputs", nargs="*", default=["-"], help="files, - for stdin")
+    parser.add_argument("--format", choices=["text", "csv", "jsonl"], default="text")
+    parser.add_argument("--column", default="ip", help="CSV column name or index")
+    parser.add_argument("--field", default="ip", help="JSONL field")
+    parser.add_argument("--fields", default=",".join(DEFAULT_FIELDS), help=f"comma separated, from {','.join(FIELDS)}")
+    parser.add_argument("--geoip", type=Path, default=context.data_path(GEOIP_LATEST_FILE))
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="1 annotates in this process")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes of input per task")
+    args = parser.parse_args()
+
+    fields = [f for f in args.fields.split(",") if f]
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        parser.error(f"unknown fields: {', '.join(sorted(unknown))}")
+
+    start = time.perf_counter()
+    # stdout carries the annotated data, keep index warnings out of it
+    with contextlib.redirect_stdout(sys.stderr):
+        table = load_table(args.geoip, fields)
+    print(f"Loaded {args.geoip} in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+    pool = None
+    if args.workers > 1:
+        pool = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(table,))
+    out = sys.stdout.buffer
+    total = matched = 0
+    start = time.perf_counter()
+
+    def write(result: tuple[bytes, int, int]):
+        nonlocal total, matched
+        data, count, hits = result
+        out.write(data)
+        total += count
+        matched += hits
+
+    try:
+        if args.format == "text":
+            out.write((",".join(["ip"] + fields) + "\n").encode("utf-8"))
+        for name in args.inputs:
+            stream = sys.stdin.buffer if name == "-" else open(name, "rb")
+            try:
+                key = args.field
+                if args.format == "csv":
+                    line = stream.readline().decode("utf-8").rstrip("\r\n")
+                    header = next(csv.reader([line]), [])
+                    if args.column.isdigit():
+                        key = int(args.column)
+                    elif args.column in header:
+                        key = header.index(args.column)
+                    else:
+                        parser.error(f"column {args.column} not in {name}")
+                    if name == args.inputs[0]:
+                        out.write((",".join([line] + fields) + "\n").encode("utf-8"))
+
+                # a bounded window of tasks keeps the output in order without
+                # reading the whole input ahead of the workers
+                pending = deque()
+                for chunk in read_chunks(stream, args.chunk_size):
+                    if pool is None:
+                        write(annotate_chunk(chunk, args.format, key, table))
+                        continue
+                    pending.append(pool.submit(annotate_chunk, chunk, args.format, key))
+                    if len(pending) >= 2 * args.workers:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+            finally:
+                if stream is not sys.stdin.buffer:
+                    stream.close()
+        out.flush()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    seconds = time.perf_counter() - start
+    print(
+        f"Annotated {total} IPs ({matched} matched) in {seconds:.2f}s, "
+        f"{total / seconds if seconds else 0:,.0f} IPs/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Content-deduplicated archive of feed, pop and geoip snapshots.
+
+Every distinct CSV row of a dataset is stored once in archive/{dataset}/rows.csv,
+and a snapshot is the list of row ids it is made of, run-length encoded in
+archive/{dataset}/snapshots.jsonl. Consecutive snapshots share almost all of
+their rows, so a new snapshot usually costs a handful of rows and runs.
+
+    python archive.py migrate
+    python archive.py list geoip
+    python archive.py show geoip --at 20250101-0000 --columns cidr,pop
+"""
+
+import io
+import re
+import csv
+import sys
+import json
+import hashlib
+import argparse
+
+from pathlib import Path
+from datetime import datetime, timezone
+
+import pandas as pd
+
+import context
+
+
+# relative to the data directory of the run
+ARCHIVE_DIR = "archive"
+
+# dataset -> (source directory, file prefix, header columns of headerless files)
+DATASETS = {
+    "feed": ("feed", "feed", ["cidr", "country", "region", "city"]),
+    "pop": ("pop", "pops", ["cidr", "pop", "code"]),
+    "geoip": ("geoip", "geoip-pops-ptr", None),
+}
+
+SNAPSHOT_PATTERN = re.compile(r"-(\d{8}-\d{4})\.csv$")
+
+
+def encode_runs(ids: list[int]) -> list[list[int]]:
+    runs: list[list[int]] = []
+    for i in ids:
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return runs
+
+
+def decode_runs(runs: list[list[int]]) -> list[int]:
+    ids = []
+    for start, length in runs:
+        ids.extend(range(start, start + length))
+    return ids
+
+
+class DatasetArchive:
+    def __init__(self, dataset: str, archive_dir: Path | None = None):
+        if dataset not in DATASETS:
+            raise ValueError(f"Unknown dataset: {dataset}")
+        self.dataset = dataset
+        self.columns = DATASETS[dataset][2]
+        self.dir = Path(archive_dir or context.data_path(ARCHIVE_DIR)).joinpath(dataset)
+        self.rows_file = self.dir.joinpath("rows.csv")
+        self.snapshots_file = self.dir.joinpath("snapshots.jsonl")
+        self._row_ids: dict[str, int] | None = None
+
+    def snapshots(self) -> list[dict]:
+        if not self.snapshots_file.exists():
+            return []
+        with open(self.snapshots_file, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _load_row_ids(self) -> dict[str, int]:
+        if self._row_ids is None:
+            self._row_ids = {}
+            if self.rows_file.exists():
+                with open(self.rows_file, "r") as f:
+                    for i, line in enumerate(f):
+                        self._row_ids.setdefault(line.rstrip("\n"), i)
+        return self._row_ids
+
+    def append(self, snapshot: str, content: str) -> bool:
+        """
+        Add a snapshot named like 20250101-0000. Return False if it is
+        identical to the previous snapshot and was not stored.
+        """
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        snapshots = self.snapshots()
+        if snapshots and snapshots[-1]["sha256"] == digest:
+            return False
+        # a rerun within the same minute gets the same name, the later one wins
+        if snapshots and snapshots[-1]["snapshot"] > snapshot:
+            raise ValueError(
+                f"Snapshot {snapshot} is older than {snapshots[-1]['snapshot']}"
+            )
+
+        lines = [line for line in content.splitlines() if line.strip()]
+        header = None
+        if self.columns is None and lines:
+            header, lines = lines[0], lines[1:]
+
+        row_ids = self._load_row_ids()
+        new_rows = []
+        ids = []
+        for line in lines:
+            row_id = row_ids.get(line)
+            if row_id is None:
+                row_id = len(row_ids)
+                row_ids[line] = row_id
+                new_rows.append(line)
+            ids.append(row_id)
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(self.rows_file, "a") as f:
+            for line in new_rows:
+                f.write(line + "\n")
+        with open(self.snapshots_file, "a") as f:
+            meta = {
+                "snapshot": snapshot,
+                "archived_at": datetime.now(timezone.utc).strftime("%Y%m%d-%H%M"),
+                "sha256": digest,
+                "rows": len(ids),
+                "new_rows": len(new_rows),
+                "header": header,
+                "trailing_newline": content.endswith("\n"),
+                "runs": encode_runs(ids),
+            }
+            f.write(json.dumps(meta, separators=(",", ":")) + "\n")
+        return True
+
+    def find(self, at: str | None = None) -> dict:
+        """Return the metadata of the last snapshot taken at or before at."""
+        snapshots = self.snapshots()
+        if at is not None:
+            snapshots = [s for s in snapshots if s["snapshot"] <= at]
+        if not snapshots:
+            raise LookupError(f"No {self.dataset} snapshot at or before {at}")
+        return snapshots[-1]
+
+    def read_lines(self, ids: set[int]) -> dict[int, str]:
+        """
+        Return the stored rows with the given ids. The file is streamed up to
+        the largest id and only those rows are kept.
+        """
+        lines: dict[int, str] = {}
+        if not ids:
+            return lines
+        last = max(ids)
+        with open(self.rows_file, "r") as f:
+            for i, line in enumerate(f):
+                if i in ids:
+                    lines[i] = line.rstrip("\n")
+                if i >= last:
+                    break
+        return lines
+
+    def read_text(self, at: str | None = None) -> str:
+        """Rebuild the original CSV text of a snapshot."""
+        meta = self.find(at)
+        ids = decode_runs(meta["runs"])
+        rows = self.read_lines(set(ids))
+        lines = [rows[i] for i in ids]
+        if meta["header"] is not None:
+            lines.insert(0, meta["header"])
+        return "\n".join(lines) + ("\n" if meta["trailing_newline"] else "")
+
+    def _names(self, header: str | None) -> list[str]:
+        return self.columns or next(csv.reader([header]))
+
+    def read_rows(
+        self, snapshots: list[dict], columns: list[str] | None = None
+    ) -> dict[str | None, pd.DataFrame]:
+        """
+        Parse the rows of the given snapshots with the header of the snapshot
+        they belong to, since rows stored before a column was added have fewer
+        fields. Return one DataFrame per header, indexed by row id, with the
+        given columns and "" where a header does not have one.
+        """
+        ids_by_header: dict[str | None, set[int]] = {}
+        for meta in snapshots:
+            ids = ids_by_header.setdefault(meta["header"], set())
+            ids.update(decode_runs(meta["runs"]))
+        return self.read_ids(ids_by_header, columns)
+
+    def read_ids(
+        self, ids_by_header: dict[str | None, set[int]], columns: list[str] | None = None
+    ) -> dict[str | None, pd.DataFrame]:
+        """Like read_rows(), for the given row ids parsed with each header."""
+        lines = self.read_lines(set().union(*ids_by_header.values()))
+        frames = {}
+        for header, ids in ids_by_header.items():
+            names = self._names(header)
+            wanted = columns or names
+            row_ids = sorted(ids)
+            if not row_ids:
+                frames[header] = pd.DataFrame(columns=wanted, dtype=str)
+                continue
+            frame = pd.read_csv(
+                io.StringIO("\n".join(lines[i] for i in row_ids)),
+                header=None,
+                names=names,
+                index_col=False,
+                usecols=[c for c in wanted if c in names],
+                skip_blank_lines=False,
+                dtype=str,
+                keep_default_na=False,
+            )
+            frame.index = row_ids
+            frames[header] = frame.reindex(columns=wanted, fill_value="")
+        return frames
+
+    def read(self, at: str | None = None, columns: list[str] | None = None) -> pd.DataFrame:
+        """Rebuild a snapshot as a DataFrame, only parsing the given columns."""
+        meta = self.find(at)
+        rows = self.read_rows([meta], columns)[meta["header"]]
+        return rows.loc[decode_runs(meta["runs"])].reset_index(drop=True)
+
+    def read_range(
+        self,
+        start: str | None = None,
+        end: str | None = None,
+        columns: list[str] | None = None,
+    ) -> pd.DataFrame:
+        """
+        Rebuild every snapshot taken between start and end (inclusive) into one
+        DataFrame with a snapshot column. Rows are parsed once for all of them.
+        Without columns, the result has the columns of every header in range.
+        """
+        snapshots = [
+            s
+            for s in self.snapshots()
+            if (start is None or s["snapshot"] >= start)
+            and (end is None or s["snapshot"] <= end)
+        ]
+        if not snapshots:
+            return pd.DataFrame(columns=(columns or self.columns or []) + ["snapshot"])
+        if columns is None:
+            columns = []
+            for meta in reversed(snapshots):
+                columns += [c for c in self._names(meta["header"]) if c not in columns]
+        rows = self.read_rows(snapshots, columns)
+        frames = []
+        for meta in snapshots:
+            frame = rows[meta["header"]].loc[decode_runs(meta["runs"])]
+            frames.append(frame.assign(snapshot=meta["snapshot"]))
+        return pd.concat(frames, ignore_index=True)
+
+
+def append_snapshot(dataset: str, snapshot: str, content: str) -> bool:
+    archived = DatasetArchive(dataset).append(snapshot, content)
+    if archived:
+        print(f"Archived {dataset} snapshot {snapshot}")
+    return archived
+
+
+def migrate(data_dir: Path | None = None, archive_dir: Path | None = None):
+    """
+    Import the existing {year}{month} snapshot directories, oldest first.
+    Snapshots already in the archive are skipped.
+    """
+    data_dir = data_dir or context.current().data_dir
+    for dataset, (subdir, prefix, _) in DATASETS.items():
+        archive = DatasetArchive(dataset, archive_dir)
+        snapshots = archive.snapshots()
+        last = snapshots[-1]["snapshot"] if snapshots else ""
+
+        files = []
+        for path in Path(data_dir).joinpath(subdir).glob(f"*/{prefix}-*.csv"):
+            match = SNAPSHOT_PATTERN.search(path.name)
+            if match and match.group(1) > last:
+                files.append((match.group(1), path))
+        files.sort()
+
+        stored = 0
+        for snapshot, path in files:
+            with open(path, "r") as f:
+                if archive.append(snapshot, f.read()):
+                    stored += 1
+        print(f"{dataset}: {len(files)} files, {stored} snapshots archived")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Starlink GeoIP snapshot archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="import the existing monthly CSV directories")
+    list_parser = sub.add_parser("list", help="list the snapshots of a dataset")
+    list_parser.add_argument("dataset", choices=DATASETS.keys())
+    show_parser = sub.add_parser("show", help="print a snapshot as CSV")
+    show_parser.add_argument("dataset", choices=DATASETS.keys())
+    show_parser.add_argument("--at", help="snapshot time, e.g. 20250101-0000")
+    show_parser.add_argument("--columns", help="comma separated columns")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate()
+    elif args.command == "list":
+        for meta in DatasetArchive(args.dataset).snapshots():
+            print(f"{meta['snapshot']} rows={meta['rows']} new_rows={meta['new_rows']}")
+    elif args.command == "show":
+        columns = args.columns.split(",") if args.columns else None
+        df = DatasetArchive(args.dataset).read(args.at, columns)
+        df.to_csv(sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()
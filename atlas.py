@@ -2,82 +2,230 @@ import os
 import time
 import json
 import httpx
-import datetime
+import asyncio
+import functools
 
 import pandas as pd
 import pycountry
 
 from copy import deepcopy
-from pathlib import Path
 
-from util import GEOIP
+import context
+import metrics
+from util import GEOIP, write_if_changed
 
 
 ASN = [14593, 45700]
 
-DATA_DIR = os.getenv("DATA_DIR", "./starlink-geoip-data")
-if not os.path.exists(Path(DATA_DIR).joinpath("atlas")):
-    os.makedirs(Path(DATA_DIR).joinpath("atlas"))
-
 
 def get_date() -> str:
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
-    return now.strftime("%Y%m%d-%H%M")
+    return context.current().dt_string
+
+
+@functools.cache
+def get_geoip_client() -> GEOIP:
+    # downloads pops.csv, only the atlas job needs it
+    return GEOIP()
 
 
-date = get_date()
-geoip_client = GEOIP()
+ATLAS_API_URL = "https://atlas.ripe.net/api/v2/"
+RETRY_ATTEMPTS = 5
+# take probe details from the listing and fetch the rest concurrently
+ATLAS_BULK = os.getenv("ATLAS_BULK", "1") == "1"
+ATLAS_CONCURRENCY = int(os.getenv("ATLAS_CONCURRENCY", "8"))
+# requests per second for probe detail calls, 0 means unlimited
+ATLAS_RATE_LIMIT = float(os.getenv("ATLAS_RATE_LIMIT", "4"))
+
+# fields used by refresh_atlas_probes
+PROBE_FIELDS = {
+    "id",
+    "status",
+    "is_public",
+    "country_code",
+    "asn_v4",
+    "asn_v6",
+    "address_v4",
+    "address_v6",
+}
 
 
 def new_atlas_client():
-    return httpx.Client(base_url="https://atlas.ripe.net/api/v2/")
+    return httpx.Client(base_url=ATLAS_API_URL)
+
+
+def new_async_atlas_client(concurrency: int = ATLAS_CONCURRENCY):
+    return httpx.AsyncClient(
+        base_url=ATLAS_API_URL,
+        limits=httpx.Limits(
+            max_connections=concurrency, max_keepalive_connections=concurrency
+        ),
+    )
+
+
+def count_response(response: httpx.Response):
+    metrics.incr("http.requests")
+    metrics.incr("http.bytes", len(response.content))
+
+
+def backoff(attempt: int) -> float:
+    return min(2 ** (attempt - 1), 10)
+
+
+def get_probes(client: httpx.Client | None = None) -> list:
+    """
+    Return the probe objects of every Starlink ASN from the paginated listing.
+    """
+    probes = []
+    own_client = client is None
+    client = client or new_atlas_client()
+    try:
+        for asn in ASN:
+            response = client.get("probes", params={"asn": asn, "limit": 200})
+            count_response(response)
+            probes.extend(response.json()["results"])
+            while response.json()["next"]:
+                response = client.get(response.json()["next"])
+                count_response(response)
+                probes.extend(response.json()["results"])
+    finally:
+        if own_client:
+            client.close()
+    return probes
 
 
 def get_probes_list():
-    list = []
-    client = new_atlas_client()
-    for asn in ASN:
-        response = client.get("probes", params={"asn": asn, "limit": 200})
-        for probe in response.json()["results"]:
-            list.append(probe["id"])
-        while response.json()["next"]:
-            response = client.get(response.json()["next"])
-            for probe in response.json()["results"]:
-                list.append(probe["id"])
-    client.close()
-    return list
-
-
-def get_probe_info(id: str):
-    attempts = 5
-    for attempt in range(1, attempts + 1):
-        client = new_atlas_client()
+    return [probe["id"] for probe in get_probes()]
+
+
+def get_probe_info(id: str, client: httpx.Client | None = None):
+    own_client = client is None
+    client = client or new_atlas_client()
+    try:
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                response = client.get(f"probes/{id}", timeout=10.0)
+                count_response(response)
+                response.raise_for_status()
+                return response.json()
+            except httpx.ReadTimeout as e:
+                print(
+                    f"Timeout getting probe {id} (attempt {attempt}/{RETRY_ATTEMPTS}): {e}"
+                )
+            except httpx.HTTPError as e:
+                print(
+                    f"HTTP error getting probe {id} (attempt {attempt}/{RETRY_ATTEMPTS}): {e}"
+                )
+            metrics.incr("atlas.retries")
+            time.sleep(backoff(attempt))
+    finally:
+        if own_client:
+            client.close()
+    return None
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            now = loop.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def get_probe_info_async(
+    id: str, client: httpx.AsyncClient, limiter: RateLimiter
+):
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        await limiter.wait()
         try:
-            response = client.get(f"probes/{id}", timeout=10.0)
+            response = await client.get(f"probes/{id}", timeout=10.0)
+            count_response(response)
             response.raise_for_status()
             return response.json()
         except httpx.ReadTimeout as e:
-            print(f"Timeout getting probe {id} (attempt {attempt}/{attempts}): {e}")
+            print(f"Timeout getting probe {id} (attempt {attempt}/{RETRY_ATTEMPTS}): {e}")
         except httpx.HTTPError as e:
-            print(f"HTTP error getting probe {id} (attempt {attempt}/{attempts}): {e}")
-        finally:
-            client.close()
-        time.sleep(min(2 ** (attempt - 1), 10))
+            print(
+                f"HTTP error getting probe {id} (attempt {attempt}/{RETRY_ATTEMPTS}): {e}"
+            )
+        metrics.incr("atlas.retries")
+        await asyncio.sleep(backoff(attempt))
     return None
 
 
+async def get_probe_infos_async(
+    ids: list,
+    concurrency: int = ATLAS_CONCURRENCY,
+    rate_limit: float = ATLAS_RATE_LIMIT,
+) -> list:
+    limiter = RateLimiter(rate_limit)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with new_async_atlas_client(concurrency) as client:
+
+        async def worker(id):
+            async with semaphore:
+                return await get_probe_info_async(id, client, limiter)
+
+        return await asyncio.gather(*(worker(id) for id in ids))
+
+
+def harvest_probes(
+    concurrency: int = ATLAS_CONCURRENCY, rate_limit: float = ATLAS_RATE_LIMIT
+) -> list[tuple[int, dict | None]]:
+    """
+    Return (probe_id, probe_info) for every probe, in listing order. Details
+    come from the listing, probes missing a field used by refresh_atlas_probes
+    are fetched concurrently over one pooled client.
+    """
+    probes = get_probes()
+    incomplete = [probe["id"] for probe in probes if not PROBE_FIELDS <= probe.keys()]
+    print(
+        f"Got {len(probes)} probes from the listing, fetching details for {len(incomplete)}"
+    )
+
+    details = {}
+    if incomplete:
+        infos = asyncio.run(get_probe_infos_async(incomplete, concurrency, rate_limit))
+        details = dict(zip(incomplete, infos))
+
+    return [
+        (probe["id"], details[probe["id"]] if probe["id"] in details else probe)
+        for probe in probes
+    ]
+
+
 def get_dns_ptr(ip) -> str:
-    return geoip_client.get_pop_by_ip(ip)
+    return get_geoip_client().get_pop_by_ip(ip)
 
 
-def refresh_atlas_probes():
+def refresh_atlas_probes(bulk: bool = ATLAS_BULK):
     probe_list = []
     probe_list_original = []
 
+    with metrics.stage("atlas.harvest"):
+        if bulk:
+            probe_infos = harvest_probes()
+        else:
+            probe_infos = []
+            with new_atlas_client() as client:
+                for probe_id in get_probes_list():
+                    print(f"Getting info for probe {probe_id}")
+                    probe_infos.append((probe_id, get_probe_info(probe_id, client)))
+                    time.sleep(0.5)
+    metrics.incr("atlas.probes", len(probe_infos))
+
     active_rows = []
-    for probe_id in get_probes_list():
-        print(f"Getting info for probe {probe_id}")
-        probe_info = get_probe_info(probe_id)
+    for probe_id, probe_info in probe_infos:
         if not probe_info:
             print(f"Failed to get info for probe {probe_id}, skipping.")
             continue
@@ -122,24 +270,28 @@ def refresh_atlas_probes():
                     "country_name": country_name,
                 }
             )
-        time.sleep(0.5)
 
+    metrics.incr("atlas.active_probes", len(active_rows))
     active_probe_df = pd.DataFrame(active_rows)
     if not active_probe_df.empty:
         active_probe_df = active_probe_df.sort_values(
             by=["ptr", "country_code", "country_name"]
         )
 
-    with open(Path(DATA_DIR).joinpath("atlas/probes.json"), "w") as f:
-        json.dump(probe_list, f, indent=4)
-    with open(Path(DATA_DIR).joinpath("atlas/probes-{}.json".format(date)), "w") as f:
+    context.data_path("atlas").mkdir(parents=True, exist_ok=True)
+    write_if_changed(
+        context.data_path("atlas/probes.json"),
+        lambda f: json.dump(probe_list, f, indent=4),
+    )
+    with open(context.data_path("atlas/probes-{}.json".format(get_date())), "w") as f:
         json.dump(probe_list_original, f, indent=4)
 
-    with open(Path(DATA_DIR).joinpath("atlas/active_probes.csv"), "w") as f:
-        if not active_rows:
-            pass
-        else:
-            for _, row in active_probe_df.iterrows():
-                f.write(
-                    f"{row['probe_id']},{row['ptr']},{row['country_code']},{row['country_name']}\n"
-                )
+    def write_active_probes(f):
+        for _, row in active_probe_df.iterrows():
+            f.write(
+                f"{row['probe_id']},{row['ptr']},{row['country_code']},{row['country_name']}\n"
+            )
+
+    write_if_changed(
+        context.data_path("atlas/active_probes.csv"), write_active_probes
+    )
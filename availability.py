@@ -1,74 +1,219 @@
 #!/usr/bin/env python3
 # flake8: noqa: E501
 
-# npm install geobuf
-# npx geobuf2json < availability-cells.pb > availability-cells.geojson
-
 # https://api.starlink.com/public-files/availability-cells.pb
 
 # visualize geojson with https://geojson.io/
 
 import os
+import gzip
 import json
 import time
-import httpx
-import subprocess
 
 from pathlib import Path
+from typing import Iterable
 
 import geocoder
-from shapely.geometry import Polygon
+import numpy as np
+import shapely
+from shapely import STRtree
+from shapely.geometry import shape
+
+import context
+import fetch
+import metrics
+from geobuf_reader import iter_features, write_geojson
+
+
+# built from Natural Earth 1:10m land and boundary lines, https://www.naturalearthdata.com/
+# Known mislabels: the Baarle-Hertog enclaves are not in the boundary lines and
+# resolve to NL, the Holy See is a stub of about 100 m and most of it resolves to IT.
+COUNTRIES_FILE = "./map/data/countries.geojson"
+# geocode cells that match no boundary with ArcGIS
+GEOCODE_FALLBACK = os.getenv("AVAILABILITY_GEOCODE_FALLBACK", "0") == "1"
+
+AVAILABILITY_CELLS_URL = "https://api.starlink.com/public-files/availability-cells.pb"
+# relative to the data directory of the run
+LAYERS_DIR = "availability/layers"
+# simplification tolerance in degrees per level, from coarse to full detail
+LAYER_TOLERANCES = [0.25, 0.1, 0.03, 0.0]
+LAYER_PRECISION = 5
+# also write pre-gzipped copies of every layer
+LAYER_GZIP = os.getenv("AVAILABILITY_LAYER_GZIP", "1") == "1"
+
+
+class CountryResolver:
+    def __init__(self, path: str = COUNTRIES_FILE):
+        with open(path, "r") as f:
+            features = json.load(f)["features"]
+        self.codes = [feature["properties"]["iso_a2"] for feature in features]
+        self.geometries = np.array([shape(feature["geometry"]) for feature in features], dtype=object)
+        self.areas = shapely.area(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def resolve(self, points: np.ndarray, cells: np.ndarray | None = None) -> list[str | None]:
+        """
+        Return the ISO 3166-1 alpha-2 code of the country containing each
+        point, the smaller one where a country lies inside another. A point on
+        no country's land, like the centroid of a cell over an atoll lagoon or
+        off a coast, gets the country covering the largest part of its cell
+        in cells. None if that is no land either.
+        """
+        countries: list[str | None] = [None] * len(points)
+        point_idx, country_idx = self.tree.query(points, predicate="within")
+        # largest country first, so the smallest one is assigned last
+        order = np.lexsort((-self.areas[country_idx], point_idx))
+        for p, c in zip(point_idx[order], country_idx[order]):
+            countries[p] = self.codes[c]
+        if cells is None:
+            return countries
+
+        missing = np.array([i for i, country in enumerate(countries) if country is None], dtype=np.int64)
+        if not len(missing):
+            return countries
+        cell_idx, country_idx = self.tree.query(cells[missing], predicate="intersects")
+        overlap = shapely.area(shapely.intersection(cells[missing][cell_idx], self.geometries[country_idx]))
+        # smallest overlap first, so the largest one is assigned last
+        order = np.lexsort((overlap, cell_idx))
+        for c, k, area in zip(cell_idx[order], country_idx[order], overlap[order]):
+            # a cell that only touches a border has no overlap
+            if area > 0:
+                countries[missing[c]] = self.codes[k]
+        return countries
 
 
-DATA_DIR = os.getenv("DATA_DIR", "./starlink-geoip-data")
+def polygon_rings(features: list) -> list:
+    rings = []
+    for feature in features:
+        if feature["geometry"] is None:
+            continue
+        polygonType = feature["geometry"]["type"]
+        if polygonType == "Polygon":
+            coordinates = [feature["geometry"]["coordinates"]]
+        elif polygonType == "MultiPolygon":
+            coordinates = feature["geometry"]["coordinates"]
+        else:
+            continue
+        for i in coordinates:
+            for j in i:
+                rings.append(j)
+    return rings
 
 
-def new_client():
-    return httpx.Client(base_url="https://api.starlink.com")
+def ring_polygons(rings: list) -> np.ndarray:
+    # build every ring in one call instead of one Polygon per ring
+    lengths = [len(ring) for ring in rings]
+    coords = np.array([point[:2] for ring in rings for point in ring], dtype=float)
+    indices = np.repeat(np.arange(len(rings)), lengths)
+    return shapely.polygons(shapely.linearrings(coords, indices=indices))
 
 
-def retrive_availability_cells():
-    client = new_client()
-    response = client.get("/public-files/availability-cells.pb")
-    client.close()
-    with open(Path(DATA_DIR).joinpath("availability/availability-cells.pb"), "wb") as f:
-        f.write(response.content)
+def geocode_ring(ring: list, centroid) -> tuple[str, float, float]:
+    time.sleep(0.1)
+    g = geocoder.arcgis("{}, {}".format(centroid.y, centroid.x))
+    metrics.incr("geocoder.arcgis_calls")
+    if g.json is not None:
+        if "country" not in g.json:
+            return g.json["address"], centroid.y, centroid.x
+        return g.json["country"], centroid.y, centroid.x
+    for k in ring:
+        g = geocoder.arcgis("{}, {}".format(k[1], k[0]))
+        metrics.incr("geocoder.arcgis_calls")
+        if g.json:
+            return g.json["country"], k[1], k[0]
+    return "", centroid.y, centroid.x
+
+
+def write_status_csv(csv_filepath: Path, features: list, resolver: CountryResolver):
+    rings = polygon_rings(features)
+    if not rings:
+        open(csv_filepath, "w").close()
+        return
+    cells = ring_polygons(rings)
+    centroids = shapely.centroid(cells)
+    countries = resolver.resolve(centroids, cells)
+    xs = shapely.get_x(centroids)
+    ys = shapely.get_y(centroids)
+    unmatched = sum(1 for c in countries if c is None)
+    print(f"{csv_filepath}: {len(rings)} cells, {unmatched} without a country")
+    metrics.incr("availability.cells", len(rings))
+    metrics.incr("availability.cells_without_country", unmatched)
+
+    with open(csv_filepath, "w") as csv_f:
+        for count, (ring, centroid, country, lat, lon) in enumerate(
+            zip(rings, centroids, countries, ys, xs), start=1
+        ):
+            if country is None:
+                if GEOCODE_FALLBACK:
+                    country, lat, lon = geocode_ring(ring, centroid)
+                else:
+                    country = ""
+
+            if country == "AQ" and count > 1:
+                continue
+            line = "{},{},{},{}\n".format(
+                country,
+                lat,
+                lon,
+                "http://maps.google.com/maps?z=12&t=m&q=loc:{}+{}".format(lat, lon),
+            )
+            csv_f.write(line)
+
+
+@metrics.timed("availability.download")
+def retrive_availability_cells() -> fetch.FetchResult:
+    cells = context.data_path("availability/availability-cells.pb")
+    # skip the download only if the outputs of the last one are complete
+    conditional = cells.exists() and context.data_path(LAYERS_DIR, "manifest.json").exists()
+    result = fetch.fetch(AVAILABILITY_CELLS_URL, conditional=conditional)
+    if isinstance(result, fetch.Fetched):
+        with open(cells, "wb") as f:
+            f.write(result.content)
+    return result
 
 
 def ensure_dir():
-    Path(DATA_DIR).joinpath("availability").mkdir(parents=True, exist_ok=True)
-
-
-def convert():
-    subprocess.run(
-        [
-            "bash",
-            "-c",
-            "npx geobuf2json < availability-cells.pb > availability-cells.geojson",
-        ],
-        cwd=Path(DATA_DIR).joinpath("availability"),
-        check=True,
+    context.data_path("availability").mkdir(parents=True, exist_ok=True)
+
+
+@metrics.timed("availability.convert")
+def convert() -> list[dict]:
+    """
+    Decode availability-cells.pb, no Node toolchain needed, and write it as
+    availability-cells.geojson. Return the features for classify() so the
+    geobuf file is decoded once.
+    """
+    features = list(
+        iter_features(context.data_path("availability/availability-cells.pb"))
+    )
+    write_geojson(
+        features, context.data_path("availability/availability-cells.geojson")
     )
-    filepath = Path(DATA_DIR).joinpath("availability/availability-cells.geojson")
-    with open(filepath, "r") as f:
-        data = json.load(f)
-    with open(filepath, "w") as f:
-        f.write(json.dumps(data, indent=4))
+    return features
+
 
+@metrics.timed("availability.classify")
+def classify(features: Iterable[dict] | None = None):
+    """
+    Group features by status in one pass. Features default to those of
+    availability-cells.geojson, pass the result of convert() to skip reading
+    it back.
+    """
+    resolver = CountryResolver()
+    if features is None:
+        with open(
+            context.data_path("availability/availability-cells.geojson"), "r"
+        ) as f:
+            features = json.load(f)["features"]
 
-def classify():
     status_dict = {}
-    with open(
-        Path(DATA_DIR).joinpath("availability/availability-cells.geojson"), "r"
-    ) as f:
-        data = json.load(f)
-        for feature in data["features"]:
-            status = feature["properties"]["status"]
-            if "expected" in feature["properties"]:
-                status += " " + feature["properties"]["expected"]
-            if status not in status_dict:
-                status_dict[status] = []
-            status_dict[status].append(feature)
+    for feature in features:
+        status = feature["properties"]["status"]
+        if "expected" in feature["properties"]:
+            status += " " + feature["properties"]["expected"]
+        if status not in status_dict:
+            status_dict[status] = []
+        status_dict[status].append(feature)
 
     for status in status_dict.keys():
         # faq
@@ -78,7 +223,7 @@ def classify():
         # waitlisted Sold Out
         # waitlisted Expanding in 2025
         # waitlisted Service date is unknown at this time
-        filepath = Path(DATA_DIR).joinpath(
+        filepath = context.data_path(
             "availability/{}.geojson".format(status.replace(" ", "_"))
         )
         with open(filepath, "w") as f:
@@ -86,62 +231,106 @@ def classify():
                 "type": "FeatureCollection",
                 "features": [feature for feature in status_dict[status]],
             }
-            f.write(json.dumps(obj, indent=4))
+            f.write(json.dumps(obj, separators=(",", ":")))
 
-            csv_filepath = Path(DATA_DIR).joinpath(
+            csv_filepath = context.data_path(
                 "availability/{}.csv".format(status.replace(" ", "_"))
             )
-            with open(csv_filepath, "w") as csv_f:
-                print(csv_filepath)
-                count = 0
-                for feature in obj["features"]:
-                    polygonType = feature["geometry"]["type"]
-                    if polygonType == "Polygon":
-                        coordinates = [feature["geometry"]["coordinates"]]
-                    elif polygonType == "MultiPolygon":
-                        coordinates = feature["geometry"]["coordinates"]
-                    for i in coordinates:
-                        for j in i:
-                            time.sleep(0.1)
-                            count += 1
-
-                            polygon = Polygon(j)
-                            g = geocoder.arcgis(
-                                "{}, {}".format(polygon.centroid.y, polygon.centroid.x)
-                            )
-                            if g.json is None:
-                                for k in j:
-                                    g = geocoder.arcgis("{}, {}".format(k[1], k[0]))
-                                    if g.json:
-                                        country = g.json["country"]
-                                        lat = k[1]
-                                        lon = k[0]
-                                        break
-                            else:
-                                if "country" not in g.json:
-                                    country = g.json["address"]
-                                else:
-                                    country = g.json["country"]
-                                lat = polygon.centroid.y
-                                lon = polygon.centroid.x
-
-                            if country == "AQ" and count > 1:
-                                continue
-                            else:
-                                line = "{},{},{},{}\n".format(
-                                    country,
-                                    lat,
-                                    lon,
-                                    "http://maps.google.com/maps?z=12&t=m&q=loc:{}+{}".format(
-                                        lat, lon
-                                    ),
-                                )
-                                csv_f.write(line)
-                                print(line)
+            write_status_csv(csv_filepath, obj["features"], resolver)
+
+    write_layers(status_dict)
+
+
+def merge_status_cells(status_dict: dict) -> tuple[list, np.ndarray]:
+    statuses = list(status_dict.keys())
+    merged = []
+    for status in statuses:
+        geoms = [
+            shape(feature["geometry"])
+            for feature in status_dict[status]
+            if feature["geometry"] is not None
+            and feature["geometry"]["type"] in ("Polygon", "MultiPolygon")
+        ]
+        # adjacent cells of the same status become one (multi)polygon
+        merged.append(shapely.make_valid(shapely.union_all(geoms)))
+    return statuses, np.array(merged, dtype=object)
+
+
+def simplify_layers(merged: np.ndarray, tolerance: float) -> np.ndarray:
+    if tolerance == 0:
+        return merged
+    # simplify all statuses as one coverage so shared borders stay shared
+    try:
+        return shapely.coverage_simplify(merged, tolerance)
+    except shapely.errors.GEOSException as e:
+        print(f"Coverage simplification failed, simplifying layers apart: {e}")
+    return shapely.simplify(merged, tolerance, preserve_topology=True)
+
+
+@metrics.timed("availability.write_layers")
+def write_layers(status_dict: dict):
+    """
+    Write each status as merged, simplified layers at every tolerance in
+    LAYER_TOLERANCES, plus manifest.json with the size and vertex count of
+    every file, so the map can load a coarse layer first. Layer files of
+    earlier runs that are not part of this one are removed.
+    """
+    layers_dir = context.data_path(LAYERS_DIR)
+    layers_dir.mkdir(parents=True, exist_ok=True)
+    statuses, merged = merge_status_cells(status_dict)
+
+    manifest = {"levels": LAYER_TOLERANCES, "layers": []}
+    written = set()
+    for level, tolerance in enumerate(LAYER_TOLERANCES):
+        simplified = simplify_layers(merged, tolerance)
+        simplified = shapely.set_precision(simplified, 10**-LAYER_PRECISION)
+        for status, geom in zip(statuses, simplified):
+            filename = "{}-z{}.geojson".format(status.replace(" ", "_"), level)
+            obj = {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "properties": {"status": status, "level": level},
+                        "geometry": json.loads(shapely.to_geojson(geom)),
+                    }
+                ],
+            }
+            content = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+            with open(layers_dir.joinpath(filename), "wb") as f:
+                f.write(content)
+            written.add(filename)
+            entry = {
+                "status": status,
+                "level": level,
+                "tolerance": tolerance,
+                "file": filename,
+                "bytes": len(content),
+                "vertices": int(shapely.get_num_coordinates(geom)),
+            }
+            if LAYER_GZIP:
+                compressed = gzip.compress(content, mtime=0)
+                with open(layers_dir.joinpath(filename + ".gz"), "wb") as f:
+                    f.write(compressed)
+                entry["gzip_bytes"] = len(compressed)
+                written.add(filename + ".gz")
+            manifest["layers"].append(entry)
+
+    # statuses that are gone, levels that were dropped, gzip copies turned off
+    for path in layers_dir.glob("*-z*.geojson*"):
+        if path.name not in written:
+            path.unlink()
+
+    with open(layers_dir.joinpath("manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    print(f"Wrote {len(manifest['layers'])} availability layers to {layers_dir}")
 
 
 def refresh_availability_zone():
     ensure_dir()
-    retrive_availability_cells()
-    convert()
-    classify()
+    result = retrive_availability_cells()
+    if isinstance(result, fetch.NotModified):
+        print("Availability cells unchanged; skipping update.")
+        return
+    classify(convert())
+    result.commit()
@@ -0,0 +1,451 @@
+"""
+Offline benchmarks of the GeoIP pipeline hot paths on synthetic data.
+
+    python benchmark.py --scale 10k,100k
+    python benchmark.py --scale 100k --save-baseline
+    python benchmark.py --scale 100k --compare
+    python benchmark.py --import-budget 0.5
+
+Every case runs in a fresh process with its own temporary data directory, so the
+reported peak RSS belongs to that case alone. The growth in brackets is how
+far the timed part pushed the peak beyond the setup. DNS and geocoding are replaced
+by in-process fakes, nothing goes over the network.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+
+BASELINE_FILE = Path("./benchmark-baseline.json")
+# run in a fresh interpreter by check_import(), any socket use raises
+IMPORT_CHECK = """
+import socket, sys, time
+
+def offline(*args, **kwargs):
+    raise RuntimeError("network access at import time")
+
+socket.socket.connect = offline
+socket.create_connection = offline
+socket.getaddrinfo = offline
+
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+# run.py, the job modules it loads and the command line tools
+IMPORT_MODULES = [
+    "run",
+    "geoip_pop",
+    "atlas",
+    "availability",
+    "bgp",
+    "peeringdb",
+    "monthly_latency_snapshot",
+    "map.process_map",
+    "geoip_service",
+    "geoipdb",
+    "annotate",
+    "history",
+    "archive",
+]
+BENCHMARKS = [
+    "join_feed",
+    "update_dns_ptr",
+    "convert_geoip_to_json",
+    "get_pop_by_ip",
+    "annotate",
+    "get_city_list",
+]
+
+COUNTRIES = {
+    "US": ["US-CA", "US-NY", "US-TX", "US-WA"],
+    "CA": ["CA-BC", "CA-ON", "CA-QC"],
+    "GB": ["GB-ENG", "GB-SCT"],
+    "DE": ["DE-BE", "DE-BY"],
+    "AU": ["AU-NSW", "AU-VIC"],
+    "BR": ["BR-SP", "BR-RJ"],
+    "JP": ["JP-13"],
+    "PH": ["PH-00"],
+}
+POPS = [
+    "sfiabgr1",
+    "lsancax1",
+    "nwyynyx1",
+    "dllstxx1",
+    "sttlwax1",
+    "tmtoont1",
+    "lndngbr1",
+    "frntdeu1",
+    "sydyaus1",
+    "sopabra1",
+    "tkyojpn1",
+    "mnlaphl1",
+]
+
+
+def parse_scale(value: str) -> int:
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
+def synthetic_cidrs(n: int, ipv6_ratio: float, rng: random.Random) -> list[str]:
+    cidrs = []
+    v4 = v6 = 0
+    for _ in range(n):
+        if rng.random() < ipv6_ratio:
+            cidrs.append(f"2a0d:3344:{v6 >> 16:x}:{v6 & 0xFFFF:x}::/64")
+            v6 += 1
+        else:
+            # consecutive /24s from 98.0.0.0
+            base = (98 << 16) + v4
+            cidrs.append(f"{base >> 16}.{(base >> 8) & 0xFF}.{base & 0xFF}.0/24")
+            v4 += 1
+    return cidrs
+
+
+def generate_feeds(n: int, ipv6_ratio: float = 0.3, seed: int = 1) -> tuple[str, str]:
+    """
+    Return (feed.csv, pops.csv) with n CIDRs. About one city per 50 CIDRs,
+    90% of the CIDRs have a PoP.
+    """
+    rng = random.Random(seed)
+    cidrs = synthetic_cidrs(n, ipv6_ratio, rng)
+    cities = [
+        (country, region, f"City {i}")
+        for i in range(max(1, n // 50))
+        for country, regions in [rng.choice(list(COUNTRIES.items()))]
+        for region in [rng.choice(regions)]
+    ]
+
+    feed = []
+    pops = []
+    for cidr in cidrs:
+        country, region, city = rng.choice(cities)
+        feed.append(f"{cidr},{country},{region},{city},")
+        if rng.random() < 0.9:
+            pop = rng.choice(POPS)
+            pops.append(f"{cidr},{pop},{pop[:3]}")
+    return "\n".join(feed) + "\n", "\n".join(pops) + "\n"
+
+
+def rss_kb() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def fake_resolve_many(ptrs: dict[str, str], latency: float, delay: float, timeout_rate: float):
+    """
+    Stand-in for ptr_resolver.resolve_many: every query takes latency seconds,
+    timeout_rate of them time out after delay seconds and return None.
+    """
+    rng = random.Random(2)
+
+    async def resolve_many(ips, concurrency=256, timeout=None, server=None):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def query(ip):
+            async with semaphore:
+                if rng.random() < timeout_rate:
+                    await asyncio.sleep(delay)
+                    return None
+                await asyncio.sleep(latency)
+                return ptrs.get(str(ip), ""), 300
+
+        return await asyncio.gather(*(query(ip) for ip in ips))
+
+    return resolve_many
+
+
+class FakeGeocode:
+    def __init__(self, json):
+        self.json = json
+
+
+def prepare_case(name: str, n: int, options: dict, data_dir: Path):
+    """
+    Set up one case in data_dir and return (items, func), func being the
+    part that is timed.
+    """
+    feed, pops = generate_feeds(n, options["ipv6_ratio"], options["seed"])
+    for subdir in ["feed", "pop", "geoip", "map"]:
+        data_dir.joinpath(subdir).mkdir(parents=True, exist_ok=True)
+    data_dir.joinpath("feed/feed-latest.csv").write_text(feed)
+    data_dir.joinpath("pop/pops-latest.csv").write_text(pops)
+
+    import geoip_pop
+
+    if name == "join_feed":
+        return n, geoip_pop.join_feed
+
+    if name == "update_dns_ptr":
+        import context
+        import ptr_resolver
+
+        ctx = context.current()
+        ctx.path(geoip_pop.GEOIP_DATA_DIR, f"{ctx.year}{ctx.month}").mkdir(
+            parents=True, exist_ok=True
+        )
+        ptrs = {}
+        for line in pops.splitlines():
+            cidr, pop, _ = line.split(",")
+            ptrs[cidr.split("/")[0]] = f"customer.{pop}.pop.starlinkisp.net."
+        ptr_resolver.resolve_many = fake_resolve_many(
+            ptrs, options["dns_latency"], options["dns_timeout"], options["dns_timeout_rate"]
+        )
+        df = geoip_pop.join_feed()
+        return n, lambda: geoip_pop.update_dns_ptr(df, resolver="async")
+
+    df = geoip_pop.join_feed()
+    df["dns_ptr"] = ["customer.{}.pop.starlinkisp.net.".format(p) for p in df["pop"]]
+    df, _ = geoip_pop.postprocess_dns_ptr(df)
+    df = df.astype(str).replace("nan", "")
+
+    if name == "convert_geoip_to_json":
+        return n, lambda: geoip_pop.convert_geoip_to_json(df)
+
+    if name == "get_pop_by_ip":
+        import util
+
+        util.POP_FEED_URL = str(data_dir.joinpath("pop/pops-latest.csv"))
+        geoip = util.GEOIP()
+        rng = random.Random(options["seed"])
+        ips = [cidr.split("/")[0] for cidr in rng.sample(list(df["cidr"]), min(n, 100_000))]
+
+        def lookup():
+            for ip in ips:
+                geoip.get_pop_by_ip(ip)
+
+        return len(ips), lookup
+
+    if name == "annotate":
+        import annotate
+
+        csv_file = data_dir.joinpath("geoip/geoip-pops-ptr-latest.csv")
+        df.to_csv(csv_file, index=False)
+        table = annotate.load_table(csv_file)
+        rng = random.Random(options["seed"])
+        ips = [cidr.split("/")[0] for cidr in rng.choices(list(df["cidr"]), k=n)]
+        chunk = ("\n".join(ips) + "\n").encode()
+        return len(ips), lambda: annotate.annotate_chunk(chunk, "text", None, table)
+
+    if name == "get_city_list":
+        import map.process_map as process_map
+
+        latency = options["geocode_latency"]
+
+        def arcgis(query):
+            if latency:
+                time.sleep(latency)
+            return FakeGeocode({"lat": 1.0, "lng": 2.0})
+
+        process_map.geocoder.arcgis = arcgis
+        geoip_json = geoip_pop.convert_geoip_to_json(df)
+        pop_index = process_map.build_pop_index(df)
+        cities = sum(
+            len(cities)
+            for regions in geoip_json["countries"].values()
+            for cities in regions.values()
+        )
+        return cities, lambda: process_map.get_city_list(geoip_json, pop_index)
+
+    raise ValueError(f"Unknown benchmark: {name}")
+
+
+def run_case(name: str, n: int, options: dict) -> dict:
+    import context
+
+    with tempfile.TemporaryDirectory(prefix="geoip-bench-") as tmp:
+        context.start_run(data_dir=tmp, state_dir=Path(tmp).joinpath("state"))
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            items, func = prepare_case(name, n, options, Path(tmp))
+            rss_before = rss_kb()
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+        peak = rss_kb()
+    return {
+        "benchmark": name,
+        "scale": n,
+        "items": items,
+        "seconds": round(seconds, 4),
+        "items_per_second": round(items / seconds, 1) if seconds else None,
+        "peak_rss_kb": peak,
+        "rss_growth_kb": peak - rss_before,
+    }
+
+
+def run_benchmarks(names: list[str], scales: list[int], options: dict, repeat: int) -> list[dict]:
+    results = []
+    # spawn so every case starts from a clean interpreter and RSS
+    context = multiprocessing.get_context("spawn")
+    for n in scales:
+        for name in names:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    runs.append(pool.submit(run_case, name, n, options).result())
+            best = min(runs, key=lambda r: r["seconds"])
+            best["peak_rss_kb"] = max(r["peak_rss_kb"] for r in runs)
+            best["rss_growth_kb"] = max(r["rss_growth_kb"] for r in runs)
+            print(
+                f"{name:<22} {n:>9} {best['items']:>9} items {best['seconds']:>9.3f}s "
+                f"{best['items_per_second'] or 0:>12.1f}/s  peak {best['peak_rss_kb'] / 1024:8.1f} MiB "
+                f"(+{best['rss_growth_kb'] / 1024:.1f})"
+            )
+            results.append(best)
+    return results
+
+
+def result_key(result: dict) -> str:
+    return f"{result['benchmark']}@{result['scale']}"
+
+
+def compare(results: list[dict], baseline: dict, threshold: float) -> list[str]:
+    """Print the change against the baseline, return the regressed cases."""
+    regressions = []
+    previous = {result_key(r): r for r in baseline["results"]}
+    for result in results:
+        key = result_key(result)
+        if key not in previous:
+            print(f"{key:<32} no baseline")
+            continue
+        base = previous[key]
+        speed = base["seconds"] / result["seconds"] if result["seconds"] else float("inf")
+        memory = result["peak_rss_kb"] / base["peak_rss_kb"] if base["peak_rss_kb"] else 1.0
+        flag = ""
+        if speed < 1 - threshold or memory > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:<32} speed x{speed:.2f}  memory x{memory:.2f}{flag}")
+    return regressions
+
+
+def check_import(module: str, budget: float, repeat: int = 3) -> bool:
+    """
+    Import module in a fresh interpreter with the network disabled and an
+    empty DATA_DIR and STATE_DIR, and check the fastest import stays within
+    budget seconds.
+    """
+    timings = []
+    with tempfile.TemporaryDirectory(prefix="geoip-import-") as tmp:
+        for _ in range(repeat):
+            process = subprocess.run(
+                [sys.executable, "-c", IMPORT_CHECK.format(module=module)],
+                env={**os.environ, "DATA_DIR": tmp, "STATE_DIR": os.path.join(tmp, "state")},
+                capture_output=True,
+                text=True,
+            )
+            if process.returncode != 0:
+                print(f"import {module} failed:\n{process.stderr}")
+                return False
+            timings.append(float(process.stdout.splitlines()[-1]))
+        created = os.listdir(tmp)
+    seconds = min(timings)
+    ok = seconds <= budget and not created
+    print(f"import {module}: {seconds:.3f}s (budget {budget:g}s){'' if ok else '  OVER BUDGET'}")
+    if created:
+        print(f"import {module} created {', '.join(sorted(created))} in DATA_DIR or STATE_DIR")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GeoIP pipeline benchmarks")
+    parser.add_argument("--scale", default="10k", help="comma separated, e.g. 10k,100k,1M")
+    parser.add_argument("--bench", default=",".join(BENCHMARKS), help="comma separated benchmarks")
+    parser.add_argument("--repeat", type=int, default=1, help="keep the fastest of this many runs")
+    parser.add_argument("--ipv6-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dns-latency", type=float, default=0.002, help="seconds per PTR query")
+    parser.add_argument("--dns-timeout", type=float, default=0.05, help="seconds per timed out query")
+    parser.add_argument("--dns-timeout-rate", type=float, default=0.01)
+    parser.add_argument("--geocode-latency", type=float, default=0.0, help="seconds per geocoder call")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="compare with the saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression")
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        help="only check that IMPORT_MODULES import offline without writing to DATA_DIR or STATE_DIR, "
+        "and import run takes at most this many seconds",
+    )
+    parser.add_argument(
+        "--module-import-budget",
+        type=float,
+        default=5.0,
+        help="budget for the other modules of the import check, they load pandas",
+    )
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        failed = [
+            module
+            for module in IMPORT_MODULES
+            if not check_import(
+                module, args.import_budget if module == "run" else args.module_import_budget
+            )
+        ]
+        if failed:
+            print(f"Import check failed for {', '.join(failed)}")
+            sys.exit(1)
+        return
+
+    names = [b for b in args.bench.split(",") if b]
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    options = {
+        "ipv6_ratio": args.ipv6_ratio,
+        "seed": args.seed,
+        "dns_latency": args.dns_latency,
+        "dns_timeout": args.dns_timeout,
+        "dns_timeout_rate": args.dns_timeout_rate,
+        "geocode_latency": args.geocode_latency,
+    }
+
+    results = run_benchmarks(names, [parse_scale(s) for s in args.scale.split(",")], options, args.repeat)
+
+    if args.compare:
+        if not args.baseline.exists():
+            print(f"Baseline {args.baseline} not found")
+            sys.exit(1)
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions")
+            sys.exit(1)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "created_at": time.strftime("%Y%m%d-%H%M", time.gmtime()),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "cpu_count": os.cpu_count(),
+                    "options": options,
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+        print(f"Saved baseline to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
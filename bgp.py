@@ -1,17 +1,28 @@
 import os
-import httpx
-import datetime
-
-import pandas as pd
+import re
+import json
 
 from ipaddress import ip_network
 from dataclasses import dataclass
-from pathlib import Path
+
+import context
+import fetch
+import metrics
 
 
 STARLINK_ASN = [14593, 45700]
 
-DATA_DIR = os.getenv("DATA_DIR", "./starlink-geoip-data")
+BGP_TABLE_URL = "https://bgp.tools/table.jsonl"
+RAW_TABLE_FILE = "./table.jsonl"
+# relative to the data directory of the run
+BGP_CSV_FILE = "bgp/starlink-bgp.csv"
+# keep a copy of the full table on disk, it is several hundred MB
+KEEP_RAW_TABLE = os.getenv("BGP_KEEP_RAW_TABLE", "0") == "1"
+
+# cheap prefilter on the raw line, only matching lines are parsed as JSON
+ASN_PATTERN = re.compile(
+    r'"ASN"\s*:\s*(?:{})\b'.format("|".join(str(asn) for asn in STARLINK_ASN))
+)
 
 
 @dataclass
@@ -21,57 +32,62 @@ class Record:
     Hits: int
 
 
-def get_date() -> str:
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
-    return now.strftime("%Y%m%d-%H%M")
-
-
-date = get_date()
-
-
 headers = {
     "User-Agent": "Starlink GeoIP Database GitHub Actions CI (https://github.com/clarkzjw/starlink-geoip)"
 }
 
 
-def new_client():
-    return httpx.Client()
+def get_bgp_list(keep_raw: bool = KEEP_RAW_TABLE):
+    bgp_csv_file = context.data_path(BGP_CSV_FILE)
+    # only ask for a 304 if the outputs of the last download are still there
+    conditional = bgp_csv_file.exists() and (
+        not keep_raw or os.path.exists(RAW_TABLE_FILE)
+    )
 
-
-def get_bgp_list():
-    client = new_client()
+    list = {14593: {"IPv4": [], "IPv6": []}, 45700: {"IPv4": [], "IPv6": []}}
 
     print("Downloading BGP announcement table from bgp.tools")
-    response = client.get("https://bgp.tools/table.jsonl", headers=headers)
-    with open("./table.jsonl", "wb") as f:
-        f.write(response.content)
-
-    jsonObj = pd.read_json(path_or_buf="./table.jsonl", lines=True)
     count = 0
-    total = len(jsonObj)
-
-    list = {14593: {"IPv4": [], "IPv6": []}, 45700: {"IPv4": [], "IPv6": []}}
-
-    for line in jsonObj.iterrows():
-        ASN = line[1]["ASN"]
-        count += 1
-        if count % 10000 == 0:
-            print(f"Iterating {count} BGP entries, {count/total:.2%} done")
-
-        if ASN in STARLINK_ASN:
-            CIDR = line[1]["CIDR"]
-            HITS = line[1]["Hits"]
-            r = Record(CIDR, ASN, HITS)
-            if ip_network(CIDR).version == 4:
-                list[ASN]["IPv4"].append(r)
-            elif ip_network(CIDR).version == 6:
-                list[ASN]["IPv6"].append(r)
+    raw_table = None
+    try:
+        with metrics.stage("bgp.download"), fetch.stream(
+            BGP_TABLE_URL, conditional=conditional, headers=headers
+        ) as result:
+            if isinstance(result, fetch.NotModified):
+                print("BGP table unchanged; skipping update.")
+                return
+            raw_table = open(RAW_TABLE_FILE, "w") if keep_raw else None
+            for line in result.response.iter_lines():
+                if raw_table is not None:
+                    raw_table.write(line + "\n")
+                count += 1
+                if count % 100000 == 0:
+                    print(f"Iterating {count} BGP entries")
+
+                if not ASN_PATTERN.search(line):
+                    continue
+                entry = json.loads(line)
+                ASN = entry["ASN"]
+                if ASN not in STARLINK_ASN:
+                    continue
+
+                r = Record(entry["CIDR"], ASN, entry["Hits"])
+                if ip_network(r.CIDR).version == 4:
+                    list[ASN]["IPv4"].append(r)
+                else:
+                    list[ASN]["IPv6"].append(r)
+    finally:
+        if raw_table is not None:
+            raw_table.close()
+    print(f"Iterated {count} BGP entries")
+    metrics.incr("bgp.entries", count)
+    metrics.incr("bgp.rows", sum(len(v["IPv4"]) + len(v["IPv6"]) for v in list.values()))
 
     for ASN in STARLINK_ASN:
         list[ASN]["IPv4"] = sorted(list[ASN]["IPv4"], key=lambda x: x.CIDR)
         list[ASN]["IPv6"] = sorted(list[ASN]["IPv6"], key=lambda x: x.CIDR)
 
-    with open(Path(DATA_DIR).joinpath("bgp/starlink-bgp.csv"), "w") as f:
+    with open(bgp_csv_file, "w") as f:
         f.write("CIDR,ASN\n")
 
         for ASN in STARLINK_ASN:
@@ -79,6 +95,7 @@ def get_bgp_list():
                 f.write(f"{r.CIDR},{r.ASN}\n")
             for r in list[ASN]["IPv6"]:
                 f.write(f"{r.CIDR},{r.ASN}\n")
+    result.commit()
 
 
 if __name__ == "__main__":
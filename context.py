@@ -0,0 +1,107 @@
+"""
+Per-run context: the time a run is named after and the directories it uses.
+
+Modules used to fix datetime.now() and DATA_DIR when they were imported. They
+now ask for the context when they need it, so importing a module has no side
+effects and every output of a run carries the same timestamp:
+
+    ctx = context.current()
+    path = ctx.path(FEED_DATA_DIR, f"feed-{ctx.dt_string}.csv")
+
+Modules keep their paths as names relative to a directory and resolve them on
+use. data_dir (DATA_DIR) is what gets published. state_dir (STATE_DIR) holds
+what only the next run needs: caches, HTTP validators, output digests and
+metrics. Building a Path does not touch the disk, directories are created by
+the code that writes to them.
+
+run.py starts the context explicitly. Anything else (tools, benchmarks, a
+module run directly) gets one created on first use, with the directories taken
+from the environment at that moment.
+"""
+
+import os
+import threading
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+
+DEFAULT_DATA_DIR = "./starlink-geoip-data"
+DEFAULT_STATE_DIR = "./starlink-geoip-state"
+
+
+def default_data_dir() -> Path:
+    return Path(os.getenv("DATA_DIR", DEFAULT_DATA_DIR))
+
+
+def default_state_dir() -> Path:
+    return Path(os.getenv("STATE_DIR", DEFAULT_STATE_DIR))
+
+
+@dataclass(frozen=True)
+class RunContext:
+    now: datetime = field(default_factory=lambda: datetime.now(tz=timezone.utc))
+    data_dir: Path = field(default_factory=default_data_dir)
+    state_dir: Path = field(default_factory=default_state_dir)
+
+    @property
+    def year(self) -> int:
+        return self.now.year
+
+    @property
+    def month(self) -> int:
+        return self.now.month
+
+    @property
+    def dt_string(self) -> str:
+        return self.now.strftime("%Y%m%d-%H%M")
+
+    def path(self, *parts: str | Path) -> Path:
+        """parts joined under the data directory of this run."""
+        return Path(self.data_dir).joinpath(*parts)
+
+    def state_path(self, *parts: str | Path) -> Path:
+        """parts joined under the state directory of this run."""
+        return Path(self.state_dir).joinpath(*parts)
+
+
+_current: RunContext | None = None
+_lock = threading.Lock()
+
+
+def start_run(
+    now: datetime | None = None,
+    data_dir: Path | str | None = None,
+    state_dir: Path | str | None = None,
+) -> RunContext:
+    """Make a new context the current one and return it."""
+    global _current
+    kwargs = {}
+    if now is not None:
+        kwargs["now"] = now
+    if data_dir is not None:
+        kwargs["data_dir"] = Path(data_dir)
+    if state_dir is not None:
+        kwargs["state_dir"] = Path(state_dir)
+    with _lock:
+        _current = RunContext(**kwargs)
+        return _current
+
+
+def current() -> RunContext:
+    global _current
+    with _lock:
+        if _current is None:
+            _current = RunContext()
+        return _current
+
+
+def data_path(*parts: str | Path) -> Path:
+    """parts joined under the data directory of the current run."""
+    return current().path(*parts)
+
+
+def state_path(*parts: str | Path) -> Path:
+    """parts joined under the state directory of the current run."""
+    return current().state_path(*parts)
@@ -0,0 +1,209 @@
+"""
+Shared HTTP fetching with conditional requests.
+
+All downloads go through one pooled httpx client. The ETag and Last-Modified
+of every URL are kept in cache/http-validators.json under the state directory
+of the run and sent back as If-None-Match / If-Modified-Since, so an unchanged
+resource comes back as NotModified and the caller can skip its downstream work.
+
+Validators are only stored when the caller calls commit() on the result,
+after every output built from the download has been written: the geoip feeds
+are committed once geoip-pops-ptr-latest.csv is published, the availability
+cells once the layers are. A run that fails halfway will download the
+resource again next time instead of skipping it. Callers only send a
+conditional request while the outputs of the previous download exist.
+"""
+
+import os
+import json
+import atexit
+import threading
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+import httpx
+
+import context
+import metrics
+
+
+# relative to the state directory of the run
+VALIDATORS_FILE = "cache/http-validators.json"
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+
+
+class ValidatorStore:
+    def __init__(self, path: Path | None = None):
+        # None follows the data directory of the current run
+        self.fixed_path = None if path is None else Path(path)
+        self.lock = threading.Lock()
+        self.entries: dict[str, dict] | None = None
+        self.loaded_from: Path | None = None
+
+    @property
+    def path(self) -> Path:
+        return self.fixed_path or context.state_path(VALIDATORS_FILE)
+
+    def _load(self) -> dict[str, dict]:
+        path = self.path
+        if self.entries is None or self.loaded_from != path:
+            self.entries = {}
+            self.loaded_from = path
+            if path.exists():
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+        return self.entries
+
+    def get(self, url: str) -> dict:
+        with self.lock:
+            return dict(self._load().get(url, {}))
+
+    def put(self, url: str, validators: dict):
+        with self.lock:
+            entries = self._load()
+            if validators:
+                entries[url] = validators
+            else:
+                entries.pop(url, None)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+@dataclass
+class NotModified:
+    url: str
+
+    def commit(self):
+        pass
+
+
+@dataclass
+class Fetched:
+    url: str
+    status_code: int
+    headers: httpx.Headers
+    # None for streamed responses, read them from response instead
+    content: bytes | None = None
+    response: httpx.Response | None = field(default=None, repr=False)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    @property
+    def validators(self) -> dict:
+        validators = {}
+        if "etag" in self.headers:
+            validators["etag"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["last_modified"] = self.headers["last-modified"]
+        return validators
+
+    def commit(self):
+        """Remember the validators of this response for the next request."""
+        store.put(self.url, self.validators)
+
+
+FetchResult = Fetched | NotModified
+
+store = ValidatorStore()
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> httpx.Client:
+    """
+    Return the shared client. httpx clients are thread safe, so jobs running in
+    parallel share one connection pool. httpx sends Accept-Encoding for every
+    decoder it has (gzip and deflate, plus br/zstd when installed) and decodes
+    the response transparently.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(
+                timeout=HTTP_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS),
+            )
+            atexit.register(_client.close)
+        return _client
+
+
+def conditional_headers(url: str) -> dict:
+    validators = store.get(url)
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def _request_headers(url: str, conditional: bool, headers: dict | None) -> dict:
+    merged = dict(headers or {})
+    if conditional:
+        merged.update(conditional_headers(url))
+    return merged
+
+
+def fetch(
+    url: str,
+    conditional: bool = True,
+    headers: dict | None = None,
+    client: httpx.Client | None = None,
+) -> FetchResult:
+    """
+    GET url. With conditional, send the stored validators and return
+    NotModified on 304. Raise httpx.HTTPStatusError on other errors.
+    """
+    client = client or get_client()
+    response = client.get(url, headers=_request_headers(url, conditional, headers))
+    metrics.incr("http.requests")
+    metrics.incr("http.bytes", response.num_bytes_downloaded)
+    if response.status_code == 304:
+        metrics.incr("http.not_modified")
+        print(f"{url} not modified")
+        return NotModified(url)
+    response.raise_for_status()
+    return Fetched(url, response.status_code, response.headers, response.content)
+
+
+@contextmanager
+def stream(
+    url: str,
+    conditional: bool = True,
+    headers: dict | None = None,
+    client: httpx.Client | None = None,
+) -> Iterator[FetchResult]:
+    """
+    Like fetch(), but the body of a Fetched result is read from its response,
+    e.g. with response.iter_lines(), inside the with block.
+    """
+    client = client or get_client()
+    with client.stream(
+        "GET", url, headers=_request_headers(url, conditional, headers)
+    ) as response:
+        metrics.incr("http.requests")
+        try:
+            if response.status_code == 304:
+                metrics.incr("http.not_modified")
+                print(f"{url} not modified")
+                yield NotModified(url)
+                return
+            response.raise_for_status()
+            yield Fetched(url, response.status_code, response.headers, response=response)
+        finally:
+            metrics.incr("http.bytes", response.num_bytes_downloaded)
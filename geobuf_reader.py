@@ -0,0 +1,279 @@
+"""
+Pure Python decoder for geobuf, a compact protobuf encoding of GeoJSON.
+
+https://github.com/mapbox/geobuf/blob/master/geobuf.proto
+
+Features are decoded one at a time, so a FeatureCollection can be consumed
+as a stream instead of being converted to GeoJSON text first. The output
+matches geobuf2json from the geobuf npm package, except that a feature
+without a geometry gets "geometry": null as GeoJSON requires.
+"""
+
+import json
+import struct
+
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+
+GEOMETRY_TYPES = [
+    "Point",
+    "MultiPoint",
+    "LineString",
+    "MultiLineString",
+    "Polygon",
+    "MultiPolygon",
+    "GeometryCollection",
+]
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_BYTES = 2
+WIRE_FIXED32 = 5
+
+
+class GeobufError(Exception):
+    pass
+
+
+def read_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def read_packed_varints(buf: bytes, pos: int, end: int) -> list[int]:
+    values = []
+    append = values.append
+    while pos < end:
+        b = buf[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+            continue
+        result = b & 0x7F
+        shift = 7
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7F) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def iter_fields(buf: bytes, pos: int, end: int) -> Iterator[tuple[int, int, Any]]:
+    """
+    Yield (field number, wire type, value) of a message. The value of a
+    length-delimited field is its (start, end) range in buf.
+    """
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x07
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == WIRE_BYTES:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == WIRE_FIXED64:
+            value = buf[pos : pos + 8]
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = buf[pos : pos + 4]
+            pos += 4
+        else:
+            raise GeobufError(f"unsupported wire type {wire_type}")
+        yield field, wire_type, value
+    if pos != end:
+        raise GeobufError("message overruns its length")
+
+
+def number(value: float) -> int | float:
+    # JSON.stringify writes integral doubles without a fraction
+    return int(value) if value.is_integer() else value
+
+
+class GeobufReader:
+    def __init__(self, data: bytes):
+        self.buf = data
+        self.keys: list[str] = []
+        self.dim = 2
+        self.e = 10**6
+        self.body: tuple[int, tuple[int, int]] | None = None
+
+        for field, _, value in iter_fields(data, 0, len(data)):
+            if field == 1:
+                self.keys.append(self.string(value))
+            elif field == 2:
+                self.dim = value
+            elif field == 3:
+                self.e = 10**value
+            elif field in (4, 5, 6):
+                # feature_collection, feature or geometry
+                self.body = (field, value)
+
+    def string(self, value: tuple[int, int]) -> str:
+        return self.buf[value[0] : value[1]].decode("utf-8")
+
+    def read_value(self, start: int, end: int) -> Any:
+        for field, _, value in iter_fields(self.buf, start, end):
+            if field == 1:
+                return self.string(value)
+            if field == 2:
+                return number(struct.unpack("<d", value)[0])
+            if field == 3:
+                return value
+            if field == 4:
+                return -value
+            if field == 5:
+                return bool(value)
+            if field == 6:
+                return json.loads(self.string(value))
+        return None
+
+    def read_props(self, value: tuple[int, int], values: list, target: dict):
+        pairs = read_packed_varints(self.buf, value[0], value[1])
+        for i in range(0, len(pairs) - 1, 2):
+            target[self.keys[pairs[i]]] = values[pairs[i + 1]]
+
+    def line_part(self, deltas: list[int], pos: int, count: int, closed: bool):
+        coords = []
+        dim = self.dim
+        e = self.e
+        prev = [0] * dim
+        for _ in range(count):
+            point = []
+            for d in range(dim):
+                prev[d] += zigzag(deltas[pos])
+                pos += 1
+                point.append(number(prev[d] / e))
+            coords.append(point)
+        if closed and coords:
+            coords.append(coords[0])
+        return coords, pos
+
+    def coordinates(self, geom_type: str, lengths: list[int] | None, deltas: list[int]):
+        dim = self.dim
+        if geom_type == "Point":
+            return [number(zigzag(d) / self.e) for d in deltas]
+        if geom_type in ("MultiPoint", "LineString"):
+            return self.line_part(deltas, 0, len(deltas) // dim, False)[0]
+        if geom_type in ("MultiLineString", "Polygon"):
+            closed = geom_type == "Polygon"
+            if not lengths:
+                return [self.line_part(deltas, 0, len(deltas) // dim, closed)[0]]
+            lines = []
+            pos = 0
+            for length in lengths:
+                line, pos = self.line_part(deltas, pos, length, closed)
+                lines.append(line)
+            return lines
+        if geom_type == "MultiPolygon":
+            if not lengths:
+                return [[self.line_part(deltas, 0, len(deltas) // dim, True)[0]]]
+            polygons = []
+            pos = 0
+            j = 1
+            for _ in range(lengths[0]):
+                rings = []
+                for k in range(lengths[j]):
+                    ring, pos = self.line_part(deltas, pos, lengths[j + 1 + k], True)
+                    rings.append(ring)
+                j += lengths[j] + 1
+                polygons.append(rings)
+            return polygons
+        raise GeobufError(f"unknown geometry type {geom_type}")
+
+    def read_geometry(self, start: int, end: int) -> dict:
+        # Point is the zero value of the type enum, which proto3 encoders omit
+        geom: dict[str, Any] = {"type": GEOMETRY_TYPES[0]}
+        lengths = None
+        values: list = []
+        for field, _, value in iter_fields(self.buf, start, end):
+            if field == 1:
+                geom["type"] = GEOMETRY_TYPES[value]
+            elif field == 2:
+                lengths = read_packed_varints(self.buf, value[0], value[1])
+            elif field == 3:
+                deltas = read_packed_varints(self.buf, value[0], value[1])
+                geom["coordinates"] = self.coordinates(geom["type"], lengths, deltas)
+                lengths = None
+            elif field == 4:
+                geom.setdefault("geometries", []).append(self.read_geometry(*value))
+            elif field == 13:
+                values.append(self.read_value(*value))
+            elif field == 15:
+                self.read_props(value, values, geom)
+                values = []
+        return geom
+
+    def read_feature(self, start: int, end: int) -> dict:
+        # GeoJSON requires the geometry member, null for an unlocated feature
+        feature: dict[str, Any] = {"type": "Feature", "geometry": None}
+        values: list = []
+        for field, _, value in iter_fields(self.buf, start, end):
+            if field == 1:
+                feature["geometry"] = self.read_geometry(*value)
+            elif field == 11:
+                feature["id"] = self.string(value)
+            elif field == 12:
+                feature["id"] = zigzag(value)
+            elif field == 13:
+                values.append(self.read_value(*value))
+            elif field == 14:
+                feature["properties"] = {}
+                self.read_props(value, values, feature["properties"])
+                values = []
+            elif field == 15:
+                self.read_props(value, values, feature)
+                values = []
+        return feature
+
+    def features(self) -> Iterator[dict]:
+        if self.body is None:
+            return
+        field, (start, end) = self.body
+        if field == 5:
+            yield self.read_feature(start, end)
+        elif field == 4:
+            for tag, _, value in iter_fields(self.buf, start, end):
+                if tag == 1:
+                    yield self.read_feature(*value)
+
+
+def iter_features(path: Path | str) -> Iterator[dict]:
+    """
+    Yield the GeoJSON features of a geobuf file one at a time.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    yield from GeobufReader(data).features()
+
+
+def write_geojson(features: Iterable[dict], path: Path | str):
+    """
+    Stream a FeatureCollection to path, formatted like
+    json.dumps(collection, separators=(",", ":")).
+    """
+    with open(path, "w") as f:
+        f.write('{"type":"FeatureCollection","features":[')
+        first = True
+        for feature in features:
+            if not first:
+                f.write(",")
+            f.write(json.dumps(feature, separators=(",", ":")))
+            first = False
+        f.write("]}")
@@ -1,35 +1,59 @@
+import io
 import os
-import sys
 import time
-import httpx
 import ipaddress
 import threading
 import subprocess
 import json
+import socket
+import asyncio
 from pathlib import Path
 from typing import Dict, Any
-from collections import Counter
-
-from datetime import datetime, timezone
+from dataclasses import dataclass, field
 
+import numpy as np
 import pandas as pd
 
+import archive
+import context
+import fetch
+import geoipdb
+import history
+import metrics
+import ptr_resolver
+from ptr_cache import PTRCache
+from util import write_if_changed
+
 GEOIP_FEED = "https://geoip.starlinkisp.net/feed.csv"
 POP_FEED = "https://geoip.starlinkisp.net/pops.csv"
 
-datetime_now = datetime.now(tz=timezone.utc)
-year = datetime_now.year
-month = datetime_now.month
-dt_string = datetime_now.strftime("%Y%m%d-%H%M")
+# relative to the data directory of the run, see context.data_path()
+FEED_DATA_DIR = "feed"
+POP_FEED_DATA_DIR = "pop"
+GEOIP_DATA_DIR = "geoip"
+
+FEED_LATEST_FILE = "feed/feed-latest.csv"
+POP_LATEST_FILE = "pop/pops-latest.csv"
+GEOIP_LATEST_FILE = "geoip/geoip-pops-ptr-latest.csv"
 
-DATA_DIR = os.getenv("DATA_DIR", "./starlink-geoip-data")
-FEED_DATA_DIR = Path(DATA_DIR).joinpath("feed")
-POP_FEED_DATA_DIR = Path(DATA_DIR).joinpath("pop")
-GEOIP_DATA_DIR = Path(DATA_DIR).joinpath("geoip")
+# "dig" forks dig +trace per CIDR, "async" uses the in-process resolver
+PTR_RESOLVER = os.getenv("PTR_RESOLVER", "dig")
+PTR_CONCURRENCY = int(os.getenv("PTR_CONCURRENCY", ptr_resolver.DEFAULT_CONCURRENCY))
+PTR_TIMEOUT = float(os.getenv("PTR_TIMEOUT", ptr_resolver.DEFAULT_TIMEOUT))
 
-FEED_LATEST_FILE = FEED_DATA_DIR.joinpath("feed-latest.csv")
-POP_LATEST_FILE = POP_FEED_DATA_DIR.joinpath("pops-latest.csv")
-GEOIP_LATEST_FILE = GEOIP_DATA_DIR.joinpath("geoip-pops-ptr-latest.csv")
+# relative to the state directory of the run
+PTR_CACHE_FILE = "cache/ptr-cache.sqlite3"
+# floor applied to record TTLs, e.g. to skip PTRs that expire within a run interval
+PTR_CACHE_MIN_TTL = int(os.getenv("PTR_CACHE_MIN_TTL", "0"))
+# cap on expired entries refreshed per run, unset means no cap
+PTR_CACHE_MAX_REFRESH = os.getenv("PTR_CACHE_MAX_REFRESH")
+# TTL for CIDRs left without a PTR that no record TTL covers: skipped or
+# invalid subnets, queries out of attempts and negative answers without a TTL
+PTR_CACHE_NEGATIVE_TTL = int(os.getenv("PTR_CACHE_NEGATIVE_TTL", "21600"))
+
+# snapshots always go to the archive, the monthly CSV copies are opt-in since
+# the archive replaced them, see archive.py migrate
+KEEP_CSV_SNAPSHOTS = os.getenv("KEEP_CSV_SNAPSHOTS", "0") == "1"
 
 
 def read_file(file_path: Path) -> str:
@@ -37,81 +61,279 @@ def read_file(file_path: Path) -> str:
         return f.read()
 
 
-def get_feed():
-    for dir_path in [FEED_DATA_DIR, GEOIP_DATA_DIR, POP_FEED_DATA_DIR]:
-        _dir = dir_path.joinpath(f"{year}{month}")
-        if not _dir.exists():
-            _dir.mkdir(parents=True, exist_ok=True)
-
-    with httpx.Client() as client:
-        feeds_urls = [GEOIP_FEED, POP_FEED]
-        for url in feeds_urls:
-            geoip_file = client.get(url)
-            content = geoip_file.content.decode("utf-8")
-            filename = url.split("/")[-1]
-            if filename == "feed.csv":
-                filename = (
-                    Path(FEED_DATA_DIR)
-                    .joinpath(f"{year}{month}")
-                    .joinpath(f"feed-{dt_string}.csv")
-                )
-                latest = Path(FEED_DATA_DIR).joinpath("feed-latest.csv")
-                old_file = read_file(FEED_LATEST_FILE)
-                if content == old_file:
-                    print("Feed file unchanged; skipping update.")
-                    continue
-            elif filename == "pops.csv":
-                filename = (
-                    Path(POP_FEED_DATA_DIR)
-                    .joinpath(f"{year}{month}")
-                    .joinpath(f"pops-{dt_string}.csv")
-                )
-                latest = Path(POP_FEED_DATA_DIR).joinpath("pops-latest.csv")
-                old_file = read_file(POP_LATEST_FILE)
-                if content == old_file:
-                    print("POP file unchanged; skipping update.")
-                    continue
-            else:
-                print("Unknown feed filename")
-                sys.exit(1)
+@dataclass
+class FeedDelta:
+    added: set[str] = field(default_factory=set)
+    removed: set[str] = field(default_factory=set)
+    changed: set[str] = field(default_factory=set)
 
-            with open(filename, "w") as f:
-                f.write(content)
-            with open(latest, "w") as f:
-                f.write(content)
+    @property
+    def unchanged(self) -> bool:
+        return not (self.added or self.removed or self.changed)
 
+    def __str__(self) -> str:
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed"
+
+
+def index_feed_lines(content: str) -> dict[str, str]:
+    rows = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        cidr = line.split(",", 1)[0].strip()
+        # keep the first row of a duplicated CIDR, like the merge in join_feed
+        rows.setdefault(cidr, line)
+    return rows
+
+
+def diff_feed(old_content: str, new_content: str) -> FeedDelta:
+    old_rows = index_feed_lines(old_content)
+    new_rows = index_feed_lines(new_content)
+    delta = FeedDelta()
+    for cidr, line in new_rows.items():
+        if cidr not in old_rows:
+            delta.added.add(cidr)
+        elif old_rows[cidr] != line:
+            delta.changed.add(cidr)
+    delta.removed = old_rows.keys() - new_rows.keys()
+    return delta
+
+
+@dataclass
+class Feed:
+    """
+    A downloaded feed. The new content stays in memory until the results built
+    from it are published, see publish(), so a run that fails on the way
+    leaves the latest file and the HTTP validators as they were and the next
+    run sees the same change again.
+    """
+
+    dataset: str
+    content: str
+    # None when there is no previous latest file
+    delta: FeedDelta | None
+    result: fetch.FetchResult
+    latest: Path
+    snapshot: Path
+    changed: bool = True
+
+    def publish(self):
+        """Archive the snapshot, replace the latest file and store the validators."""
+        if self.changed:
+            archive.append_snapshot(self.dataset, context.current().dt_string, self.content)
+            if KEEP_CSV_SNAPSHOTS:
+                self.snapshot.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.snapshot, "w") as f:
+                    f.write(self.content)
+            write_if_changed(self.latest, lambda f: f.write(self.content))
+        self.result.commit()
+
+
+@metrics.timed("geoip_pop.get_feed")
+def get_feed() -> tuple[Feed, Feed]:
+    """
+    Download feed.csv and pops.csv and diff each against its latest file.
+    Nothing is written, call publish() on both once the result is.
+    """
+    ctx = context.current()
+    feeds = []
+    for url, dataset, directory, latest_file, prefix in [
+        (GEOIP_FEED, "feed", FEED_DATA_DIR, FEED_LATEST_FILE, "feed"),
+        (POP_FEED, "pop", POP_FEED_DATA_DIR, POP_LATEST_FILE, "pops"),
+    ]:
+        latest = ctx.path(latest_file)
+        snapshot = ctx.path(directory, f"{ctx.year}{ctx.month}", f"{prefix}-{ctx.dt_string}.csv")
+
+        # a 304 is only useful if the previous download is still there
+        result = fetch.fetch(url, conditional=latest.exists())
+        if isinstance(result, fetch.NotModified):
+            feeds.append(Feed(dataset, read_file(latest), FeedDelta(), result, latest, snapshot, False))
+            continue
+        content = result.text
 
-def join_feed():
+        if not latest.exists():
+            feeds.append(Feed(dataset, content, None, result, latest, snapshot))
+            continue
+        old_file = read_file(latest)
+        if content == old_file:
+            print(f"{url} unchanged; skipping update.")
+            feeds.append(Feed(dataset, content, FeedDelta(), result, latest, snapshot, False))
+            continue
+        delta = diff_feed(old_file, content)
+        print(f"{url} changed: {delta}")
+        feeds.append(Feed(dataset, content, delta, result, latest, snapshot))
+
+    feed, pop = feeds
+    return feed, pop
+
+
+# IPv4 is mapped into ::ffff:0:0/96, so both families are 128 bit (high, low)
+V4_MAPPED = bytes(10) + b"\xff\xff"
+_ONES = (1 << 64) - 1
+# top bits of the high and low word kept by a prefix of each length
+MASK_HIGH = np.array([_ONES ^ (_ONES >> min(n, 64)) for n in range(129)], dtype=np.uint64)
+MASK_LOW = np.array([_ONES ^ (_ONES >> max(n - 64, 0)) for n in range(129)], dtype=np.uint64)
+
+MATCH_EXACT = "exact"
+MATCH_COVERING = "covering"
+MATCH_PARTIAL = "partial"
+
+
+def _parse_prefix(cidr) -> tuple[int, bytes, int]:
+    address, _, length = str(cidr).strip().partition("/")
+    try:
+        if ":" in address:
+            family, packed, bits = 6, socket.inet_pton(socket.AF_INET6, address), 128
+        else:
+            family, packed, bits = 4, V4_MAPPED + socket.inet_pton(socket.AF_INET, address), 32
+        prefixlen = int(length) if length else bits
+        if not 0 <= prefixlen <= bits:
+            raise ValueError(length)
+    except (OSError, ValueError):
+        return 0, bytes(16), 0
+    return family, packed, prefixlen + 128 - bits
+
+
+def prefix_ranges(cidrs) -> pd.DataFrame:
+    """
+    Parse CIDRs into family, the high and low 64 bits of the network address
+    and the prefix length in the 128 bit space. Host bits are cleared, so
+    10.0.0.1/24 and 10.0.0.0/24 are the same prefix. Invalid CIDRs are
+    dropped, the index is the position in cidrs.
+    """
+    cidrs = list(cidrs)
+    if not cidrs:
+        return pd.DataFrame(
+            {c: pd.Series(dtype=t) for c, t in [("family", "int64"), ("high", "uint64"), ("low", "uint64"), ("length", "int64")]}
+        )
+    families, packed, lengths = zip(*(_parse_prefix(c) for c in cidrs))
+    words = np.frombuffer(b"".join(packed), dtype=">u8").reshape(len(cidrs), 2).astype(np.uint64)
+    length = np.array(lengths, dtype=np.int64)
+    ranges = pd.DataFrame(
+        {
+            "family": np.array(families, dtype=np.int64),
+            "high": words[:, 0] & MASK_HIGH[length],
+            "low": words[:, 1] & MASK_LOW[length],
+            "length": length,
+        }
+    )
+    return ranges[ranges["family"] != 0]
+
+
+def covering_pairs(inner: pd.DataFrame, outer: pd.DataFrame) -> pd.DataFrame:
+    """
+    Every (inner, outer) pair of prefix_ranges() rows where the outer prefix
+    equals or contains the inner one. CIDRs are either nested or disjoint, so
+    this is one hash join per distinct outer prefix length: the inner network
+    address cut to that length must be an outer prefix.
+    """
+    pairs = [pd.DataFrame({"inner": [], "outer": [], "inner_length": [], "outer_length": []}, dtype="int64")]
+    for length in outer["length"].unique():
+        candidates = inner[inner["length"] >= length]
+        if candidates.empty:
+            continue
+        keys = pd.DataFrame(
+            {
+                "family": candidates["family"],
+                "high": candidates["high"] & MASK_HIGH[length],
+                "low": candidates["low"] & MASK_LOW[length],
+                "inner": candidates.index,
+                "inner_length": candidates["length"],
+            }
+        )
+        prefixes = outer[outer["length"] == length]
+        prefixes = prefixes.assign(outer=prefixes.index, outer_length=length)
+        pairs.append(
+            keys.merge(prefixes.drop(columns="length"), on=["family", "high", "low"])[
+                ["inner", "outer", "inner_length", "outer_length"]
+            ]
+        )
+    return pd.concat(pairs, ignore_index=True)
+
+
+def match_prefixes(feed_cidrs: list[str], pop_cidrs: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match every feed CIDR to a PoP CIDR. Return the position of the matched
+    PoP CIDR (-1 for none) and the match type:
+
+    - exact: the same prefix, whatever the notation
+    - covering: the most specific PoP prefix that contains the feed prefix
+    - partial: no PoP prefix contains it, but some lie inside it. The largest
+      one wins, then the first in pop_cidrs.
+    """
+    feed = prefix_ranges(feed_cidrs)
+    # a duplicated PoP prefix keeps its first row
+    pop = prefix_ranges(pop_cidrs).drop_duplicates(["family", "high", "low", "length"])
+
+    matched = np.full(len(feed_cidrs), -1, dtype=np.int64)
+    match_type = np.full(len(feed_cidrs), None, dtype=object)
+
+    covering = covering_pairs(feed, pop).sort_values(["inner", "outer_length"], kind="stable")
+    best = covering.drop_duplicates("inner", keep="last")
+    matched[best["inner"].to_numpy()] = best["outer"].to_numpy()
+    match_type[best["inner"].to_numpy()] = np.where(
+        best["inner_length"] == best["outer_length"], MATCH_EXACT, MATCH_COVERING
+    )
+
+    uncovered = feed[matched[feed.index] < 0]
+    partial = covering_pairs(pop, uncovered).sort_values(["outer", "inner_length", "inner"], kind="stable")
+    best = partial.drop_duplicates("outer", keep="first")
+    matched[best["outer"].to_numpy()] = best["inner"].to_numpy()
+    match_type[best["outer"].to_numpy()] = MATCH_PARTIAL
+    return matched, match_type
+
+
+def overlapping_cidrs(feed_cidrs: list[str], pop_cidrs) -> set[str]:
+    """The feed CIDRs that contain, equal or lie inside any of pop_cidrs."""
+    feed = prefix_ranges(feed_cidrs)
+    pop = prefix_ranges(pop_cidrs)
+    rows = set(covering_pairs(feed, pop)["inner"]) | set(covering_pairs(pop, feed)["outer"])
+    return {feed_cidrs[i] for i in rows}
+
+
+@metrics.timed("geoip_pop.join_feed")
+def join_feed(cidrs: set[str] | None = None, feed: str | None = None, pops: str | None = None):
+    """
+    Join feed.csv with pops.csv on address ranges rather than CIDR strings,
+    see match_prefixes(). Matched rows come first, in feed order. feed and
+    pops are the CSV contents, by default those of the latest files.
+    """
     geoip_feed_header = "cidr,country,region,city"
     feed_df = pd.read_csv(
-        FEED_DATA_DIR.joinpath("feed-latest.csv"),
+        io.StringIO(feed) if feed is not None else context.data_path(FEED_LATEST_FILE),
         header=None,
         names=geoip_feed_header.split(","),
         index_col=False,
     )
+    if cidrs is not None:
+        # only join the rows of an incremental update
+        feed_df = feed_df[feed_df["cidr"].isin(cidrs)].reset_index(drop=True)
 
     pop_feed_header = "cidr,pop,code"
     pop_df = pd.read_csv(
-        POP_FEED_DATA_DIR.joinpath("pops-latest.csv"),
+        io.StringIO(pops) if pops is not None else context.data_path(POP_LATEST_FILE),
         header=None,
         names=pop_feed_header.split(","),
         index_col=False,
     )
 
-    merged_left = feed_df.merge(pop_df, on="cidr", how="left")
-
-    feed_only_mask = ~merged_left["cidr"].isin(pop_df["cidr"])
-    feed_only = merged_left[feed_only_mask]
-    common_df = merged_left[~feed_only_mask]
-
-    print(f"Feed only rows: {len(feed_only)}")
-    print(f"Common rows: {len(common_df)}")
-
-    if not feed_only.empty:
-        merged_df = pd.concat([common_df, feed_only], ignore_index=True)
-    else:
-        merged_df = merged_left
+    matched, match_type = match_prefixes(feed_df["cidr"].tolist(), pop_df["cidr"].tolist())
+    found = matched >= 0
+    for column in ["pop", "code"]:
+        values = np.full(len(feed_df), np.nan, dtype=object)
+        values[found] = pop_df[column].to_numpy(dtype=object)[matched[found]]
+        feed_df[column] = values
+    feed_df["match_type"] = match_type
+
+    counts = pd.Series(match_type[found]).value_counts()
+    print(f"Feed only rows: {int((~found).sum())}")
+    print(
+        "Common rows: "
+        + ", ".join(f"{counts.get(t, 0)} {t}" for t in [MATCH_EXACT, MATCH_COVERING, MATCH_PARTIAL])
+    )
 
+    merged_df = feed_df.sort_values("match_type", key=lambda x: x.isna(), kind="stable")
+    merged_df = merged_df.reset_index(drop=True)
     print(f"Total merged rows: {len(merged_df)}")
 
     return merged_df
@@ -129,41 +351,277 @@ def parse_subnet(subnet: str) -> None | ipaddress.IPv6Address | ipaddress.IPv4Ad
     return subnet_ip
 
 
-def dig_ptr(ip: ipaddress.IPv4Address | ipaddress.IPv6Address) -> str | None:
+def dig_ptr_record(
+    ip: ipaddress.IPv4Address | ipaddress.IPv6Address,
+) -> tuple[str, int] | None:
     print(f"Digging PTR for IP: {ip}")
+    metrics.incr("dns.queries")
     try:
         cmd = ["dig", "-x", str(ip), "+trace", "+all", "+dnssec"]
         output = subprocess.check_output(cmd, timeout=5).decode("utf-8")
+        negative_ttl = 0
         for _line in output.splitlines():
-            if (
-                "PTR" in _line
-                and ".arpa." in _line
-                and (not _line.startswith(";"))
-                and "RRSIG" not in _line
-            ):
+            if _line.startswith(";"):
+                continue
+            fields = _line.split()
+            if "PTR" in _line and ".arpa." in _line and "RRSIG" not in _line:
                 domain = _line.split("PTR")[1].strip()
-                return domain
-        return ""
+                ttl = int(fields[1]) if fields[1].isdigit() else 0
+                return domain, ttl
+            # negative answers are cached for min(SOA TTL, SOA minimum)
+            if len(fields) >= 11 and fields[3] == "SOA" and fields[1].isdigit():
+                negative_ttl = min(int(fields[1]), int(fields[10]))
+        return "", negative_ttl
     except subprocess.TimeoutExpired:
         print(f"Timeout expired for dig command on IP: {ip}")
+        metrics.incr("dns.timeouts")
         return None
     except subprocess.CalledProcessError as e:
         print(f"Error executing dig command: {e}")
-        return ""
+        return "", 0
+
+
+def dig_ptr(ip: ipaddress.IPv4Address | ipaddress.IPv6Address) -> str | None:
+    record = dig_ptr_record(ip)
+    if record is None:
+        return None
+    return record[0]
+
+
+def resolve_round_threads(
+    df: pd.DataFrame,
+    to_process: list,
+    retries: list,
+    threads: int,
+    lock: threading.Lock,
+    chunk_lock: threading.Lock,
+):
+    chunk_size = (len(to_process) + threads - 1) // threads
+    chunks = [
+        to_process[i : i + chunk_size] for i in range(0, len(to_process), chunk_size)
+    ]
+
+    total_chunks = len(chunks)
+    processed_chunks = 0
+    threads_list = []
+
+    def worker(idx_slice):
+        nonlocal processed_chunks
+        for idx in idx_slice:
+            with lock:
+                if df.at[idx, "processed"]:
+                    continue
+                df.at[idx, "attempts"] = int(df.at[idx, "attempts"]) + 1
+            subnet = df.at[idx, "cidr"]
+            # weird that some of these subnets return timeout
+            if str(subnet).startswith("150.228."):
+                continue
+            time.sleep(0.1)
+            subnet_ip = parse_subnet(subnet)
+            if subnet_ip is None:
+                with lock:
+                    df.at[idx, "processed"] = True
+                continue
+            ptr_rec = dig_ptr_record(subnet_ip)
+            if ptr_rec is None:
+                # timeout: schedule retry (but do not mark processed)
+                with lock:
+                    retries.append(idx)
+            else:
+                with lock:
+                    df.at[idx, "dns_ptr"] = ptr_rec[0]
+                    df.at[idx, "ptr_ttl"] = ptr_rec[1]
+                    df.at[idx, "processed"] = True
+        with chunk_lock:
+            processed_chunks += 1
+            print(
+                f"Processed {processed_chunks}/{total_chunks} chunks (round size {len(to_process)})"
+            )
+
+    for chunk in chunks:
+        t = threading.Thread(target=worker, args=(chunk,), daemon=True)
+        threads_list.append(t)
+        t.start()
 
+    for t in threads_list:
+        t.join()
 
-def update_dns_ptr(df: pd.DataFrame, max_attempts: int = 100):
+
+def resolve_round_async(df: pd.DataFrame, to_process: list, retries: list):
+    pending = []
+    for idx in to_process:
+        if df.at[idx, "processed"]:
+            continue
+        df.at[idx, "attempts"] = int(df.at[idx, "attempts"]) + 1
+        subnet = df.at[idx, "cidr"]
+        # weird that some of these subnets return timeout
+        if str(subnet).startswith("150.228."):
+            continue
+        subnet_ip = parse_subnet(subnet)
+        if subnet_ip is None:
+            df.at[idx, "processed"] = True
+            continue
+        pending.append((idx, subnet_ip))
+    if not pending:
+        return
+
+    print(f"Resolving {len(pending)} PTR records (concurrency {PTR_CONCURRENCY})")
+    metrics.incr("dns.queries", len(pending))
+    records = asyncio.run(
+        ptr_resolver.resolve_many(
+            [ip for _, ip in pending],
+            concurrency=PTR_CONCURRENCY,
+            timeout=PTR_TIMEOUT,
+        )
+    )
+    for (idx, _), record in zip(pending, records):
+        if record is None:
+            # timeout: schedule retry (but do not mark processed)
+            metrics.incr("dns.timeouts")
+            retries.append(idx)
+        else:
+            df.at[idx, "dns_ptr"] = record[0]
+            df.at[idx, "ptr_ttl"] = record[1]
+            df.at[idx, "processed"] = True
+
+
+def apply_ptr_cache(df: pd.DataFrame, cache: PTRCache, max_refresh: int | None):
+    """
+    Fill dns_ptr from the cache and mark those rows processed. Expired entries
+    are resolved again, at most max_refresh of them per run; the rest keep
+    their cached PTR until a later run.
+    """
+    now = time.time()
+    entries = cache.get_many(df["cidr"].astype(str).unique().tolist())
+    hits = 0
+    refresh = 0
+    deferred = 0
+    for idx, cidr in df["cidr"].astype(str).items():
+        entry = entries.get(cidr)
+        if entry is None:
+            continue
+        if not cache.is_fresh(entry, now):
+            if max_refresh is None or refresh < max_refresh:
+                refresh += 1
+                continue
+            deferred += 1
+        else:
+            hits += 1
+        df.at[idx, "dns_ptr"] = entry[0]
+        df.at[idx, "processed"] = True
+    metrics.incr("ptr_cache.hits", hits)
+    metrics.incr("ptr_cache.refreshed", refresh)
+    metrics.incr("ptr_cache.deferred", deferred)
+    print(
+        f"PTR cache: {hits} fresh, {refresh} to refresh, {deferred} deferred, "
+        f"{len(df) - hits - refresh - deferred} new"
+    )
+
+
+def postprocess_dns_ptr(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compute pop_dns_ptr_match, move rows without a PoP to the end and count
+    PTR/PoP mismatches per PoP.
+
+    A PTR matches when it looks like customer.<pop>.pop.starlinkisp.net. and
+    <pop> equals the PoP from the feed, e.g., undefined.hostname.localhost.
+    and 0-179-184-103.host.net.id. never match.
+    """
+    ptr = df["dns_ptr"].fillna("").astype(str)
+    is_customer = ptr.str.startswith("customer.") & (ptr.str.count(r"\.") >= 5)
+    parts = ptr.str.split(".", n=2, expand=True)
+    if 1 in parts.columns:
+        ptr_pop = parts[1].where(is_customer)
+    else:
+        ptr_pop = pd.Series(None, index=df.index, dtype=object)
+
+    df = df.copy()
+    df["pop_dns_ptr_match"] = (ptr_pop == df["pop"]).fillna(False).astype(bool)
+
+    frame = pd.DataFrame(
+        {
+            "pop": df["pop"],
+            "ptr_pop": ptr_pop,
+            "match": df["pop_dns_ptr_match"],
+            "has_ptr": ptr != "",
+        }
+    )
+    stats = frame.groupby("pop").agg(
+        subnets=("match", "size"),
+        with_ptr=("has_ptr", "sum"),
+        matched=("match", "sum"),
+    )
+    # PoPs named by the PTR of mismatched subnets
+    ptr_pops = (
+        frame[~frame["match"] & frame["ptr_pop"].notna()]
+        .groupby("pop")["ptr_pop"]
+        .agg(lambda x: "|".join(sorted(x.unique())))
+    )
+    stats["ptr_pops"] = ptr_pops.reindex(stats.index).fillna("")
+    stats["mismatched"] = stats["subnets"] - stats["matched"]
+    stats = stats[["subnets", "with_ptr", "matched", "mismatched", "ptr_pops"]]
+
+    mismatched = stats[stats["mismatched"] > 0]
+    print(
+        f"PTR/PoP mismatches: {int(stats['mismatched'].sum())} subnets in {len(mismatched)}/{len(stats)} PoPs"
+    )
+
+    df = df.sort_values(by="pop", key=lambda x: x.isna(), kind="stable")
+    return df.reset_index(drop=True), stats.reset_index()
+
+
+def patch_geoip_result(
+    base: pd.DataFrame, delta: pd.DataFrame, removed: set[str]
+) -> pd.DataFrame:
+    """
+    Drop removed CIDRs from the previous result, replace rows whose CIDR is in
+    delta in place and append the new ones.
+    """
+    base = base[~base["cidr"].isin(removed)].set_index("cidr")
+    columns = [c for c in base.columns if c in delta.columns]
+    delta = delta.drop_duplicates("cidr").set_index("cidr")[columns]
+
+    common = base.index.intersection(delta.index)
+    base = base.astype(object)
+    base.loc[common, columns] = delta.loc[common]
+    added = delta.loc[~delta.index.isin(base.index)]
+    print(
+        f"Patched geoip-pops-ptr: {len(common)} updated, {len(added)} added, {len(removed)} removed"
+    )
+
+    return pd.concat([base, added]).reset_index()
+
+
+def update_dns_ptr(
+    df: pd.DataFrame,
+    max_attempts: int = 100,
+    resolver: str = PTR_RESOLVER,
+    cache: PTRCache | None = None,
+    max_refresh: int | None = None,
+    base: pd.DataFrame | None = None,
+    removed: set[str] | None = None,
+):
+    """
+    Resolve the PTR of every row in df and publish the result. If base (the
+    previous result) is given, df only holds the rows of an incremental update
+    and is patched into base, with the CIDRs in removed dropped.
+    """
     if "dns_ptr" not in df.columns:
         df["dns_ptr"] = ""
     if "processed" not in df.columns:
         df["processed"] = False
     if "attempts" not in df.columns:
         df["attempts"] = 0
+    # TTL of records resolved in this run, -1 for rows not resolved
+    df["ptr_ttl"] = -1
 
     total = len(df)
-    if total == 0:
+    if total == 0 and base is None:
         return df
 
+    if cache is not None:
+        apply_ptr_cache(df, cache, max_refresh)
+
     cpu_count = os.cpu_count() or 1
     threads = max(8, cpu_count * 8)
 
@@ -172,111 +630,84 @@ def update_dns_ptr(df: pd.DataFrame, max_attempts: int = 100):
     lock = threading.Lock()
     chunk_lock = threading.Lock()
 
-    while to_process:
-        chunk_size = (len(to_process) + threads - 1) // threads
-        chunks = [
-            to_process[i : i + chunk_size]
-            for i in range(0, len(to_process), chunk_size)
-        ]
-
-        total_chunks = len(chunks)
-        processed_chunks = 0
-        threads_list = []
-        retries: list[int] = []
-
-        def worker(idx_slice):
-            nonlocal processed_chunks
-            for idx in idx_slice:
-                with lock:
-                    if df.at[idx, "processed"]:
-                        continue
-                    df.at[idx, "attempts"] = int(df.at[idx, "attempts"]) + 1
-                subnet = df.at[idx, "cidr"]
-                # weird that some of these subnets return timeout
-                if str(subnet).startswith("150.228."):
-                    continue
-                time.sleep(0.1)
-                subnet_ip = parse_subnet(subnet)
-                if subnet_ip is None:
-                    with lock:
-                        df.at[idx, "processed"] = True
-                    continue
-                ptr_rec = dig_ptr(subnet_ip)
-                if ptr_rec is None:
-                    # timeout: schedule retry (but do not mark processed)
-                    with lock:
-                        retries.append(idx)
-                else:
-                    with lock:
-                        df.at[idx, "dns_ptr"] = ptr_rec
+    with metrics.stage("geoip_pop.dns"):
+        while to_process:
+            retries: list[int] = []
+
+            if resolver == "async":
+                resolve_round_async(df, to_process, retries)
+            else:
+                resolve_round_threads(df, to_process, retries, threads, lock, chunk_lock)
+
+            next_round = []
+            with lock:
+                for idx in set(retries):
+                    if int(df.at[idx, "attempts"]) < max_attempts:
+                        next_round.append(idx)
+                    else:
+                        # give up after max_attempts
                         df.at[idx, "processed"] = True
-            with chunk_lock:
-                processed_chunks += 1
-                print(
-                    f"Processed {processed_chunks}/{total_chunks} chunks (round size {len(to_process)})"
+            to_process = sorted(next_round)
+
+            if to_process:
+                metrics.incr("dns.retry_rounds")
+                print(f"Retrying {len(to_process)} rows (attempts < {max_attempts})")
+
+    if cache is not None:
+        # without an entry these rows would be stale on every run, and an
+        # unchanged feed could never skip the update
+        failed = (df["attempts"] > 0) & (df["ptr_ttl"] < 0)
+        negative = failed | ((df["ptr_ttl"] == 0) & (df["dns_ptr"].fillna("") == ""))
+        # a refresh that failed keeps the PTR it had
+        previous = cache.get_many(df.loc[failed, "cidr"].astype(str).tolist())
+        for idx, cidr in df.loc[failed, "cidr"].astype(str).items():
+            if cidr in previous:
+                df.at[idx, "dns_ptr"] = previous[cidr][0]
+        df.loc[negative, "ptr_ttl"] = PTR_CACHE_NEGATIVE_TTL
+        resolved = df[df["ptr_ttl"] >= 0]
+        resolved_at = int(time.time())
+        cache.put_many(
+            [
+                (str(cidr), str(ptr), resolved_at, int(ttl))
+                for cidr, ptr, ttl in zip(
+                    resolved["cidr"], resolved["dns_ptr"], resolved["ptr_ttl"]
                 )
-
-        for chunk in chunks:
-            t = threading.Thread(target=worker, args=(chunk,), daemon=True)
-            threads_list.append(t)
-            t.start()
-
-        for t in threads_list:
-            t.join()
-
-        next_round = []
-        with lock:
-            for idx in set(retries):
-                if int(df.at[idx, "attempts"]) < max_attempts:
-                    next_round.append(idx)
-                else:
-                    # give up after max_attempts
-                    df.at[idx, "processed"] = True
-        to_process = sorted(next_round)
-
-        if to_process:
-            print(f"Retrying {len(to_process)} rows (attempts < {max_attempts})")
-
-    def check_ptr_pop_match(row) -> bool:
-        ptr = row["dns_ptr"]
-        pop = row["pop"]
-        # e.g., undefined.hostname.localhost., 0-179-184-103.host.net.id.
-        if not ptr.startswith("customer."):
-            return False
-        try:
-            parts = ptr.split(".")
-            if len(parts) < 6:
-                return False
-            ptr_pop = parts[1]
-            return ptr_pop == pop
-        except Exception:
-            return False
-
-    df["pop_dns_ptr_match"] = df.apply(check_ptr_pop_match, axis=1)
-    df = df.drop(columns=["processed", "attempts"])
-
-    df_with_pop = df[df["pop"].notna()]
-    df_without_pop = df[df["pop"].isna()]
-    df = pd.concat([df_with_pop, df_without_pop], ignore_index=True)
-
-    df.to_csv(f"/tmp/geoip-pops-ptr-{dt_string}.csv", index=False)
-    df_cmp = pd.read_csv(f"/tmp/geoip-pops-ptr-{dt_string}.csv")
-
-    old_df = pd.read_csv(GEOIP_LATEST_FILE)
-    if old_df.equals(df_cmp):
-        print("No changes in geoip-pops-ptr data; skipping update.")
-        return
-
-    df.to_csv(
-        GEOIP_DATA_DIR.joinpath("geoip-pops-ptr-latest.csv"),
-        index=False,
-    )
-    df.to_csv(
-        GEOIP_DATA_DIR.joinpath(f"{year}{month}").joinpath(
-            f"geoip-pops-ptr-{dt_string}.csv"
-        ),
-        index=False,
-    )
+            ]
+        )
+
+    df = df.drop(columns=["processed", "attempts", "ptr_ttl"])
+
+    if base is not None:
+        df = patch_geoip_result(base, df, removed or set())
+
+    with metrics.stage("geoip_pop.postprocess"):
+        df, mismatch_stats = postprocess_dns_ptr(df)
+    if "match_type" in df.columns:
+        # the last column, so positional readers of the published CSV keep working
+        df = df[[c for c in df.columns if c != "match_type"] + ["match_type"]]
+    metrics.incr("geoip_pop.rows", len(df))
+
+    with metrics.stage("geoip_pop.write_csv"):
+        ctx = context.current()
+        snapshot_file = None
+        if KEEP_CSV_SNAPSHOTS:
+            snapshot_file = ctx.path(
+                GEOIP_DATA_DIR, f"{ctx.year}{ctx.month}", f"geoip-pops-ptr-{ctx.dt_string}.csv"
+            )
+        if not write_if_changed(
+            ctx.path(GEOIP_LATEST_FILE),
+            lambda f: df.to_csv(f, index=False),
+            archive=snapshot_file,
+        ):
+            print("No changes in geoip-pops-ptr data; skipping update.")
+            return
+
+        write_if_changed(
+            ctx.path(GEOIP_DATA_DIR, "pop-ptr-mismatch-latest.csv"),
+            lambda f: mismatch_stats.to_csv(f, index=False),
+        )
+        if archive.append_snapshot("geoip", ctx.dt_string, read_file(ctx.path(GEOIP_LATEST_FILE))):
+            history.refresh_history()
 
 
 def convert_geoip_to_json(df: pd.DataFrame) -> Dict[str, Any]:
@@ -316,74 +747,129 @@ def convert_geoip_to_json(df: pd.DataFrame) -> Dict[str, Any]:
     for ec in expected_cols:
         if ec in cols_lower:
             col_map[ec] = df.columns[cols_lower.index(ec)]
-    # fallback: assume columns are already correct
-    get = lambda r, k: (
-        r[col_map[k]]
-        if k in col_map
-        else r.get(k, "") if isinstance(r, dict) else r.get(k, "")
+
+    def column(name: str, strip: bool = True) -> pd.Series:
+        if name not in col_map:
+            return pd.Series("", index=df.index, dtype=object)
+        values = df[col_map[name]]
+        if not strip:
+            return values
+        return values.fillna("").astype(str).str.strip()
+
+    cidr = column("cidr", strip=False)
+    dns_ptr = column("dns_ptr")
+    country = column("country")
+    region = column("region")
+    city = column("city")
+
+    # build pop_subnet_count as list of [dns_ptr, count] over all non-empty
+    # dns_ptr values (regardless of match), sorted by ptr
+    ptr_counts = dns_ptr[dns_ptr != ""].value_counts().sort_index()
+    pop_subnet_count = [
+        [ptr, cnt] for ptr, cnt in zip(ptr_counts.index.tolist(), ptr_counts.tolist())
+    ]
+
+    # one [cidr, dns_ptr] pair per row, grouped by city in row order. Sorting
+    # by country is stable, so regions and cities keep their first-seen order.
+    located = country != ""
+    ips = pd.Series(
+        list(zip(cidr[located].tolist(), dns_ptr[located].tolist())),
+        index=df.index[located],
+        dtype=object,
+    )
+    tree = pd.DataFrame(
+        {
+            "country": country[located],
+            "region": region[located],
+            "city": city[located],
+            "ips": ips,
+        }
+    ).sort_values("country", kind="stable")
+    city_ips = tree.groupby(["country", "region", "city"], sort=False)["ips"].agg(
+        lambda pairs: [list(pair) for pair in pairs]
     )
 
     # prepare top-level keys in desired order
-    # result: Dict[str, Any] = {"valid": {}, "dns_ptr_pop_not_match": {}}
-    result = {
+    result: Dict[str, Any] = {
         "countries": {},
-        "pop_subnet_count": [],
+        "pop_subnet_count": pop_subnet_count,
     }
-
-    # counter for all non-empty dns_ptr values (regardless of match)
-    ptr_counter: Counter = Counter()
-
-    for _, row in df.iterrows():
-        cidr = get(row, "cidr")
-        dns_ptr = (get(row, "dns_ptr") or "").strip()
-        if dns_ptr:
-            ptr_counter[dns_ptr] += 1
-
-        country = (get(row, "country") or "").strip()
-        region = (get(row, "region") or "").strip()
-        city = (get(row, "city") or "").strip()
-
-        if not country:
-            continue
-
-        target_bucket = "countries"
-        country_dict = result[target_bucket].setdefault(country, {})
-        region_dict = country_dict.setdefault(region, {})
-        city_dict = region_dict.setdefault(city, {})
-        ips = city_dict.setdefault("ips", [])
-        ips.append([cidr, dns_ptr])
-
-    # build pop_subnet_count as list of [dns_ptr, count] sorted desc
-    pop_subnet_count = [[ptr, cnt] for ptr, cnt in ptr_counter.most_common()]
-    # sort pop_subnet_count by ptr
-    pop_subnet_count.sort(key=lambda x: x[0])
-    result["pop_subnet_count"] = pop_subnet_count
-
-    # sort valid = dict(sorted(valid.items()))
-    result["countries"] = dict(sorted(result["countries"].items()))
+    for (country_key, region_key, city_key), city_list in city_ips.items():
+        country_dict = result["countries"].setdefault(country_key, {})
+        region_dict = country_dict.setdefault(region_key, {})
+        region_dict[city_key] = {"ips": city_list}
 
     return result
 
 
+@metrics.timed("geoip_pop.convert_to_geoip_json")
 def convert_to_geoip_json():
     print("Converting geoip-pops-ptr CSV to JSON format")
-    CSV_PATH = GEOIP_DATA_DIR.joinpath("geoip-pops-ptr-latest.csv")
-    JSON_PATH = GEOIP_DATA_DIR.joinpath("geoip-latest.json")
+    CSV_PATH = context.data_path(GEOIP_LATEST_FILE)
+    JSON_PATH = context.data_path(GEOIP_DATA_DIR, "geoip-latest.json")
 
     if CSV_PATH.exists():
         df = pd.read_csv(CSV_PATH, dtype=str, keep_default_na=False)
         geojson = convert_geoip_to_json(df)
-        with open(JSON_PATH, "w") as f:
-            json.dump(geojson, f, indent=2)
-        print(f"Wrote {JSON_PATH}")
+        if write_if_changed(JSON_PATH, lambda f: json.dump(geojson, f, indent=2)):
+            print(f"Wrote {JSON_PATH}")
 
 
 def refresh_geoip_pop():
 
-    get_feed()
+    feed, pop = get_feed()
+    feed_delta, pop_delta = feed.delta, pop.delta
 
-    df = join_feed()
+    cache = PTRCache(context.state_path(PTR_CACHE_FILE), min_ttl=PTR_CACHE_MIN_TTL)
+    max_refresh = int(PTR_CACHE_MAX_REFRESH) if PTR_CACHE_MAX_REFRESH else None
+    try:
+        base = None
+        geoip_latest = context.data_path(GEOIP_LATEST_FILE)
+        if feed_delta is not None and pop_delta is not None and geoip_latest.exists():
+            base = pd.read_csv(geoip_latest)
+            # results from before the range join are rebuilt once
+            if "match_type" not in base.columns:
+                base = None
+
+        if base is None:
+            df = join_feed(feed=feed.content, pops=pop.content)
+            update_dns_ptr(df, cache=cache, max_refresh=max_refresh)
+        else:
+            # a PoP row matters for every feed row it overlaps
+            pop_changed = pop_delta.added | pop_delta.removed | pop_delta.changed
+            affected = (
+                feed_delta.added
+                | feed_delta.changed
+                | overlapping_cidrs(base["cidr"].astype(str).tolist(), pop_changed)
+            ) - feed_delta.removed
+            unaffected = [c for c in base["cidr"].astype(str) if c not in affected]
+            stale = set(cache.stale(unaffected))
+            if max_refresh is not None:
+                stale = set(sorted(stale)[:max_refresh])
+            print(
+                f"Incremental update: {len(affected)} affected, "
+                f"{len(feed_delta.removed)} removed, {len(stale)} stale PTR records"
+            )
+
+            if affected or stale or feed_delta.removed:
+                df = join_feed(affected | stale, feed=feed.content, pops=pop.content)
+                update_dns_ptr(
+                    df,
+                    cache=cache,
+                    max_refresh=max_refresh,
+                    base=base,
+                    removed=feed_delta.removed,
+                )
+            else:
+                print("Feeds and PTR records unchanged; skipping update.")
+    finally:
+        cache.close()
 
-    update_dns_ptr(df)
+    # only now that the result is written, the next run diffs against this download
+    feed.publish()
+    pop.publish()
 
+    # cheap when nothing changed, and they catch up after a run that failed
+    # between writing the CSV and exporting it
     convert_to_geoip_json()
+    geoipdb.export()
@@ -0,0 +1,326 @@
+"""
+Local HTTP lookup service over the latest pops and geoip CSV files.
+
+    python geoip_service.py --port 8080
+
+    GET  /lookup?ip=149.19.108.1        one address
+    POST /lookup  ["149.19.108.1", ...]  a JSON list, or {"ips": [...]}
+    GET  /prefixes?pop=sttlwax1          prefixes announced for a PoP
+    GET  /pops                           PoPs and their prefix counts
+    GET  /metrics                        request counts, latency, throughput
+    GET  /health
+
+PoPs come from util.GEOIP over pop/pops-latest.csv. Country, region, city,
+code and PTR come from geoip/geoip-pops-ptr-latest.csv when it exists. The
+files are polled and, when one changes, a new index is built in a thread.
+The new index replaces the old one in a single assignment, so a request
+always sees one consistent version and is never blocked by a reload.
+Batch lookups run in a thread as well, so a large POST does not hold up
+the other connections. Nothing is fetched over the network.
+"""
+
+import os
+import csv
+import json
+import time
+import asyncio
+import argparse
+
+from collections import deque
+from dataclasses import dataclass, field
+from ipaddress import ip_address
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import context
+import metrics
+from util import GEOIP, PrefixIndex
+
+
+# relative to the data directory of the run
+POP_LATEST_FILE = "pop/pops-latest.csv"
+GEOIP_LATEST_FILE = "geoip/geoip-pops-ptr-latest.csv"
+
+DETAIL_FIELDS = ["code", "country", "region", "city", "dns_ptr"]
+
+MAX_BATCH = int(os.getenv("SERVICE_MAX_BATCH", "100000"))
+MAX_BODY = 64 * 1024 * 1024
+# requests kept for latency percentiles and recent throughput
+LATENCY_WINDOW = 10000
+THROUGHPUT_WINDOW = 60.0
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+def file_versions(paths: list[Path]) -> dict[str, tuple[int, int] | None]:
+    versions = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+            versions[str(path)] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            versions[str(path)] = None
+    return versions
+
+
+@dataclass
+class Snapshot:
+    geoip: GEOIP
+    details: PrefixIndex | None
+    prefixes: dict[str, list[str]]
+    versions: dict[str, tuple[int, int] | None]
+    loaded_at: float = field(default_factory=time.time)
+
+    def lookup(self, ip: str) -> dict:
+        return self.lookup_many([ip])[0]
+
+    def lookup_many(self, ips: list) -> list[dict]:
+        ips = [str(ip).strip() for ip in ips]
+        pops = self.geoip.lookup_many(ips)
+        rows = self.details.lookup_many(ips) if self.details is not None else [None] * len(ips)
+        results = []
+        for ip, pop, row in zip(ips, pops, rows):
+            if not pop and row is None:
+                try:
+                    ip_address(ip)
+                except ValueError:
+                    results.append({"ip": ip, "error": "invalid IP address"})
+                    continue
+            result = {"ip": ip, "pop": pop or None}
+            for name in DETAIL_FIELDS:
+                result[name] = (row.get(name) or None) if row else None
+            results.append(result)
+        return results
+
+
+def load_snapshot(pop_file: Path | None = None, geoip_file: Path | None = None) -> Snapshot:
+    pop_file = pop_file or context.data_path(POP_LATEST_FILE)
+    geoip_file = geoip_file or context.data_path(GEOIP_LATEST_FILE)
+    # taken before reading, a file replaced while loading is picked up next poll
+    versions = file_versions([pop_file, geoip_file])
+    geoip = GEOIP(pop_file)
+    prefixes = {
+        str(pop): group["cidr"].astype(str).tolist()
+        for pop, group in geoip.pop_df.dropna(subset=["pop"]).groupby("pop")
+    }
+    details = None
+    if geoip_file.exists():
+        with open(geoip_file, "r", newline="") as f:
+            rows = list(csv.DictReader(f))
+        details = PrefixIndex([row["cidr"] for row in rows], rows)
+    return Snapshot(geoip, details, prefixes, versions)
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class GeoIPService:
+    def __init__(
+        self,
+        pop_file: Path | None = None,
+        geoip_file: Path | None = None,
+        reload_interval: float = 5.0,
+    ):
+        self.pop_file = Path(pop_file or context.data_path(POP_LATEST_FILE))
+        self.geoip_file = Path(geoip_file or context.data_path(GEOIP_LATEST_FILE))
+        self.reload_interval = reload_interval
+        self.watcher: asyncio.Task | None = None
+        self.snapshot = load_snapshot(self.pop_file, self.geoip_file)
+        self.stats = metrics.Metrics()
+        # (finished, seconds, lookups) of the latest requests
+        self.recent: deque[tuple[float, float, int]] = deque(maxlen=LATENCY_WINDOW)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            versions = file_versions([self.pop_file, self.geoip_file])
+            if versions == self.snapshot.versions:
+                continue
+            if versions[str(self.pop_file)] is None:
+                # mid-replace or removed, keep serving what we have
+                continue
+            try:
+                snapshot = await asyncio.to_thread(load_snapshot, self.pop_file, self.geoip_file)
+            except Exception as e:
+                self.stats.incr("reload.failures")
+                print(f"Reload failed, keeping the current data: {e}")
+                continue
+            self.snapshot = snapshot
+            self.stats.incr("reloads")
+            print(f"Reloaded {len(snapshot.prefixes)} PoPs")
+
+    async def dispatch(self, method: str, target: str, body: bytes) -> tuple[str, object, int]:
+        """Return the endpoint name, the response object and the number of lookups."""
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        # one reference for the whole request, reloads swap self.snapshot
+        snapshot = self.snapshot
+
+        if url.path == "/lookup":
+            if method == "GET":
+                if "ip" not in query:
+                    raise HTTPError(400, "missing ip parameter")
+                return "lookup", snapshot.lookup(query["ip"][0]), 1
+            if method == "POST":
+                try:
+                    ips = json.loads(body)
+                except ValueError:
+                    raise HTTPError(400, "body is not JSON")
+                if isinstance(ips, dict):
+                    ips = ips.get("ips")
+                if not isinstance(ips, list):
+                    raise HTTPError(400, 'expected a JSON list or {"ips": [...]}')
+                if len(ips) > MAX_BATCH:
+                    raise HTTPError(413, f"at most {MAX_BATCH} addresses per request")
+                results = await asyncio.to_thread(snapshot.lookup_many, ips)
+                return "batch", results, len(ips)
+            raise HTTPError(405, "use GET or POST")
+
+        if method != "GET":
+            raise HTTPError(405, "use GET")
+        if url.path == "/prefixes":
+            pop = query.get("pop", [""])[0]
+            if pop not in snapshot.prefixes:
+                raise HTTPError(404, f"unknown PoP {pop!r}")
+            return "prefixes", {"pop": pop, "prefixes": snapshot.prefixes[pop]}, 0
+        if url.path == "/pops":
+            return "pops", {pop: len(p) for pop, p in sorted(snapshot.prefixes.items())}, 0
+        if url.path == "/metrics":
+            return "metrics", self.report(), 0
+        if url.path == "/health":
+            return "health", {"status": "ok", "loaded_at": snapshot.loaded_at}, 0
+        raise HTTPError(404, f"no such endpoint {url.path}")
+
+    def report(self) -> dict:
+        now = time.time()
+        recent = list(self.recent)
+        latencies = sorted(seconds for _, seconds, _ in recent)
+        window = [(s, n) for finished, s, n in recent if finished >= now - THROUGHPUT_WINDOW]
+
+        def percentile(p: float) -> float | None:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 3)
+
+        stats = self.stats.to_dict()
+        return {
+            "uptime_seconds": stats["wall_seconds"],
+            "loaded_at": self.snapshot.loaded_at,
+            "counters": stats["counters"],
+            "latency_ms": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)},
+            "throughput": {
+                "window_seconds": THROUGHPUT_WINDOW,
+                "requests_per_second": round(len(window) / THROUGHPUT_WINDOW, 3),
+                "lookups_per_second": round(sum(n for _, n in window) / THROUGHPUT_WINDOW, 3),
+            },
+        }
+
+    async def respond(self, method: str, target: str, body: bytes) -> tuple[int, object]:
+        start = time.perf_counter()
+        endpoint, lookups, status = "unknown", 0, 200
+        try:
+            endpoint, payload, lookups = await self.dispatch(method, target, body)
+        except HTTPError as e:
+            status, payload = e.status, {"error": str(e)}
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+            print(f"{method} {target} failed: {e}")
+        seconds = time.perf_counter() - start
+        self.recent.append((time.time(), seconds, lookups))
+        self.stats.incr(f"requests.{endpoint}")
+        self.stats.incr("lookups", lookups)
+        if status != 200:
+            self.stats.incr(f"errors.{status}")
+        return status, payload
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode("latin-1").split()
+                length = headers.get("content-length", "0")
+                if len(parts) != 3 or not length.isdigit():
+                    await self.send(writer, 400, {"error": "malformed request"}, False)
+                    break
+                method, target, version = parts
+                if int(length) > MAX_BODY:
+                    await self.send(writer, 413, {"error": "body too large"}, False)
+                    break
+                body = await reader.readexactly(int(length))
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                status, payload = await self.respond(method, target, body)
+                await self.send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool):
+        data = json.dumps(payload).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def start(self, host: str, port: int) -> asyncio.Server:
+        """Start listening and watching the files, port 0 picks a free port."""
+        server = await asyncio.start_server(self.handle, host, port)
+        self.watcher = asyncio.create_task(self.watch())
+        return server
+
+    async def serve(self, host: str, port: int):
+        server = await self.start(host, port)
+        port = server.sockets[0].getsockname()[1]
+        print(f"Serving GeoIP lookups on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.watcher.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Starlink GeoIP lookup service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pops", type=Path, default=context.data_path(POP_LATEST_FILE))
+    parser.add_argument("--geoip", type=Path, default=context.data_path(GEOIP_LATEST_FILE))
+    parser.add_argument("--reload-interval", type=float, default=5.0, help="seconds between file checks")
+    args = parser.parse_args()
+
+    service = GeoIPService(args.pops, args.geoip, args.reload_interval)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Compact binary export of geoip-pops-ptr-latest.csv and a memory-mapped reader.
+
+The file is a sorted table of disjoint address ranges per address family,
+nested prefixes already resolved to the most specific one (see PrefixIndex).
+Each range points at a record of interned strings:
+
+    header    magic, version, IPv4 ranges, IPv6 ranges, records, strings
+    IPv4      starts u32[], ends u32[], records u32[]
+    IPv6      start high/low u64[], end high/low u64[], records u32[]
+    records   u32[6] string ids per record, in FIELDS order
+    strings   u32[] offsets into a UTF-8 blob, string 0 is ""
+
+All integers are little-endian and every section starts on an 8 byte
+boundary, so the reader uses memoryview.cast() on the mapping. Opening a file
+is an mmap and a header read. A lookup is a binary search. Processes that
+open the same file share its pages.
+
+    python geoipdb.py export
+    python geoipdb.py lookup 149.19.108.1 2605:59c8:1000::1
+"""
+
+import sys
+import csv
+import json
+import mmap
+import array
+import struct
+import argparse
+
+from bisect import bisect_right
+from ipaddress import ip_address
+from pathlib import Path
+
+import context
+import metrics
+from util import PrefixIndex, write_if_changed
+
+
+# relative to the data directory of the run
+GEOIP_CSV_FILE = "geoip/geoip-pops-ptr-latest.csv"
+GEOIPDB_FILE = "geoip/geoip-latest.bin"
+
+MAGIC = b"SLGEOIP\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIII")
+FIELDS = ["country", "region", "city", "pop", "code", "dns_ptr"]
+
+
+class GeoIPDBError(Exception):
+    pass
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _layout(ipv4: int, ipv6: int, records: int, strings: int) -> dict[str, tuple[int, int]]:
+    """Byte offset and size of every section, shared by writer and reader."""
+    sizes = [
+        ("v4_starts", ipv4 * 4),
+        ("v4_ends", ipv4 * 4),
+        ("v4_records", ipv4 * 4),
+        ("v6_start_high", ipv6 * 8),
+        ("v6_start_low", ipv6 * 8),
+        ("v6_end_high", ipv6 * 8),
+        ("v6_end_low", ipv6 * 8),
+        ("v6_records", ipv6 * 4),
+        ("records", records * len(FIELDS) * 4),
+        ("string_offsets", (strings + 1) * 4),
+    ]
+    layout = {}
+    offset = _align(HEADER.size)
+    for name, size in sizes:
+        layout[name] = (offset, size)
+        offset = _align(offset + size)
+    layout["strings"] = (offset, None)
+    return layout
+
+
+def _pack(typecode: str, values) -> bytes:
+    packed = array.array(typecode, values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def build(rows) -> bytes:
+    """Build the file from rows with a cidr column and the FIELDS columns."""
+    strings: dict[str, int] = {"": 0}
+    records: dict[tuple, tuple] = {}
+    cidrs = []
+    values = []
+    for row in rows:
+        key = tuple(
+            strings.setdefault(row.get(field) or "", len(strings)) for field in FIELDS
+        )
+        # one object per distinct record, so PrefixIndex merges adjacent ranges
+        values.append(records.setdefault(key, key))
+        cidrs.append(row["cidr"])
+    index = PrefixIndex(cidrs, values)
+
+    record_ids = {key: i for i, key in enumerate(records)}
+    v4_starts, v4_ends, v4_values = index.ranges(4)
+    v6_starts, v6_ends, v6_values = index.ranges(6)
+    low = (1 << 64) - 1
+
+    blob = bytearray()
+    offsets = [0]
+    for string in strings:
+        blob += string.encode("utf-8")
+        offsets.append(len(blob))
+
+    sections = {
+        "v4_starts": _pack("I", v4_starts),
+        "v4_ends": _pack("I", v4_ends),
+        "v4_records": _pack("I", (record_ids[v] for v in v4_values)),
+        "v6_start_high": _pack("Q", (s >> 64 for s in v6_starts)),
+        "v6_start_low": _pack("Q", (s & low for s in v6_starts)),
+        "v6_end_high": _pack("Q", (e >> 64 for e in v6_ends)),
+        "v6_end_low": _pack("Q", (e & low for e in v6_ends)),
+        "v6_records": _pack("I", (record_ids[v] for v in v6_values)),
+        "records": _pack("I", (i for key in records for i in key)),
+        "string_offsets": _pack("I", offsets),
+        "strings": bytes(blob),
+    }
+    layout = _layout(len(v4_starts), len(v6_starts), len(records), len(strings))
+
+    out = bytearray(
+        HEADER.pack(MAGIC, VERSION, len(v4_starts), len(v6_starts), len(records), len(strings))
+    )
+    for name, (offset, _) in layout.items():
+        out += bytes(offset - len(out))
+        out += sections[name]
+    return bytes(out)
+
+
+@metrics.timed("geoipdb.export")
+def export(csv_path: Path | None = None, path: Path | None = None) -> bool:
+    csv_path = csv_path or context.data_path(GEOIP_CSV_FILE)
+    path = path or context.data_path(GEOIPDB_FILE)
+    if not csv_path.exists():
+        print(f"{csv_path} not found, skipping export")
+        return False
+    with open(csv_path, "r", newline="") as f:
+        data = build(csv.DictReader(f))
+    if write_if_changed(path, lambda f: f.write(data)):
+        print(f"Wrote {path} ({len(data)} bytes)")
+        return True
+    return False
+
+
+class _U128View:
+    """Sequence of 128-bit integers over high and low u64 views, for bisect."""
+
+    def __init__(self, high: memoryview, low: memoryview):
+        self.high = high
+        self.low = low
+
+    def __len__(self) -> int:
+        return len(self.high)
+
+    def __getitem__(self, i: int) -> int:
+        return (self.high[i] << 64) | self.low[i]
+
+
+class GeoIPDB:
+    """
+    Read-only lookups on an exported file.
+
+        with GeoIPDB() as db:
+            db.lookup("149.19.108.1")
+    """
+
+    def __init__(self, path: Path | None = None):
+        if sys.byteorder != "little":
+            raise GeoIPDBError("GeoIPDB needs a little-endian host")
+        self.path = Path(path or context.data_path(GEOIPDB_FILE))
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views: list[memoryview] = []
+        try:
+            self._open()
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self):
+        if len(self._mmap) < HEADER.size:
+            raise GeoIPDBError(f"{self.path} is truncated")
+        magic, version, ipv4, ipv6, records, strings = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise GeoIPDBError(f"{self.path} is not a GeoIPDB file")
+        if version != VERSION:
+            raise GeoIPDBError(f"{self.path} has unsupported version {version}")
+        self.counts = {"ipv4": ipv4, "ipv6": ipv6, "records": records, "strings": strings}
+
+        layout = _layout(ipv4, ipv6, records, strings)
+        buf = memoryview(self._mmap)
+        self._views.append(buf)
+        if len(buf) < layout["strings"][0]:
+            raise GeoIPDBError(f"{self.path} is truncated")
+
+        def view(name: str, typecode: str) -> memoryview:
+            offset, size = layout[name]
+            raw = buf[offset : offset + size]
+            self._views.append(raw)
+            cast = raw.cast(typecode)
+            self._views.append(cast)
+            return cast
+
+        self._v4_starts = view("v4_starts", "I")
+        self._v4_ends = view("v4_ends", "I")
+        self._v4_records = view("v4_records", "I")
+        self._v6_starts = _U128View(view("v6_start_high", "Q"), view("v6_start_low", "Q"))
+        self._v6_ends = _U128View(view("v6_end_high", "Q"), view("v6_end_low", "Q"))
+        self._v6_records = view("v6_records", "I")
+        self._records = view("records", "I")
+        self._string_offsets = view("string_offsets", "I")
+        self._strings = buf[layout["strings"][0] :]
+        self._views.append(self._strings)
+
+    def close(self):
+        # views have to be released before the mapping can be closed
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def __enter__(self) -> "GeoIPDB":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.counts["ipv4"] + self.counts["ipv6"]
+
+    def string(self, i: int) -> str:
+        return str(self._strings[self._string_offsets[i] : self._string_offsets[i + 1]], "utf-8")
+
+    def record(self, i: int) -> dict[str, str]:
+        base = i * len(FIELDS)
+        return {
+            field: self.string(self._records[base + j]) for j, field in enumerate(FIELDS)
+        }
+
+    def lookup_record(self, version: int, ip: int) -> int | None:
+        """Record id of an integer address, None if no prefix covers it."""
+        if version == 4:
+            starts, ends, records = self._v4_starts, self._v4_ends, self._v4_records
+        else:
+            starts, ends, records = self._v6_starts, self._v6_ends, self._v6_records
+        i = bisect_right(starts, ip) - 1
+        if i >= 0 and ip <= ends[i]:
+            return records[i]
+        return None
+
+    def lookup(self, ip_str: str) -> dict[str, str] | None:
+        try:
+            ip = ip_address(str(ip_str).strip())
+        except ValueError:
+            return None
+        record = self.lookup_record(ip.version, int(ip))
+        return None if record is None else self.record(record)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Starlink GeoIP binary database")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_parser = sub.add_parser("export", help="export the latest geoip CSV")
+    export_parser.add_argument("--csv", type=Path, default=context.data_path(GEOIP_CSV_FILE))
+    export_parser.add_argument("--output", type=Path, default=context.data_path(GEOIPDB_FILE))
+    lookup_parser = sub.add_parser("lookup", help="look up IP addresses")
+    lookup_parser.add_argument("ips", nargs="+")
+    lookup_parser.add_argument("--db", type=Path, default=context.data_path(GEOIPDB_FILE))
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.csv, args.output)
+    elif args.command == "lookup":
+        with GeoIPDB(args.db) as db:
+            json.dump({ip: db.lookup(ip) for ip in args.ips}, sys.stdout, indent=4)
+        print()
+
+
+if __name__ == "__main__":
+    main()
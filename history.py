@@ -0,0 +1,291 @@
+"""
+Time-travel index over the archived geoip snapshots.
+
+For every CIDR and attribute the index keeps the intervals [start, end) in
+which the attribute had a value, sorted by start, plus the change events in
+time order, overall and per CIDR. Point-in-time lookups and "changes between
+T1 and T2" are binary searches. Times are snapshot names like 20250101-0000.
+
+The index is persisted as an append-only log, archive/geoip-history.jsonl,
+with one line per archived snapshot holding its changes. A run appends the
+lines of the new snapshots without loading the log, and only parses the
+archived rows that differ between consecutive snapshots.
+
+    python history.py build
+    python history.py at 149.19.108.0/24 --time 20250101-0000
+    python history.py show 149.19.108.0/24
+    python history.py changes 20250101-0000 20250201-0000 --attribute pop
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import archive
+import context
+
+
+# relative to the data directory of the run
+HISTORY_FILE = "archive/geoip-history.jsonl"
+# the whole index rewritten by every run, replaced by HISTORY_FILE
+LEGACY_HISTORY_FILE = "archive/geoip-history.json"
+
+ATTRIBUTES = ["pop", "code", "dns_ptr", "city"]
+
+
+@dataclass
+class Change:
+    time: str
+    cidr: str
+    attribute: str
+    old: str | None
+    new: str | None
+
+
+class HistoryIndex:
+    def __init__(self):
+        # cidr -> attribute -> [[start, end or None, value], ...]
+        self.intervals: dict[str, dict[str, list[list]]] = {}
+        self.events: list[Change] = []
+        # cidr -> its events, in time order
+        self.cidr_events: dict[str, list[Change]] = {}
+        self.last_snapshot: str | None = None
+        # number of archived snapshots applied so far
+        self.applied = 0
+
+    def apply_changes(self, time: str, changes: list[Change]):
+        """Record the changes of the next snapshot, see diff_snapshots()."""
+        if self.last_snapshot is not None and time < self.last_snapshot:
+            raise ValueError(f"Snapshot {time} is older than {self.last_snapshot}")
+        for change in changes:
+            spans = self.intervals.setdefault(change.cidr, {}).setdefault(change.attribute, [])
+            if spans and spans[-1][1] is None:
+                spans[-1][1] = time
+            if change.new is not None:
+                spans.append([time, None, change.new])
+            self.events.append(change)
+            self.cidr_events.setdefault(change.cidr, []).append(change)
+        self.last_snapshot = time
+        self.applied += 1
+
+    def at(self, cidr: str, time: str | None = None) -> dict[str, str | None]:
+        """Return the attributes of cidr at time, None for unknown attributes."""
+        result: dict[str, str | None] = {}
+        for attribute in ATTRIBUTES:
+            spans = self.intervals.get(cidr, {}).get(attribute, [])
+            value = None
+            if spans:
+                if time is None:
+                    span = spans[-1]
+                else:
+                    i = bisect_right(spans, time, key=lambda s: s[0]) - 1
+                    span = spans[i] if i >= 0 else None
+                if span and (span[1] is None or (time is not None and time < span[1])):
+                    value = span[2]
+            result[attribute] = value
+        return result
+
+    def history(self, cidr: str) -> dict[str, list[list]]:
+        return self.intervals.get(cidr, {})
+
+    def changes(
+        self,
+        start: str,
+        end: str,
+        cidr: str | None = None,
+        attribute: str | None = None,
+    ) -> list[Change]:
+        """Return the changes made in snapshots taken between start and end (inclusive)."""
+        events = self.events if cidr is None else self.cidr_events.get(cidr, [])
+        lo = bisect_left(events, start, key=lambda e: e.time)
+        hi = bisect_right(events, end, key=lambda e: e.time)
+        return [e for e in events[lo:hi] if attribute is None or e.attribute == attribute]
+
+    @classmethod
+    def load(cls, path: Path | None = None) -> "HistoryIndex":
+        path = path or context.data_path(HISTORY_FILE)
+        index = cls()
+        if not path.exists():
+            return index
+        with open(path, "r") as f:
+            for line in f:
+                # a torn last line is dropped by the next append_history()
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                time = entry["snapshot"]
+                index.apply_changes(time, [Change(time, *change) for change in entry["changes"]])
+                index.applied = entry["applied"]
+        return index
+
+
+def first_rows(records: dict[int, dict], ids: set[int]) -> dict[str, dict]:
+    """The record of each CIDR among ids, the first row of a duplicated CIDR."""
+    rows: dict[str, dict] = {}
+    for row_id in sorted(ids):
+        rows.setdefault(records[row_id]["cidr"], records[row_id])
+    return rows
+
+
+def diff_snapshots(
+    geoip_archive: archive.DatasetArchive, applied: int = 0
+) -> Iterator[tuple[str, list[Change]]]:
+    """
+    Yield the name and changes of every archived snapshot after the first
+    applied ones. Only the rows that differ from the previous snapshot are
+    read, which the archive row ids give for free.
+    """
+    snapshots = geoip_archive.snapshots()
+    pending = snapshots[applied:]
+    if not pending:
+        return
+
+    chain = ([snapshots[applied - 1]] if applied else []) + pending
+    ids = [set(archive.decode_runs(meta["runs"])) for meta in chain]
+    if not applied:
+        chain.insert(0, None)
+        ids.insert(0, set())
+
+    # rows that leave or enter a snapshot, each parsed with its own header
+    wanted: dict[str | None, set[int]] = {}
+    for i in range(1, len(chain)):
+        if chain[i - 1] is not None:
+            wanted.setdefault(chain[i - 1]["header"], set()).update(ids[i - 1] - ids[i])
+        wanted.setdefault(chain[i]["header"], set()).update(ids[i] - ids[i - 1])
+    rows = geoip_archive.read_ids(wanted, ["cidr"] + ATTRIBUTES)
+    records = {header: frame.to_dict("index") for header, frame in rows.items()}
+
+    for i in range(1, len(chain)):
+        meta = chain[i]
+        time = meta["snapshot"]
+        old = {}
+        if chain[i - 1] is not None:
+            old = first_rows(records[chain[i - 1]["header"]], ids[i - 1] - ids[i])
+        new = first_rows(records[meta["header"]], ids[i] - ids[i - 1])
+        changes = []
+        for cidr in list(new) + [c for c in old if c not in new]:
+            for attribute in ATTRIBUTES:
+                before = old[cidr][attribute] if cidr in old else None
+                after = new[cidr][attribute] if cidr in new else None
+                if before != after:
+                    changes.append(Change(time, cidr, attribute, before, after))
+        yield time, changes
+
+
+def update_history(
+    index: HistoryIndex | None = None,
+    geoip_archive: archive.DatasetArchive | None = None,
+) -> HistoryIndex:
+    """Apply the archived geoip snapshots newer than the index, in memory."""
+    index = index if index is not None else HistoryIndex()
+    geoip_archive = geoip_archive or archive.DatasetArchive("geoip")
+    for time, changes in diff_snapshots(geoip_archive, index.applied):
+        index.apply_changes(time, changes)
+    return index
+
+
+def last_entry(path: Path) -> dict | None:
+    """
+    Return the last complete line of the log, read from the end of the file.
+    A torn line left by an interrupted append is cut off.
+    """
+    if not path.exists():
+        return None
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b""
+        pos = end
+        while pos > 0:
+            step = min(1 << 16, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+            complete = data.rfind(b"\n")
+            if complete < 0:
+                continue
+            if pos + complete + 1 < end:
+                f.truncate(pos + complete + 1)
+            start = data.rfind(b"\n", 0, complete)
+            if start >= 0 or pos == 0:
+                return json.loads(data[start + 1 : complete])
+        f.truncate(0)
+    return None
+
+
+def append_history(
+    path: Path | None = None,
+    geoip_archive: archive.DatasetArchive | None = None,
+) -> int:
+    """
+    Append a line for every snapshot archived since the last line of the log,
+    without loading the log. Return the number of lines appended.
+    """
+    path = path or context.data_path(HISTORY_FILE)
+    geoip_archive = geoip_archive or archive.DatasetArchive("geoip")
+    last = last_entry(path)
+    applied = last["applied"] if last else 0
+
+    lines = []
+    for time, changes in diff_snapshots(geoip_archive, applied):
+        applied += 1
+        entry = {
+            "snapshot": time,
+            "applied": applied,
+            "changes": [[c.cidr, c.attribute, c.old, c.new] for c in changes],
+        }
+        lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+    if lines:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write("".join(lines))
+        print(f"History updated to {time} ({len(lines)} snapshots)")
+    return len(lines)
+
+
+def refresh_history():
+    append_history()
+    # the log above is rebuilt from the archive when it does not exist yet
+    context.data_path(LEGACY_HISTORY_FILE).unlink(missing_ok=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Starlink GeoIP history")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("build", help="rebuild the log from the whole archive")
+    at_parser = sub.add_parser("at", help="attributes of a CIDR at a time")
+    at_parser.add_argument("cidr")
+    at_parser.add_argument("--time", help="e.g. 20250101-0000, latest if omitted")
+    show_parser = sub.add_parser("show", help="all intervals of a CIDR")
+    show_parser.add_argument("cidr")
+    changes_parser = sub.add_parser("changes", help="changes between two times")
+    changes_parser.add_argument("start")
+    changes_parser.add_argument("end")
+    changes_parser.add_argument("--cidr")
+    changes_parser.add_argument("--attribute", choices=ATTRIBUTES)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        context.data_path(HISTORY_FILE).unlink(missing_ok=True)
+        refresh_history()
+        return
+
+    index = HistoryIndex.load()
+    if args.command == "at":
+        json.dump(index.at(args.cidr, args.time), sys.stdout, indent=4)
+        print()
+    elif args.command == "show":
+        json.dump(index.history(args.cidr), sys.stdout, indent=4)
+        print()
+    elif args.command == "changes":
+        for change in index.changes(args.start, args.end, args.cidr, args.attribute):
+            print(f"{change.time} {change.cidr} {change.attribute}: {change.old!r} -> {change.new!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,50 +7,176 @@ import httpx
 import requests
 import geocoder
 import pycountry
+import unicodedata
 from pathlib import Path
 
 import pandas as pd
 
+import context
+import metrics
+from util import write_if_changed
 
 GEOIP_JSON_URL = "https://raw.githubusercontent.com/clarkzjw/starlink-geoip-data/refs/heads/master/geoip/geoip-latest.json"
 NETFAC_JSON_TEMPLATE_URL = "https://raw.githubusercontent.com/clarkzjw/starlink-geoip-data/refs/heads/master/peeringdb/net-{}.json"
 POPS_CSV_URL = "https://raw.githubusercontent.com/clarkzjw/starlink-geoip-data/refs/heads/master/geoip/geoip-pops-ptr-latest.csv"
 PEERINGDB_NET_ID = [18747, 36005]
-DATA_DIR = os.getenv("DATA_DIR", "./starlink-geoip-data")
-GEOIP_MAP_DIR = Path(DATA_DIR).joinpath("map")
+# relative to the data directory of the run
+GEOIP_MAP_DIR = "map"
+POPS_CSV_FILE = "geoip/geoip-pops-ptr-latest.csv"
+# relative to the state directory of the run
+GEOCODE_CACHE_FILE = "cache/geocode-cache.json"
+# GeoNames cities with a population above 15000, https://www.geonames.org/ (CC BY 4.0)
+GAZETTEER_FILE = "./map/data/gazetteer.csv"
+# resolve cities from the cache and the gazetteer only, without calling ArcGIS
+GEOCODE_OFFLINE = os.getenv("GEOCODE_OFFLINE", "0") == "1"
+
+
+def normalize_place(name: str) -> str:
+    name = unicodedata.normalize("NFKD", str(name).strip().casefold())
+    return "".join(c for c in name if not unicodedata.combining(c))
+
+
+class Gazetteer:
+    def __init__(self, path: str = GAZETTEER_FILE):
+        self.places: dict[tuple[str, str], list[tuple[str, float, float]]] = {}
+        if not os.path.exists(path):
+            print("Gazetteer {} not found".format(path))
+            return
+        # rows of the same name are sorted by population, largest first
+        df = pd.read_csv(path, dtype={"admin1": str}, keep_default_na=False)
+        for name, country, admin1, lat, lon in zip(
+            df["name"], df["country"], df["admin1"], df["lat"], df["lon"]
+        ):
+            key = (normalize_place(name), country.upper())
+            self.places.setdefault(key, []).append((admin1, lat, lon))
+
+    def lookup(self, city: str, state: str, country: str) -> dict | None:
+        candidates = self.places.get((normalize_place(city), country.upper()))
+        if not candidates:
+            return None
+        # ISO 3166-2 subdivision codes match GeoNames admin1 codes for some
+        # countries, e.g., US-CA and AD-07
+        subdivision = state.split("-", 1)[-1].upper()
+        for admin1, lat, lon in candidates:
+            if admin1.upper() == subdivision:
+                return {"lat": lat, "lng": lon}
+        _, lat, lon = candidates[0]
+        return {"lat": lat, "lng": lon}
+
+
+class GeocodeCache:
+    """
+    Persistent geocode results keyed by the normalized (city, region, country).
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.path = Path(path or context.state_path(GEOCODE_CACHE_FILE))
+        self.hits = 0
+        self.misses = 0
+        self.entries: dict[str, dict] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(city: str, state: str, country: str) -> str:
+        return "|".join(normalize_place(x) for x in (city, state, country))
+
+    def get(self, city: str, state: str, country: str) -> dict | None:
+        entry = self.entries.get(self.key(city, state, country))
+        if entry is None:
+            self.misses += 1
+            metrics.incr("geocoder.cache_misses")
+        else:
+            self.hits += 1
+            metrics.incr("geocoder.cache_hits")
+        return entry
+
+    def put(self, city: str, state: str, country: str, lat, lng, source: str):
+        self.entries[self.key(city, state, country)] = {
+            "lat": float(lat),
+            "lng": float(lng),
+            "source": source,
+        }
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        print(
+            "Geocode cache: {} hits, {} misses, {} entries".format(
+                self.hits, self.misses, len(self.entries)
+            )
+        )
+
+
+def geocode_arcgis(city: str, state: str, country: str) -> dict | None:
+    metrics.incr("geocoder.arcgis_calls")
+    if country == "US":
+        # US has too many cities with the same name, add state to improve accuracy
+        g = geocoder.arcgis("{}, {}, {}".format(city, state, country))
+    else:
+        g = geocoder.arcgis("{}, {}".format(city, country))
+
+    if g.json is None:
+        metrics.incr("geocoder.arcgis_calls")
+        g = geocoder.arcgis("{}, {}, {}".format(city, state, country))
+        if g.json is None:
+            metrics.incr("geocoder.arcgis_calls")
+            g = geocoder.arcgis("{}".format(city))
+    return g.json
+
+
+def geocode_city(
+    city: str,
+    state: str,
+    country: str,
+    cache: GeocodeCache,
+    gazetteer: Gazetteer,
+    offline: bool = GEOCODE_OFFLINE,
+) -> dict | None:
+    source_gps = cache.get(city, state, country)
+    if source_gps is not None:
+        return source_gps
+
+    source = "gazetteer"
+    if offline:
+        metrics.incr("geocoder.gazetteer_lookups")
+        source_gps = gazetteer.lookup(city, state, country)
+    else:
+        source_gps = geocode_arcgis(city, state, country)
+        source = "arcgis"
+        if source_gps is None:
+            metrics.incr("geocoder.gazetteer_lookups")
+            source_gps = gazetteer.lookup(city, state, country)
+            source = "gazetteer"
+
+    if source_gps is not None:
+        cache.put(city, state, country, source_gps["lat"], source_gps["lng"], source)
+    return source_gps
 
 
 def load_pops_csv() -> pd.DataFrame:
     # cidr,country,region,city,pop,code,dns_ptr,pop_dns_ptr_match
     # 14.1.64.0/24,PH,PH-00,Manila,mnlaphl1,mnl,customer.mnlaphl1.pop.starlinkisp.net.,True
     # 14.1.65.0/24,PH,PH-00,Manila,mnlaphl1,mnl,customer.mnlaphl1.pop.starlinkisp.net.,True
+    # prefer the copy the GeoIP stage has just written
+    pops_csv_file = context.data_path(POPS_CSV_FILE)
+    if pops_csv_file.exists():
+        return pd.read_csv(pops_csv_file)
     df = pd.read_csv(POPS_CSV_URL)
     return df
 
 
-def get_pop(subnet: str, df: pd.DataFrame) -> str:
-    match = df[df["cidr"] == subnet]
-    if not match.empty:
-        pop = match.iloc[0]["pop"]
-        if pd.notna(pop):
-            return pop
-        else:
-            return ""
-        # # if "pop_dns_ptr_match" is True
-        # if match.iloc[0]["pop_dns_ptr_match"]:
-        #     return match.iloc[0]["pop"]
-        # else:
-        #     ptr = match.iloc[0]["dns_ptr"]
-        #     pop_from_ptr = ptr.split(".")[1]
-        #     return pop_from_ptr
-    return ""
+def build_pop_index(df: pd.DataFrame, key: str = "cidr") -> dict[str, str]:
+    # the first row of a subnet wins, like df[df[key] == subnet].iloc[0]
+    df = df.drop_duplicates(subset=key, keep="first")
+    pops = df["pop"].where(df["pop"].notna(), "")
+    return dict(zip(df[key], pops))
 
 
-def get_pop_from_csv(subnet: str, df: pd.DataFrame) -> str:
-    match = df[df["subnet"] == subnet]
-    if not match.empty:
-        return match.iloc[0]["pop"]
-    return ""
+def get_pop(subnet: str, pop_index: dict[str, str]) -> str:
+    return pop_index.get(subnet, "")
 
 
 def get_geoip_json() -> dict:
@@ -61,6 +187,7 @@ def get_geoip_json() -> dict:
     return geoipJson
 
 
+@metrics.timed("map.pop_list")
 def get_pop_list(geoipJson: dict):
     with open("./map/data/pop.json", "r+") as f:
         pops = json.load(f)
@@ -84,8 +211,10 @@ def get_pop_list(geoipJson: dict):
                     )
         pops.sort(key=lambda x: x["code"])
 
-        with open(Path(GEOIP_MAP_DIR).joinpath("pop.json"), "w") as f_out:
-            json.dump(pops, f_out, indent=4)
+        write_if_changed(
+            context.data_path(GEOIP_MAP_DIR, "pop.json"),
+            lambda f_out: json.dump(pops, f_out, indent=4),
+        )
 
 
 def convert_country_code(two_letter_code: str) -> str:
@@ -96,6 +225,7 @@ def convert_country_code(two_letter_code: str) -> str:
     return two_letter_code
 
 
+@metrics.timed("map.netfac")
 def get_netfac_list():
     netfac_geojson = {"type": "FeatureCollection", "features": []}
 
@@ -103,6 +233,8 @@ def get_netfac_list():
     peeringdb_client = httpx.Client(base_url="https://www.peeringdb.com/")
     for netid in PEERINGDB_NET_ID:
         netfac_json = requests.get(NETFAC_JSON_TEMPLATE_URL.format(netid))
+        metrics.incr("http.requests")
+        metrics.incr("http.bytes", len(netfac_json.content))
         netfac_json = json.loads(netfac_json.content)
         netfac_json = netfac_json["data"][0]["netfac_set"]
         for netfac in netfac_json:
@@ -110,6 +242,8 @@ def get_netfac_list():
             netfac_ids.append(netfac["id"])
             print("Processing PeeringDB netfac ID: {}".format(netfac["id"]))
             response = peeringdb_client.get(f'api/netfac/{netfac["id"]}', timeout=10.0)
+            metrics.incr("http.requests")
+            metrics.incr("http.bytes", len(response.content))
             netfac_detail = response.json()
             if "data" not in netfac_detail:
                 print(netfac_detail)
@@ -132,6 +266,7 @@ def get_netfac_list():
                 )
                 print("Geocoding address: {}".format(address))
                 g = geocoder.arcgis(address)
+                metrics.incr("geocoder.arcgis_calls")
                 lat, lon = g.json["lat"], g.json["lng"]
                 print("Geocoded to: {}, {}".format(lat, lon))
 
@@ -153,14 +288,19 @@ def get_netfac_list():
             )
 
     peeringdb_client.close()
-    json.dump(
-        netfac_geojson, open(Path(GEOIP_MAP_DIR).joinpath("netfac.json"), "w"), indent=4
+    write_if_changed(
+        context.data_path(GEOIP_MAP_DIR, "netfac.json"),
+        lambda f: json.dump(netfac_geojson, f, indent=4),
     )
 
 
-def get_city_list(geoipJson: dict):
+@metrics.timed("map.city_list")
+def get_city_list(geoipJson: dict, pop_index: dict[str, str] | None = None):
     city_json = {"type": "FeatureCollection", "features": []}
-    df_geoip = load_pops_csv()
+    if pop_index is None:
+        pop_index = build_pop_index(load_pops_csv())
+    cache = GeocodeCache()
+    gazetteer = Gazetteer()
 
     geoipJson = geoipJson["countries"]
     for country in geoipJson:
@@ -173,21 +313,14 @@ def get_city_list(geoipJson: dict):
                 # country_full = convert_country_code(country)
                 print("{}, {}, {}".format(country, state, city))
 
-                if country == "US":
-                    # US has too many cities with the same name, add state to improve accuracy
-                    g = geocoder.arcgis("{}, {}, {}".format(city, state, country))
-                else:
-                    g = geocoder.arcgis("{}, {}".format(city, country))
-
-                if g.json is None:
-                    g = geocoder.arcgis("{}, {}, {}".format(city, state, country))
-                    if g.json is None:
-                        g = geocoder.arcgis("{}".format(city))
-                source_gps = g.json
+                source_gps = geocode_city(city, state, country, cache, gazetteer)
                 print(source_gps)
+                if source_gps is None:
+                    print("Failed to geocode {}, {}, {}".format(country, state, city))
+                    continue
                 description = "<i>{},{},{}</i><br>".format(country, state, city)
                 for ip in geoipJson[country][state][city]["ips"]:
-                    pop = get_pop(ip[0], df_geoip)
+                    pop = get_pop(ip[0], pop_index)
                     description += f"Subnet: {ip[0]}: PoP: {pop}<br>(PTR: {ip[1]})<br>"
 
                 city_json["features"].append(
@@ -208,7 +341,12 @@ def get_city_list(geoipJson: dict):
                     }
                 )
 
-    json.dump(city_json, open(Path(GEOIP_MAP_DIR).joinpath("city.json"), "w"), indent=4)
+    cache.save()
+    metrics.incr("map.cities", len(city_json["features"]))
+    write_if_changed(
+        context.data_path(GEOIP_MAP_DIR, "city.json"),
+        lambda f: json.dump(city_json, f, indent=4),
+    )
 
 
 def refresh_map():
@@ -217,4 +355,4 @@ def refresh_map():
     get_netfac_list()
 
     get_pop_list(geoipJson)
-    get_city_list(geoipJson)
+    get_city_list(geoipJson, build_pop_index(load_pops_csv()))
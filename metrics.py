@@ -0,0 +1,161 @@
+"""
+Per-run metrics: stage timings, counters and peak RSS.
+
+    with metrics.stage("geoip_pop.dns"):
+        ...
+    metrics.incr("dns.queries", len(ips))
+
+write() saves everything to metrics/run-{dt_string}.json under the state
+directory of the run, named after the run context.
+
+Any stage can be profiled by listing it in METRICS_PROFILE (comma separated,
+"*" for all stages), with METRICS_PROFILER=cprofile (default) or tracemalloc.
+The profile is saved next to the metrics file.
+"""
+
+import os
+import time
+import json
+import cProfile
+import functools
+import resource
+import threading
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import context
+
+
+# relative to the state directory of the run
+METRICS_DIR = "metrics"
+
+METRICS_PROFILE = [s for s in os.getenv("METRICS_PROFILE", "").split(",") if s]
+METRICS_PROFILER = os.getenv("METRICS_PROFILER", "cprofile")
+
+
+def peak_rss_kb() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages: dict[str, dict] = {}
+        self.counters: dict[str, float] = {}
+        self.profiles: list[str] = []
+        self._profiling = False
+
+    def incr(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _record(self, name: str, seconds: float, failed: bool):
+        with self.lock:
+            entry = self.stages.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "failures": 0}
+            )
+            entry["calls"] += 1
+            entry["seconds"] = round(entry["seconds"] + seconds, 3)
+            entry["failures"] += int(failed)
+            entry["peak_rss_kb"] = peak_rss_kb()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        failed = False
+        profile = self._start_profile(name)
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self._record(name, time.perf_counter() - start, failed)
+            if profile is not None:
+                self._save_profile(name, profile)
+
+    def timed(self, name: str):
+        """Decorator form of stage()."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def _start_profile(self, name: str):
+        if not ("*" in METRICS_PROFILE or name in METRICS_PROFILE):
+            return None
+        with self.lock:
+            # only one profiler can be active at a time, jobs run in parallel
+            if self._profiling:
+                print(f"Profiler busy, not profiling stage {name}")
+                return None
+            self._profiling = True
+        if METRICS_PROFILER == "tracemalloc":
+            tracemalloc.start()
+            return "tracemalloc"
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _save_profile(self, name: str, profile):
+        metrics_dir = context.state_path(METRICS_DIR)
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        if profile == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            path = metrics_dir.joinpath(
+                f"run-{context.current().dt_string}-{name}.tracemalloc.txt"
+            )
+            with open(path, "w") as f:
+                f.write(f"peak traced memory: {peak} bytes\n")
+                for stat in snapshot.statistics("lineno")[:50]:
+                    f.write(f"{stat}\n")
+        else:
+            profile.disable()
+            path = metrics_dir.joinpath(f"run-{context.current().dt_string}-{name}.prof")
+            profile.dump_stats(path)
+        print(f"Saved profile of {name} to {path}")
+        with self.lock:
+            self._profiling = False
+            self.profiles.append(path.name)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "run": context.current().dt_string,
+                "started_at": datetime.fromtimestamp(self.started, tz=timezone.utc).isoformat(),
+                "wall_seconds": round(time.time() - self.started, 3),
+                "peak_rss_kb": peak_rss_kb(),
+                "stages": dict(sorted(self.stages.items())),
+                "counters": dict(sorted(self.counters.items())),
+                "profiles": list(self.profiles),
+            }
+
+    def write(self, path: Path | None = None) -> Path:
+        ctx = context.current()
+        path = path or ctx.state_path(METRICS_DIR, f"run-{ctx.dt_string}.json")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        print(f"Wrote run metrics to {path}")
+        return path
+
+
+RUN = Metrics()
+
+stage = RUN.stage
+timed = RUN.timed
+incr = RUN.incr
+write = RUN.write
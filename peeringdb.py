@@ -1,30 +1,32 @@
-import os
 import json
-import httpx
 
 from pathlib import Path
 
+import context
+import fetch
+import metrics
+from util import write_if_changed
+
 
 NETID = [18747, 36005]
 
-DATA_DIR = os.getenv("DATA_DIR", "./starlink-geoip-data")
+PEERINGDB_API_URL = "https://www.peeringdb.com/api/"
 
 
-def new_client():
-    return httpx.Client(base_url="https://www.peeringdb.com/")
+def net_file(netid: int) -> Path:
+    return context.data_path("peeringdb/net-{}.json".format(netid))
 
 
-def retrive_net(netid: int):
-    client = new_client()
-    response = client.get(f"api/net/{netid}")
-    client.close()
-    return response.json()
+def retrive_net(netid: int, conditional: bool = False) -> fetch.FetchResult:
+    return fetch.fetch(f"{PEERINGDB_API_URL}net/{netid}", conditional=conditional)
 
 
+@metrics.timed("peeringdb.refresh")
 def refresh_peeringdb():
     for netid in NETID:
-        data = retrive_net(netid)
-        with open(
-            Path(DATA_DIR).joinpath("peeringdb/net-{}.json".format(netid)), "w"
-        ) as f:
-            f.write(json.dumps(data, indent=4))
+        result = retrive_net(netid, conditional=net_file(netid).exists())
+        if isinstance(result, fetch.NotModified):
+            continue
+        data = result.json()
+        write_if_changed(net_file(netid), lambda f: f.write(json.dumps(data, indent=4)))
+        result.commit()
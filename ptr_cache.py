@@ -0,0 +1,66 @@
+import time
+import sqlite3
+
+from pathlib import Path
+
+
+class PTRCache:
+    """
+    On-disk PTR cache keyed by CIDR.
+
+    Each entry keeps the PTR, the time it was resolved and the TTL of the
+    record, so a run only needs to resolve new CIDRs and expired entries.
+    """
+
+    def __init__(self, path: Path, min_ttl: int = 0):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.min_ttl = min_ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ptr ("
+            "cidr TEXT PRIMARY KEY, "
+            "dns_ptr TEXT NOT NULL, "
+            "resolved_at INTEGER NOT NULL, "
+            "ttl INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get_many(self, cidrs: list) -> dict[str, tuple[str, int, int]]:
+        entries = {}
+        cidrs = list(cidrs)
+        # stay below SQLITE_MAX_VARIABLE_NUMBER
+        for i in range(0, len(cidrs), 500):
+            chunk = cidrs[i : i + 500]
+            rows = self.conn.execute(
+                "SELECT cidr, dns_ptr, resolved_at, ttl FROM ptr WHERE cidr IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            )
+            for cidr, dns_ptr, resolved_at, ttl in rows:
+                entries[cidr] = (dns_ptr, resolved_at, ttl)
+        return entries
+
+    def put_many(self, rows: list[tuple[str, str, int, int]]):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO ptr (cidr, dns_ptr, resolved_at, ttl) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        self.conn.commit()
+
+    def is_fresh(self, entry: tuple[str, int, int], now: float | None = None) -> bool:
+        _, resolved_at, ttl = entry
+        now = time.time() if now is None else now
+        return resolved_at + max(ttl, self.min_ttl) > now
+
+    def stale(self, cidrs: list, now: float | None = None) -> list[str]:
+        """Return the CIDRs that are missing from the cache or have expired."""
+        entries = self.get_many(cidrs)
+        return [
+            cidr
+            for cidr in cidrs
+            if cidr not in entries or not self.is_fresh(entries[cidr], now)
+        ]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,251 @@
+import os
+import random
+import struct
+import asyncio
+import ipaddress
+
+
+# https://www.rfc-editor.org/rfc/rfc1035#section-4.1
+TYPE_SOA = 6
+TYPE_PTR = 12
+CLASS_IN = 1
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+RCODE_MASK = 0x000F
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+DNS_PORT = 53
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_CONCURRENCY = 256
+# extra attempts for a SERVFAIL answer before giving up on this round
+SERVFAIL_RETRIES = 2
+SERVFAIL_BACKOFF = 0.2
+
+
+class TruncatedResponse(Exception):
+    pass
+
+
+class MalformedResponse(Exception):
+    pass
+
+
+class ResponseCodeError(Exception):
+    """The server answered with an error RCODE other than NXDOMAIN."""
+
+    def __init__(self, rcode: int):
+        super().__init__(f"DNS error RCODE {rcode}")
+        self.rcode = rcode
+
+
+def get_nameserver() -> tuple[str, int]:
+    # DNS_SERVER=127.0.0.1:5353 or DNS_SERVER=1.1.1.1
+    server = os.getenv("DNS_SERVER", "")
+    if not server:
+        try:
+            with open("/etc/resolv.conf", "r") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] == "nameserver":
+                        server = parts[1]
+                        break
+        except OSError:
+            pass
+    if not server:
+        server = "1.1.1.1"
+
+    if server.startswith("["):
+        host, _, port = server[1:].partition("]:")
+        return host, int(port or DNS_PORT)
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return host, int(port)
+    return server, DNS_PORT
+
+
+def encode_name(name: str) -> bytes:
+    out = b""
+    for label in name.rstrip(".").split("."):
+        out += struct.pack("!B", len(label)) + label.encode("ascii")
+    return out + b"\x00"
+
+
+def build_query(qname: str, qid: int) -> bytes:
+    header = struct.pack("!HHHHHH", qid, FLAG_RD, 1, 0, 0, 0)
+    return header + encode_name(qname) + struct.pack("!HH", TYPE_PTR, CLASS_IN)
+
+
+def decode_name(data: bytes, offset: int) -> tuple[str, int]:
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(data):
+            raise MalformedResponse("name exceeds message")
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            # compression pointer
+            if offset + 1 >= len(data):
+                raise MalformedResponse("truncated pointer")
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise MalformedResponse("compression loop")
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        if length == 0:
+            offset += 1
+            break
+        labels.append(data[offset + 1 : offset + 1 + length].decode("ascii", "replace"))
+        offset += 1 + length
+    return ".".join(labels) + ".", end if end is not None else offset
+
+
+def parse_response(data: bytes, qid: int) -> tuple[str, int]:
+    """
+    Return (ptr, ttl) from a DNS response, ptr is "" if there is no PTR record.
+    For negative answers (NOERROR without a PTR, or NXDOMAIN) the TTL is taken
+    from the SOA record (RFC 2308). Any other RCODE raises ResponseCodeError,
+    so a SERVFAIL is never mistaken for an empty answer.
+    """
+    if len(data) < 12:
+        raise MalformedResponse("short message")
+    rid, flags, qdcount, ancount, nscount, _ = struct.unpack("!HHHHHH", data[:12])
+    if rid != qid or not flags & FLAG_QR:
+        raise MalformedResponse("unexpected message id")
+    if flags & FLAG_TC:
+        raise TruncatedResponse()
+    rcode = flags & RCODE_MASK
+    if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        raise ResponseCodeError(rcode)
+
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = decode_name(data, offset)
+        offset += 4
+
+    negative_ttl = 0
+    for section, count in (("answer", ancount), ("authority", nscount)):
+        for _ in range(count):
+            _, offset = decode_name(data, offset)
+            if offset + 10 > len(data):
+                raise MalformedResponse("truncated record")
+            rtype, _, ttl, rdlength = struct.unpack("!HHIH", data[offset : offset + 10])
+            offset += 10
+            if section == "answer" and rtype == TYPE_PTR:
+                ptr, _ = decode_name(data, offset)
+                return ptr, ttl
+            if section == "authority" and rtype == TYPE_SOA:
+                _, rdata = decode_name(data, offset)
+                _, rdata = decode_name(data, rdata)
+                minimum = struct.unpack("!I", data[rdata + 16 : rdata + 20])[0]
+                negative_ttl = min(ttl, minimum)
+            offset += rdlength
+    return "", negative_ttl
+
+
+class _UDPQuery(asyncio.DatagramProtocol):
+    def __init__(self, query: bytes, qid: int, future: asyncio.Future):
+        self.query = query
+        self.qid = qid
+        self.future = future
+
+    def connection_made(self, transport):
+        transport.sendto(self.query)
+
+    def datagram_received(self, data, addr):
+        if self.future.done():
+            return
+        try:
+            self.future.set_result(parse_response(data, self.qid))
+        except MalformedResponse:
+            # not our answer, keep waiting
+            pass
+        except (TruncatedResponse, ResponseCodeError) as e:
+            self.future.set_exception(e)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def _query_udp(query: bytes, qid: int, server: tuple[str, int]):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _UDPQuery(query, qid, future), remote_addr=server
+    )
+    try:
+        return await future
+    finally:
+        transport.close()
+
+
+async def _query_tcp(query: bytes, qid: int, server: tuple[str, int]):
+    reader, writer = await asyncio.open_connection(server[0], server[1])
+    try:
+        writer.write(struct.pack("!H", len(query)) + query)
+        await writer.drain()
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+        return parse_response(await reader.readexactly(length), qid)
+    finally:
+        writer.close()
+
+
+async def query_ptr(
+    ip: ipaddress.IPv4Address | ipaddress.IPv6Address,
+    server: tuple[str, int] | None = None,
+    timeout: float = DEFAULT_TIMEOUT,
+    servfail_retries: int = SERVFAIL_RETRIES,
+) -> tuple[str, int] | None:
+    """
+    Resolve the PTR record of an IP address over UDP, retrying over TCP if the
+    answer is truncated. A SERVFAIL is asked again up to servfail_retries
+    times. Return (ptr, ttl), or None on timeout or if the server keeps
+    failing, so the caller retries later instead of caching an empty answer.
+    """
+    server = server or get_nameserver()
+    query_name = ip.reverse_pointer
+    try:
+        async with asyncio.timeout(timeout):
+            for attempt in range(servfail_retries + 1):
+                qid = random.getrandbits(16)
+                query = build_query(query_name, qid)
+                try:
+                    try:
+                        return await _query_udp(query, qid, server)
+                    except TruncatedResponse:
+                        return await _query_tcp(query, qid, server)
+                except ResponseCodeError as e:
+                    if e.rcode != RCODE_SERVFAIL or attempt == servfail_retries:
+                        print(f"PTR query for IP {ip} failed: {e}")
+                        return None
+                    await asyncio.sleep(SERVFAIL_BACKOFF * (attempt + 1))
+    except TimeoutError:
+        print(f"Timeout expired for PTR query on IP: {ip}")
+        return None
+    except (OSError, MalformedResponse, asyncio.IncompleteReadError) as e:
+        print(f"Error querying PTR for IP {ip}: {e}")
+        return "", 0
+
+
+async def resolve_many(
+    ips: list,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    timeout: float = DEFAULT_TIMEOUT,
+    server: tuple[str, int] | None = None,
+) -> list[tuple[str, int] | None]:
+    server = server or get_nameserver()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(ip):
+        async with semaphore:
+            return await query_ptr(ip, server, timeout)
+
+    return await asyncio.gather(*(worker(ip) for ip in ips))
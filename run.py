@@ -1,42 +1,127 @@
+import os
+import sys
+import shutil
+import importlib
+
 from datetime import datetime, timezone
 
-import bgp
-import peeringdb
-import atlas
-import map.process_map
-import monthly_latency_snapshot
-import availability
-import geoip_pop
+import context
+import metrics
+from scheduler import Job, Scheduler
 
 
-def run_jobs(now: datetime):
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "5400"))
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "0")) or None
+# run state that earlier versions kept in the published data directory
+LEGACY_STATE_DIRS = ["cache", "metrics"]
+
+
+def lazy(target: str):
+    """
+    Return a function that imports "module.function" when it is called, so
+    only the jobs that run this hour pay for their imports.
+    """
+    module_name, func_name = target.rsplit(".", 1)
+
+    def run():
+        return getattr(importlib.import_module(module_name), func_name)()
+
+    run.__name__ = run.__qualname__ = target
+    return run
 
-    print("Current UTC date and time:", now.strftime("%Y-%m-%d %H:%M:%S"))
 
+def build_jobs(now: datetime) -> list[Job]:
     hour = now.hour
     day = now.day
 
+    jobs = []
     if hour == 0:
         if day in [1, 7, 14, 21, 28]:
-            print("Running monthly latency snapshot and availability zone refresh...")
-            monthly_latency_snapshot.get_latency_json()
-            print("Refreshing availability zones...")
-            availability.refresh_availability_zone()
+            jobs += [
+                Job(
+                    "latency",
+                    lazy("monthly_latency_snapshot.get_latency_json"),
+                    outputs=["latency"],
+                    timeout=JOB_TIMEOUT,
+                ),
+                Job(
+                    "availability",
+                    lazy("availability.refresh_availability_zone"),
+                    outputs=["availability"],
+                    timeout=JOB_TIMEOUT,
+                ),
+            ]
 
-        print("Refreshing BGP")
-        bgp.get_bgp_list()
-        print("Refreshing PeeringDB")
-        peeringdb.refresh_peeringdb()
-        print("Refreshing Atlas probes")
-        atlas.refresh_atlas_probes()
+        jobs += [
+            Job("bgp", lazy("bgp.get_bgp_list"), outputs=["bgp"], timeout=JOB_TIMEOUT),
+            Job(
+                "peeringdb",
+                lazy("peeringdb.refresh_peeringdb"),
+                outputs=["peeringdb"],
+                timeout=JOB_TIMEOUT,
+            ),
+            Job(
+                "atlas",
+                lazy("atlas.refresh_atlas_probes"),
+                outputs=["atlas"],
+                timeout=JOB_TIMEOUT,
+            ),
+        ]
 
-    print("Refreshing GeoIP and POP data")
-    geoip_pop.refresh_geoip_pop()
+    jobs += [
+        Job(
+            "geoip",
+            lazy("geoip_pop.refresh_geoip_pop"),
+            outputs=["feed", "pop", "geoip/geoip-latest.json", "geoip/geoip-pops-ptr-latest.csv"],
+            timeout=JOB_TIMEOUT,
+        ),
+        Job(
+            "map",
+            lazy("map.process_map.refresh_map"),
+            inputs=["geoip/geoip-latest.json", "geoip/geoip-pops-ptr-latest.csv", "peeringdb"],
+            outputs=["map"],
+            timeout=JOB_TIMEOUT,
+        ),
+    ]
+    return jobs
+
+
+def move_legacy_state(ctx: context.RunContext):
+    """
+    Move LEGACY_STATE_DIRS out of the data directory into the state directory,
+    so they stop being published. A file already in the state directory is
+    newer than the published copy and is kept.
+    """
+    for name in LEGACY_STATE_DIRS:
+        legacy = ctx.path(name)
+        if not legacy.is_dir():
+            continue
+        for path in sorted(legacy.rglob("*")):
+            if not path.is_file():
+                continue
+            target = ctx.state_path(path.relative_to(ctx.data_dir))
+            if target.exists():
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(path, target)
+        shutil.rmtree(legacy)
+        print(f"Moved {legacy} to the state directory {ctx.state_dir}")
+
+
+def run_jobs(now: datetime) -> bool:
+    ctx = context.start_run(now)
+    move_legacy_state(ctx)
+    print("Current UTC date and time:", now.strftime("%Y-%m-%d %H:%M:%S"))
 
-    print("Refreshing GeoIP map data")
-    map.process_map.refresh_map()
+    scheduler = Scheduler(build_jobs(now), max_workers=JOB_CONCURRENCY)
+    results = scheduler.run()
+    scheduler.summary(results)
+    metrics.incr("jobs.failed", sum(r.status != "ok" for r in results.values()))
+    metrics.write()
+    return all(r.status == "ok" for r in results.values())
 
 
 if __name__ == "__main__":
     now = datetime.now(tz=timezone.utc)
-    run_jobs(now)
+    if not run_jobs(now):
+        sys.exit(1)
@@ -0,0 +1,206 @@
+"""
+Small dependency-aware job scheduler.
+
+A job declares the data it reads (inputs) and writes (outputs). A job waits for
+every job that outputs one of its inputs; inputs that no job outputs are files
+already in the data directory. Ready jobs run concurrently in daemon threads.
+A job that fails marks its dependents as skipped, unrelated jobs keep running.
+
+A job that runs past its timeout aborts the run: its thread cannot be stopped
+and may still be writing its outputs, so no further job is started and every
+job that has not started yet is skipped. The jobs already running are waited
+for. A run with a timed out job never succeeds, run.py exits with an error and
+CI does not publish the data directory, so half-written outputs stay local.
+"""
+
+import time
+import queue
+import threading
+import traceback
+
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import metrics
+
+
+@dataclass
+class Job:
+    name: str
+    func: Callable[[], Any]
+    inputs: list[str] = field(default_factory=list)
+    outputs: list[str] = field(default_factory=list)
+    # seconds, None means no timeout
+    timeout: float | None = None
+
+
+@dataclass
+class JobResult:
+    name: str
+    # ok, failed, timeout or skipped
+    status: str
+    started: float = 0.0
+    finished: float = 0.0
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class Scheduler:
+    def __init__(self, jobs: list[Job], max_workers: int | None = None):
+        self.jobs = {job.name: job for job in jobs}
+        if len(self.jobs) != len(jobs):
+            raise ValueError("Duplicate job names")
+        self.max_workers = max_workers or len(jobs) or 1
+        self.dependencies = self._resolve_dependencies()
+
+    def _resolve_dependencies(self) -> dict[str, set[str]]:
+        producers: dict[str, str] = {}
+        for job in self.jobs.values():
+            for output in job.outputs:
+                if output in producers:
+                    raise ValueError(
+                        f"{output} is an output of both {producers[output]} and {job.name}"
+                    )
+                producers[output] = job.name
+
+        dependencies = {
+            job.name: {producers[i] for i in job.inputs if i in producers} - {job.name}
+            for job in self.jobs.values()
+        }
+
+        # reject cycles, which would never become ready
+        visited: dict[str, int] = {}
+
+        def visit(name: str, path: list[str]):
+            if visited.get(name) == 1:
+                raise ValueError("Dependency cycle: " + " -> ".join(path + [name]))
+            if visited.get(name) == 2:
+                return
+            visited[name] = 1
+            for dep in dependencies[name]:
+                visit(dep, path + [name])
+            visited[name] = 2
+
+        for name in dependencies:
+            visit(name, [])
+        return dependencies
+
+    def _start(self, job: Job, done: queue.Queue) -> JobResult:
+        result = JobResult(job.name, "running", started=time.monotonic())
+
+        def target():
+            try:
+                with metrics.stage(f"job.{job.name}"):
+                    job.func()
+                done.put((job.name, "ok", None))
+            except BaseException as e:
+                # SystemExit from sys.exit() in a job only fails that job
+                traceback.print_exc()
+                done.put((job.name, "failed", f"{type(e).__name__}: {e}"))
+
+        print(f"[scheduler] starting {job.name}")
+        threading.Thread(target=target, name=f"job-{job.name}", daemon=True).start()
+        return result
+
+    def run(self) -> dict[str, JobResult]:
+        done: queue.Queue = queue.Queue()
+        results: dict[str, JobResult] = {}
+        pending = dict(self.dependencies)
+        running: dict[str, JobResult] = {}
+        # the first job that timed out, see the module docstring
+        aborted: str | None = None
+
+        while pending or running:
+            if aborted is not None:
+                for name in pending:
+                    results[name] = JobResult(name, "skipped", error=f"run aborted, {aborted} timed out")
+                if pending:
+                    print(f"[scheduler] skipping {', '.join(sorted(pending))}: {aborted} timed out")
+                pending = {}
+
+            # skip the jobs whose dependencies did not succeed
+            for name, deps in list(pending.items()):
+                failed = [d for d in deps if d in results and results[d].status != "ok"]
+                if failed:
+                    print(f"[scheduler] skipping {name}: {', '.join(sorted(failed))} did not succeed")
+                    results[name] = JobResult(name, "skipped", error=f"depends on {', '.join(sorted(failed))}")
+                    del pending[name]
+
+            for name, deps in list(pending.items()):
+                if len(running) >= self.max_workers:
+                    break
+                if all(d in results for d in deps):
+                    running[name] = self._start(self.jobs[name], done)
+                    del pending[name]
+
+            if not running:
+                continue
+
+            deadlines = [
+                r.started + self.jobs[n].timeout
+                for n, r in running.items()
+                if self.jobs[n].timeout is not None
+            ]
+            wait = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            try:
+                name, status, error = done.get(timeout=wait)
+                if name in running:
+                    self._finish(running.pop(name), status, error, results)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            for name, result in list(running.items()):
+                timeout = self.jobs[name].timeout
+                if timeout is not None and now - result.started >= timeout:
+                    # the thread cannot be killed, it is abandoned as a daemon
+                    self._finish(running.pop(name), "timeout", f"timed out after {timeout:g}s", results)
+                    aborted = aborted or name
+
+        return results
+
+    def _finish(self, result: JobResult, status: str, error: str | None, results: dict):
+        result.status = status
+        result.error = error
+        result.finished = time.monotonic()
+        results[result.name] = result
+        print(f"[scheduler] {result.name} {status} in {result.duration:.1f}s" + (f": {error}" if error else ""))
+
+    def critical_path(self, results: dict[str, JobResult]) -> list[str]:
+        """
+        Walk back from the job that finished last through the dependency that
+        finished last, i.e. the chain of jobs that set the total run time.
+        """
+        ran = {n: r for n, r in results.items() if r.status != "skipped"}
+        if not ran:
+            return []
+        name = max(ran, key=lambda n: ran[n].finished)
+        path = [name]
+        while True:
+            deps = [d for d in self.dependencies[name] if d in ran]
+            if not deps:
+                break
+            name = max(deps, key=lambda d: ran[d].finished)
+            path.append(name)
+        return path[::-1]
+
+    def summary(self, results: dict[str, JobResult]):
+        ran = [r for r in results.values() if r.status != "skipped"]
+        origin = min((r.started for r in ran), default=0.0)
+        print("[scheduler] job summary:")
+        for r in sorted(results.values(), key=lambda r: (r.status == "skipped", r.started)):
+            if r.status == "skipped":
+                print(f"  {r.name:<12} skipped ({r.error})")
+            else:
+                print(
+                    f"  {r.name:<12} {r.status:<8} start +{r.started - origin:7.1f}s"
+                    f"  duration {r.duration:7.1f}s"
+                )
+        path = self.critical_path(results)
+        if path:
+            total = results[path[-1]].finished - origin
+            chain = " -> ".join(f"{n} ({results[n].duration:.1f}s)" for n in path)
+            print(f"[scheduler] critical path: {chain}, {total:.1f}s of wall time")
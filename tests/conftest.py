@@ -0,0 +1,78 @@
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import context
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path):
+    """Every test runs in a context of its own, with empty data and state directories."""
+    ctx = context.start_run(data_dir=tmp_path.joinpath("data"), state_dir=tmp_path.joinpath("state"))
+    return ctx.data_dir
+
+
+class StandInServer:
+    """
+    Local HTTP server for code that talks to a remote API. handle(request)
+    returns (status, headers, body), every request is kept in requests.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.requests = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with stand_in.lock:
+                    stand_in.requests.append(self)
+                    stand_in.in_flight += 1
+                    stand_in.max_in_flight = max(stand_in.max_in_flight, stand_in.in_flight)
+                try:
+                    status, headers, body = stand_in.handle(self)
+                finally:
+                    with stand_in.lock:
+                        stand_in.in_flight -= 1
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in_server():
+    servers = []
+
+    def start(handle) -> StandInServer:
+        server = StandInServer(handle)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,210 @@
+import sys
+import csv
+import json
+import random
+import subprocess
+
+from ipaddress import ip_address
+from pathlib import Path
+
+import pytest
+
+import annotate
+from util import PrefixIndex
+
+from test_prefix_index import probes, random_prefixes
+
+
+HEADER = "cidr,country,region,city,pop,code,dns_ptr,match_type\n"
+ROWS = [
+    "149.19.108.0/24,US,US-WA,Seattle,sttlwax1,US-WA,customer.sttlwax1.pop.starlinkisp.net.,exact",
+    "14.1.64.0/24,PH,PH-00,Manila,mnlaphl1,PH-00,,exact",
+    '98.97.0.0/24,US,US-NY,"New York, NY",nwyynyx1,US-NY,,exact',
+    "2605:59c8:2700::/40,US,US-WA,Seattle,sttlwax1,US-WA,,exact",
+]
+
+
+def write_geoip(path: Path, rows: list[str]) -> Path:
+    path.write_text(HEADER + "".join(row + "\n" for row in rows))
+    return path
+
+
+@pytest.fixture
+def geoip_file(tmp_path):
+    return write_geoip(tmp_path.joinpath("geoip.csv"), ROWS)
+
+
+def test_parse_ipv4():
+    cases = {
+        "1.2.3.4": int(ip_address("1.2.3.4")),
+        "0.0.0.0": 0,
+        "255.255.255.255": 2**32 - 1,
+        "10.0.0.10": int(ip_address("10.0.0.10")),
+        "100.64.0.1": int(ip_address("100.64.0.1")),
+        # leading zeros
+        "01.2.3.4": None,
+        "1.2.3.04": None,
+        "1.2.3.00": None,
+        "00.0.0.0": None,
+        # empty, missing and extra octets
+        "1..2.3": None,
+        ".1.2.3": None,
+        "1.2.3.": None,
+        "1.2.3": None,
+        "1.2.3.4.": None,
+        "1.2.3.4.5": None,
+        "256.1.1.1": None,
+        "1.2.3.1000": None,
+        # longer than the 15 characters kept by the U15 cast
+        "1.2.3.4.5.6.7.8.9": None,
+        "255.255.255.2550": None,
+        "1.2.3.4" + " " * 12: None,
+        # NUL only pads the cast, it is not part of an address
+        "1.2.3.4\0": None,
+        "1.2\0.3.4": None,
+        "1.2.3.4x": None,
+        "１.2.3.4": None,
+        "::ffff:1.2.3.4": None,
+        "": None,
+    }
+    value, ok = annotate.parse_ipv4(list(cases))
+    assert {ip: int(v) if k else None for ip, v, k in zip(cases, value, ok)} == cases
+    for ip, expected in cases.items():
+        try:
+            parsed = ip_address(ip)
+        except ValueError:
+            parsed = None
+        assert expected == (int(parsed) if parsed and parsed.version == 4 else None), ip
+
+
+def test_v6_high_only(tmp_path):
+    short = write_geoip(tmp_path.joinpath("short.csv"), ROWS + ["2605:59c8:2700:10::/64,US,US-WA,Tacoma,tcmawax1,US-WA,,exact"])
+    table = annotate.load_table(short, ["pop", "city"])
+    assert table["v6_high_only"]
+
+    long = write_geoip(tmp_path.joinpath("long.csv"), ROWS + ["2605:59c8:2700:10::/80,US,US-WA,Tacoma,tcmawax1,US-WA,,exact"])
+    long_table = annotate.load_table(long, ["pop", "city"])
+    assert not long_table["v6_high_only"]
+
+    ips = [
+        "2605:59c8:2700::",
+        "2605:59c8:2700:10::",
+        "2605:59c8:2700:10:ffff:ffff:ffff:ffff",
+        "2605:59c8:2700:11::",
+        "2605:59c8:2700:f:ffff:ffff:ffff:ffff",
+        "2605:59c8:27ff:ffff:ffff:ffff:ffff:ffff",
+        "2605:59c8:2800::",
+        "::",
+        "not-an-ip",
+    ]
+    pops = table["values"][0][annotate.resolve(table, ips)]
+    assert list(pops) == ["sttlwax1", "tcmawax1", "tcmawax1", "sttlwax1", "sttlwax1", "sttlwax1", "", "", ""]
+
+    pops = long_table["values"][0][annotate.resolve(long_table, ips)]
+    assert list(pops) == ["sttlwax1", "tcmawax1", "sttlwax1", "sttlwax1", "sttlwax1", "sttlwax1", "", "", ""]
+    assert long_table["values"][0][annotate.resolve(long_table, ["2605:59c8:2700:10::ffff:ffff:ffff"])][0] == "tcmawax1"
+
+
+def mutate(rng: random.Random, ip: str) -> str:
+    """A near miss of a valid address."""
+    chars = list(ip)
+    i = rng.randrange(len(chars) + 1)
+    op = rng.randrange(3)
+    if op == 0:
+        chars.insert(i, rng.choice("0123456789.:abf"))
+    elif op == 1 and i < len(chars):
+        del chars[i]
+    elif i < len(chars):
+        chars[i] = rng.choice("0123456789.:abf")
+    return "".join(chars)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_against_prefix_index(tmp_path, seed):
+    rng = random.Random(seed)
+    cidrs = random_prefixes(rng, 200)
+    # mostly /64 or shorter, sometimes a longer one
+    if seed:
+        cidrs = [c for c in cidrs if ":" not in c or int(c.split("/")[1]) <= 64]
+    pops = [f"pop{rng.randrange(20)}" for _ in cidrs]
+    path = write_geoip(
+        tmp_path.joinpath("geoip.csv"), [f"{c},US,,,{p},,,exact" for c, p in zip(cidrs, pops)]
+    )
+    table = annotate.load_table(path, ["pop"])
+    assert table["v6_high_only"] == bool(seed)
+    index = PrefixIndex(cidrs, pops)
+
+    ips = probes(cidrs)
+    ips += [str(ip_address(0x0A000000 | rng.getrandbits(16))) for _ in range(200)]
+    ips += [str(ip_address(rng.getrandbits(32))) for _ in range(100)]
+    ips += [mutate(rng, rng.choice(ips)) for _ in range(1000)]
+    expected = [index.lookup(ip) or "" for ip in ips]
+    assert list(table["values"][0][annotate.resolve(table, ips)]) == expected
+
+
+def test_text_round_trip(geoip_file):
+    table = annotate.load_table(geoip_file)
+    chunk = b"149.19.108.7\n\n  14.1.64.200 \n98.97.0.1\n2605:59c8:2700::1\n10.0.0.1\nnot,an,ip\n"
+    output, count, matched = annotate.annotate_chunk(chunk, "text", "ip", table)
+    assert (count, matched) == (6, 4)
+    rows = list(csv.reader(output.decode("utf-8").splitlines()))
+    assert rows == [
+        ["149.19.108.7", "sttlwax1", "Seattle", "customer.sttlwax1.pop.starlinkisp.net."],
+        ["14.1.64.200", "mnlaphl1", "Manila", ""],
+        ["98.97.0.1", "nwyynyx1", "New York, NY", ""],
+        ["2605:59c8:2700::1", "sttlwax1", "Seattle", ""],
+        ["10.0.0.1", "", "", ""],
+        ["not,an,ip", "", "", ""],
+    ]
+    assert annotate.annotate_chunk(b"\n", "text", "ip", table) == (b"", 0, 0)
+
+
+def test_csv_round_trip(geoip_file):
+    table = annotate.load_table(geoip_file, ["pop", "country"])
+    chunk = b'1,149.19.108.7,"a, b"\r\n2, 98.97.0.1 ,c\n3\n4,bogus,d\n'
+    output, count, matched = annotate.annotate_chunk(chunk, "csv", 1, table)
+    assert (count, matched) == (4, 2)
+    assert list(csv.reader(output.decode("utf-8").splitlines())) == [
+        ["1", "149.19.108.7", "a, b", "sttlwax1", "US"],
+        ["2", " 98.97.0.1 ", "c", "nwyynyx1", "US"],
+        ["3", "", ""],
+        ["4", "bogus", "d", "", ""],
+    ]
+
+
+def test_jsonl_round_trip(geoip_file):
+    table = annotate.load_table(geoip_file)
+    objects = [{"from": "149.19.108.7", "rtt": 31.5}, {"from": "10.0.0.1"}, {"rtt": 1}, {"from": "98.97.0.1", "city": "x"}]
+    chunk = "".join(json.dumps(o) + "\n" for o in objects).encode("utf-8")
+    output, count, matched = annotate.annotate_chunk(chunk, "jsonl", "from", table)
+    assert (count, matched) == (4, 2)
+    assert [json.loads(line) for line in output.decode("utf-8").splitlines()] == [
+        {"from": "149.19.108.7", "rtt": 31.5, "pop": "sttlwax1", "city": "Seattle", "dns_ptr": "customer.sttlwax1.pop.starlinkisp.net."},
+        {"from": "10.0.0.1", "pop": None, "city": None, "dns_ptr": None},
+        {"rtt": 1, "pop": None, "city": None, "dns_ptr": None},
+        {"from": "98.97.0.1", "city": "New York, NY", "pop": "nwyynyx1", "dns_ptr": None},
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_main_keeps_the_input_order(tmp_path, geoip_file, workers):
+    rng = random.Random(workers)
+    ips = [rng.choice(["149.19.108.", "14.1.64.", "10.0.0."]) + str(rng.randrange(256)) for _ in range(2000)]
+    source = tmp_path.joinpath("flows.csv")
+    source.write_text("id,dst_addr\n" + "".join(f"{i},{ip}\n" for i, ip in enumerate(ips)))
+
+    result = subprocess.run(
+        [
+            sys.executable, "annotate.py", str(source),
+            "--format", "csv", "--column", "dst_addr", "--fields", "pop",
+            "--geoip", str(geoip_file), "--workers", str(workers), "--chunk-size", "1000",
+        ],
+        cwd=Path(annotate.__file__).parent,
+        capture_output=True,
+        check=True,
+    )
+    rows = list(csv.reader(result.stdout.decode("utf-8").splitlines()))
+    index = PrefixIndex(["149.19.108.0/24", "14.1.64.0/24"], ["sttlwax1", "mnlaphl1"])
+    assert rows[0] == ["id", "dst_addr", "pop"]
+    assert rows[1:] == [[str(i), ip, index.lookup(ip) or ""] for i, ip in enumerate(ips)]
+    assert b"Annotated 2000 IPs" in result.stderr
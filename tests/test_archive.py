@@ -0,0 +1,87 @@
+import io
+
+import pandas as pd
+import pytest
+
+import archive
+import history
+
+
+# geoip-pops-ptr before and after match_type was added as the last column
+OLD = """cidr,country,region,city,pop,code,dns_ptr
+149.19.108.0/24,US,US-WA,Seattle,sttlwax1,US-WA,customer.sttlwax1.pop.starlinkisp.net.
+14.1.64.0/24,PH,PH-00,Manila,mnlaphl1,PH-00,customer.mnlaphl1.pop.starlinkisp.net.
+"""
+NEW = """cidr,country,region,city,pop,code,dns_ptr,match_type
+149.19.108.0/24,US,US-WA,Seattle,sttlwax1,US-WA,customer.sttlwax1.pop.starlinkisp.net.,exact
+14.1.64.0/24,PH,PH-00,Manila,tkyojpn1,PH-00,customer.tkyojpn1.pop.starlinkisp.net.,suffix
+"""
+
+
+@pytest.fixture
+def geoip(tmp_path):
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    geoip_archive.append("20250101-0000", OLD)
+    geoip_archive.append("20250201-0000", NEW)
+    return geoip_archive
+
+
+def test_read_each_snapshot_with_its_header(geoip):
+    old = geoip.read("20250101-0000")
+    assert old.equals(pd.read_csv(io.StringIO(OLD), dtype=str))
+    new = geoip.read()
+    assert new["match_type"].tolist() == ["exact", "suffix"]
+    assert new["pop"].tolist() == ["sttlwax1", "tkyojpn1"]
+    assert geoip.read_text("20250101-0000") == OLD
+
+
+def test_read_range_across_a_schema_change(geoip):
+    rows = geoip.read_range()
+    assert list(rows.columns) == OLD.splitlines()[0].split(",") + ["match_type", "snapshot"]
+    assert rows["match_type"].tolist() == ["", "", "exact", "suffix"]
+    assert rows["dns_ptr"].str.startswith("customer.").all()
+
+    pops = geoip.read_range(columns=["cidr", "pop", "match_type"])
+    assert pops[["pop", "match_type", "snapshot"]].values.tolist() == [
+        ["sttlwax1", "", "20250101-0000"],
+        ["mnlaphl1", "", "20250101-0000"],
+        ["sttlwax1", "exact", "20250201-0000"],
+        ["tkyojpn1", "suffix", "20250201-0000"],
+    ]
+
+
+def test_history_across_a_schema_change(geoip):
+    index = history.update_history(history.HistoryIndex(), geoip)
+    assert index.at("14.1.64.0/24", "20250115-0000")["pop"] == "mnlaphl1"
+    assert index.at("14.1.64.0/24")["pop"] == "tkyojpn1"
+    # the first row only gained match_type, its attributes did not change
+    assert index.history("149.19.108.0/24")["pop"] == [["20250101-0000", None, "sttlwax1"]]
+
+
+def test_history_resumes_after_a_schema_change(tmp_path):
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    geoip_archive.append("20250101-0000", OLD)
+    index = history.update_history(history.HistoryIndex(), geoip_archive)
+    # 14.1.64.0/24 is gone from the first snapshot with match_type
+    geoip_archive.append("20250201-0000", "\n".join(NEW.splitlines()[:2]) + "\n")
+    index = history.update_history(index, geoip_archive)
+    assert index.at("14.1.64.0/24") == dict.fromkeys(history.ATTRIBUTES)
+    assert index.at("14.1.64.0/24", "20250101-0000")["city"] == "Manila"
+
+
+def test_columns_are_mapped_by_name(tmp_path):
+    # a column inserted mid-row shifts every later field of the newer rows
+    moved = "cidr,country,region,city,pop,code,match_type,dns_ptr\n" + "".join(
+        ",".join(row.split(",")[:6] + ["exact"] + row.split(",")[6:7]) + "\n"
+        for row in OLD.splitlines()[1:]
+    )
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    geoip_archive.append("20250101-0000", OLD)
+    geoip_archive.append("20250201-0000", moved)
+
+    rows = geoip_archive.read_range(columns=["cidr", "dns_ptr", "match_type"])
+    assert rows["dns_ptr"].str.startswith("customer.").all()
+    assert rows["match_type"].tolist() == ["", "", "exact", "exact"]
+
+    index = history.update_history(history.HistoryIndex(), geoip_archive)
+    assert index.changes("20250201-0000", "20250201-0000") == []
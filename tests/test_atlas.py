@@ -0,0 +1,127 @@
+import json
+import time
+import threading
+
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import atlas
+
+
+def probe(id: int, asn: int, complete: bool = True) -> dict:
+    info = {"id": id, "asn_v4": asn, "address_v4": f"100.64.0.{id % 250}"}
+    if complete:
+        info.update(
+            status={"name": "Connected"},
+            is_public=True,
+            country_code="US",
+            asn_v6=None,
+            address_v6=None,
+        )
+    return info
+
+
+class AtlasAPI:
+    """Stand-in for the probes listing and probe detail endpoints."""
+
+    def __init__(self, probes: dict[int, list[dict]], page_size: int = 2, fail_once=()):
+        self.probes = probes
+        self.page_size = page_size
+        self.fail_once = set(fail_once)
+        self.lock = threading.Lock()
+        self.detail_times = []
+        self.url = ""
+
+    def __call__(self, request):
+        url = urlsplit(request.path)
+        query = parse_qs(url.query)
+        path = url.path.removeprefix("/api/v2/")
+        if path == "probes":
+            asn = int(query["asn"][0])
+            offset = int(query.get("offset", ["0"])[0])
+            probes = self.probes.get(asn, [])
+            end = offset + self.page_size
+            next_url = (
+                f"{self.url}/api/v2/probes?asn={asn}&offset={end}" if end < len(probes) else None
+            )
+            return 200, {}, json.dumps({"results": probes[offset:end], "next": next_url})
+        if path.startswith("probes/"):
+            id = int(path.removeprefix("probes/"))
+            if not any(p["id"] == id for probes in self.probes.values() for p in probes):
+                return 404, {}, "not found"
+            with self.lock:
+                self.detail_times.append(time.monotonic())
+                if id in self.fail_once:
+                    self.fail_once.discard(id)
+                    return 503, {}, "busy"
+            # slow enough for concurrent requests to overlap
+            time.sleep(0.05)
+            return 200, {}, json.dumps(probe(id, 14593) | {"detail": True})
+        return 404, {}, "not found"
+
+
+@pytest.fixture
+def atlas_api(stand_in_server, monkeypatch):
+    def start(api: AtlasAPI):
+        server = stand_in_server(api)
+        api.url = server.url
+        monkeypatch.setattr(atlas, "ATLAS_API_URL", f"{server.url}/api/v2/")
+        monkeypatch.setattr(atlas, "backoff", lambda attempt: 0)
+        return server
+
+    return start
+
+
+def test_harvest_uses_the_listing_and_fetches_missing_details(atlas_api):
+    api = AtlasAPI(
+        {
+            14593: [probe(1, 14593), probe(2, 14593, complete=False), probe(3, 14593)],
+            45700: [probe(4, 45700, complete=False), probe(5, 45700)],
+        },
+        fail_once={4},
+    )
+    server = atlas_api(api)
+
+    probes = atlas.harvest_probes(concurrency=4, rate_limit=0)
+
+    assert [id for id, _ in probes] == [1, 2, 3, 4, 5]
+    details = {id: info for id, info in probes}
+    assert details[1] == probe(1, 14593)
+    assert details[2]["detail"] and details[4]["detail"]
+    assert "detail" not in details[5]
+    detail_paths = sorted(
+        r.path for r in server.requests if r.path.startswith("/api/v2/probes/")
+    )
+    # probe 4 failed once and was retried, complete probes were never fetched
+    assert detail_paths == ["/api/v2/probes/2", "/api/v2/probes/4", "/api/v2/probes/4"]
+
+
+def test_harvest_runs_details_concurrently(atlas_api):
+    api = AtlasAPI({14593: [probe(i, 14593, complete=False) for i in range(1, 13)]}, page_size=5)
+    server = atlas_api(api)
+
+    probes = atlas.harvest_probes(concurrency=4, rate_limit=0)
+
+    assert all(info["detail"] for _, info in probes)
+    assert 1 < server.max_in_flight <= 4
+
+
+def test_harvest_respects_the_rate_limit(atlas_api):
+    api = AtlasAPI({14593: [probe(i, 14593, complete=False) for i in range(1, 7)]})
+    atlas_api(api)
+
+    atlas.harvest_probes(concurrency=6, rate_limit=20)
+
+    times = sorted(api.detail_times)
+    # 6 requests at 20/s take at least 5 intervals of 50 ms
+    assert times[-1] - times[0] >= 0.2
+
+
+def test_probe_info_gives_up_after_retries(atlas_api):
+    api = AtlasAPI({})
+    server = atlas_api(api)
+
+    with atlas.new_atlas_client() as client:
+        assert atlas.get_probe_info(99, client) is None
+    assert len(server.requests) == atlas.RETRY_ATTEMPTS
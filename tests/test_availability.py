@@ -0,0 +1,132 @@
+import json
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+import shapely
+
+import availability
+
+
+DATA = Path(__file__).parent.joinpath("data")
+
+
+@pytest.fixture(scope="module")
+def resolver():
+    return availability.CountryResolver()
+
+
+def test_resolve_small_countries(resolver):
+    # all of these fell outside the old 1:110m boundaries and went to a neighbour
+    places = {
+        "MT": (14.45, 35.90),
+        "SG": (103.82, 1.35),
+        "HK": (114.17, 22.32),
+        "BH": (50.58, 26.20),
+        "BB": (-59.55, 13.10),
+        "GU": (144.78, 13.45),
+        "WS": (-172.40, -13.60),
+        "MU": (57.55, -20.25),
+        "MV": (73.51, 4.18),
+        "AD": (1.52, 42.51),
+        "RE": (55.50, -21.10),
+        "MC": (7.42, 43.74),
+    }
+    points = shapely.points(np.array(list(places.values())))
+    assert resolver.resolve(points) == list(places)
+
+
+def test_resolve_leaves_the_sea_empty(resolver):
+    # open ocean, and the sea between Malta and Sicily
+    points = shapely.points(np.array([(-30.0, 30.0), (14.60, 36.40)]))
+    assert resolver.resolve(points) == [None, None]
+
+
+def hexagon(x: float, y: float, radius: float = 0.1) -> shapely.Polygon:
+    angles = np.linspace(0, 2 * np.pi, 7)
+    return shapely.Polygon(np.c_[x + radius * np.cos(angles), y + radius * np.sin(angles)])
+
+
+def test_resolve_atolls_by_cell_overlap(resolver):
+    # cells centred on the lagoons of Funafuti and Majuro, and two at sea
+    centres = [(179.15, -8.50), (171.25, 7.10), (-30.0, 30.0), (14.60, 36.40)]
+    points = shapely.points(np.array(centres))
+    assert resolver.resolve(points) == [None, None, None, None]
+    cells = np.array([hexagon(x, y) for x, y in centres], dtype=object)
+    assert resolver.resolve(points, cells) == ["TV", "MH", None, None]
+
+
+def test_resolve_prefers_the_enclosed_country(resolver):
+    # the Holy See lies inside Italy's polygon
+    vatican = resolver.geometries[resolver.codes.index("VA")].centroid
+    assert resolver.resolve(shapely.points([[vatican.x, vatican.y], [12.50, 41.90]])) == ["VA", "IT"]
+
+
+class Downloaded:
+    committed = False
+
+    def commit(self):
+        self.committed = True
+
+
+def test_refresh_decodes_cells_once(data_dir, monkeypatch):
+    result = Downloaded()
+
+    def retrive_availability_cells():
+        data_dir.joinpath("availability/availability-cells.pb").write_bytes(
+            DATA.joinpath("availability-cells.pb").read_bytes()
+        )
+        return result
+
+    decoded = []
+    iter_features = availability.iter_features
+
+    def counting_iter_features(path):
+        decoded.append(path)
+        return iter_features(path)
+
+    classified = []
+    monkeypatch.setattr(availability, "retrive_availability_cells", retrive_availability_cells)
+    monkeypatch.setattr(availability, "iter_features", counting_iter_features)
+    monkeypatch.setattr(availability, "classify", classified.append)
+
+    availability.refresh_availability_zone()
+
+    assert len(decoded) == 1
+    assert result.committed
+    with open(DATA.joinpath("availability-cells.geojson")) as f:
+        expected = json.load(f)["features"]
+    assert classified == [expected]
+    with open(data_dir.joinpath("availability/availability-cells.geojson")) as f:
+        assert json.load(f)["features"] == expected
+
+
+def test_write_layers_removes_stale_files(data_dir, monkeypatch):
+    layers_dir = data_dir.joinpath(availability.LAYERS_DIR)
+    with open(DATA.joinpath("availability-cells.geojson")) as f:
+        features = json.load(f)["features"]
+    cells = [f for f in features if f["geometry"] and f["geometry"]["type"] == "Polygon"]
+    available, waitlisted = cells
+
+    availability.write_layers({"available": [available], "waitlisted Sold Out": [waitlisted]})
+    assert layers_dir.joinpath("waitlisted_Sold_Out-z0.geojson.gz").exists()
+
+    monkeypatch.setattr(availability, "LAYER_GZIP", False)
+    availability.write_layers({"available": [available]})
+    with open(layers_dir.joinpath("manifest.json")) as f:
+        manifest = json.load(f)
+    expected = {entry["file"] for entry in manifest["layers"]} | {"manifest.json"}
+    assert {path.name for path in layers_dir.iterdir()} == expected
+
+
+def test_simplify_layers_as_coverage(monkeypatch):
+    def simplify(*args, **kwargs):
+        raise AssertionError("fell back to simplifying layers apart")
+
+    monkeypatch.setattr(shapely, "simplify", simplify)
+    # two statuses sharing a jagged border
+    left = shapely.Polygon([(0, 0), (1, 0), (1.01, 0.5), (1, 1), (0, 1)])
+    right = shapely.Polygon([(1, 0), (2, 0), (2, 1), (1, 1), (1.01, 0.5)])
+    simplified = availability.simplify_layers(np.array([left, right], dtype=object), 0.1)
+    assert shapely.equals(shapely.intersection(*simplified).normalize(), shapely.LineString([(1, 0), (1, 1)]).normalize())
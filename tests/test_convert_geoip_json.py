@@ -0,0 +1,108 @@
+import io
+import json
+import random
+
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+import geoip_pop
+
+
+def convert_geoip_to_json_rowwise(df: pd.DataFrame) -> dict:
+    """convert_geoip_to_json before it was vectorized, the reference output."""
+    expected_cols = ["cidr", "country", "region", "city", "pop", "code", "dns_ptr", "pop_dns_ptr_match"]
+    cols_lower = [c.lower() for c in df.columns]
+    col_map = {}
+    for ec in expected_cols:
+        if ec in cols_lower:
+            col_map[ec] = df.columns[cols_lower.index(ec)]
+
+    def get(r, k):
+        return r[col_map[k]] if k in col_map else r.get(k, "")
+
+    result = {"countries": {}, "pop_subnet_count": []}
+    ptr_counter: Counter = Counter()
+    for _, row in df.iterrows():
+        cidr = get(row, "cidr")
+        dns_ptr = (get(row, "dns_ptr") or "").strip()
+        if dns_ptr:
+            ptr_counter[dns_ptr] += 1
+        country = (get(row, "country") or "").strip()
+        region = (get(row, "region") or "").strip()
+        city = (get(row, "city") or "").strip()
+        if not country:
+            continue
+        country_dict = result["countries"].setdefault(country, {})
+        region_dict = country_dict.setdefault(region, {})
+        city_dict = region_dict.setdefault(city, {})
+        city_dict.setdefault("ips", []).append([cidr, dns_ptr])
+
+    pop_subnet_count = [[ptr, cnt] for ptr, cnt in ptr_counter.most_common()]
+    pop_subnet_count.sort(key=lambda x: x[0])
+    result["pop_subnet_count"] = pop_subnet_count
+    result["countries"] = dict(sorted(result["countries"].items()))
+    return result
+
+
+PLACES = [
+    ("US", "US-WA", "Seattle"),
+    ("US", "US-CA", "Los Angeles"),
+    ("US", "US-CA", "San José"),
+    ("CA", "CA-BC", "Vancouver"),
+    ("DE", "DE-HE", "Frankfurt am Main"),
+    ("JP", "", "Tokyo"),
+    ("AD", "AD-07", "Andorra la Vella"),
+    ("", "", ""),
+    (" NZ", "NZ-AUK ", " Auckland "),
+]
+COLUMNS = ["cidr", "country", "region", "city", "pop", "code", "dns_ptr", "pop_dns_ptr_match", "match_type"]
+POPS = ["sttlwax1", "lsancax1", "frntdeu1", "tkyojpn1", ""]
+
+
+def synthetic_csv(rows: int, seed: int) -> str:
+    rng = random.Random(seed)
+    out = io.StringIO()
+    frame = []
+    for i in range(rows):
+        country, region, city = rng.choice(PLACES)
+        pop = rng.choice(POPS)
+        ptr = rng.choice(
+            [
+                "",
+                f"customer.{pop or 'sttlwax1'}.pop.starlinkisp.net.",
+                f" customer.{rng.choice(POPS) or 'lsancax1'}.pop.starlinkisp.net. ",
+            ]
+        )
+        if i % 3:
+            cidr = f"{98 + i % 5}.{i // 256 % 256}.{i % 256}.0/24"
+        else:
+            cidr = f"2605:59c8:{i:x}::/48"
+        frame.append(
+            {
+                "cidr": cidr,
+                "country": country,
+                "region": region,
+                "city": city,
+                "pop": pop,
+                "code": "",
+                "dns_ptr": ptr,
+                "pop_dns_ptr_match": str(bool(pop) and pop in ptr),
+                "match_type": rng.choice(["exact", "covering", "partial", ""]),
+            }
+        )
+    pd.DataFrame(frame, columns=COLUMNS).to_csv(out, index=False)
+    return out.getvalue()
+
+
+def as_published(result: dict) -> str:
+    # convert_to_geoip_json writes geoip-latest.json this way
+    return json.dumps(result, indent=2)
+
+
+@pytest.mark.parametrize("rows, seed", [(0, 1), (1, 2), (50, 3), (3000, 4)])
+def test_matches_the_row_by_row_conversion(rows, seed):
+    df = pd.read_csv(io.StringIO(synthetic_csv(rows, seed)), dtype=str, keep_default_na=False)
+    expected = as_published(convert_geoip_to_json_rowwise(df.copy()))
+    assert as_published(geoip_pop.convert_geoip_to_json(df)) == expected
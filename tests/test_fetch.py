@@ -0,0 +1,103 @@
+import gzip
+import json
+
+import httpx
+import pytest
+
+import fetch
+
+
+FEED = "149.19.108.0/24,US,US-WA,Seattle,\n"
+
+
+class FeedServer:
+    """Serves one resource with an ETag and Last-Modified, gzipped on request."""
+
+    def __init__(self, body: str = FEED, etag: str = '"v1"'):
+        self.body = body
+        self.etag = etag
+        self.last_modified = "Sat, 17 Oct 2026 10:00:00 GMT"
+
+    def __call__(self, request):
+        if request.path != "/feed.csv":
+            return 404, {}, "not found"
+        if request.headers.get("If-None-Match") == self.etag:
+            return 304, {"ETag": self.etag}, b""
+        headers = {"ETag": self.etag, "Last-Modified": self.last_modified}
+        body = self.body.encode("utf-8")
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            body = gzip.compress(body)
+        return 200, headers, body
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = fetch.ValidatorStore(tmp_path / "http-validators.json")
+    monkeypatch.setattr(fetch, "store", store)
+    return store
+
+
+def test_conditional_get_after_commit(stand_in_server, store):
+    server = stand_in_server(FeedServer())
+    url = f"{server.url}/feed.csv"
+
+    result = fetch.fetch(url)
+    assert isinstance(result, fetch.Fetched)
+    assert result.text == FEED
+    assert "If-None-Match" not in server.requests[0].headers
+    assert "gzip" in server.requests[0].headers["Accept-Encoding"]
+
+    # validators are only kept once the caller has written its output
+    assert isinstance(fetch.fetch(url), fetch.Fetched)
+    result.commit()
+    assert json.loads(store.path.read_text())[url] == {
+        "etag": '"v1"',
+        "last_modified": "Sat, 17 Oct 2026 10:00:00 GMT",
+    }
+
+    assert isinstance(fetch.fetch(url), fetch.NotModified)
+    assert server.requests[-1].headers["If-None-Match"] == '"v1"'
+    assert server.requests[-1].headers["If-Modified-Since"] == "Sat, 17 Oct 2026 10:00:00 GMT"
+
+
+def test_changed_resource_is_fetched_again(stand_in_server, store):
+    feed = FeedServer()
+    server = stand_in_server(feed)
+    url = f"{server.url}/feed.csv"
+    fetch.fetch(url).commit()
+
+    feed.body, feed.etag = FEED * 2, '"v2"'
+    result = fetch.fetch(url)
+    assert isinstance(result, fetch.Fetched)
+    assert result.text == FEED * 2
+
+
+def test_unconditional_fetch_ignores_validators(stand_in_server, store):
+    server = stand_in_server(FeedServer())
+    url = f"{server.url}/feed.csv"
+    fetch.fetch(url).commit()
+
+    assert isinstance(fetch.fetch(url, conditional=False), fetch.Fetched)
+    assert "If-None-Match" not in server.requests[-1].headers
+
+
+def test_stream(stand_in_server, store):
+    server = stand_in_server(FeedServer(body=FEED * 1000))
+    url = f"{server.url}/feed.csv"
+
+    with fetch.stream(url) as result:
+        assert isinstance(result, fetch.Fetched)
+        lines = list(result.response.iter_lines())
+        result.commit()
+    assert lines == [FEED.strip()] * 1000
+
+    with fetch.stream(url) as result:
+        assert isinstance(result, fetch.NotModified)
+
+
+def test_errors_raise(stand_in_server, store):
+    server = stand_in_server(FeedServer())
+    with pytest.raises(httpx.HTTPStatusError):
+        fetch.fetch(f"{server.url}/missing.csv")
+    assert store.get(f"{server.url}/missing.csv") == {}
@@ -0,0 +1,39 @@
+import json
+
+from pathlib import Path
+
+import geobuf_reader
+
+
+DATA = Path(__file__).parent.joinpath("data")
+
+
+def expected_features() -> list:
+    # availability-cells.pb was encoded from this file with the pygeobuf encoder
+    with open(DATA.joinpath("availability-cells.geojson")) as f:
+        return json.load(f)["features"]
+
+
+def test_decode_matches_source():
+    features = list(geobuf_reader.iter_features(DATA.joinpath("availability-cells.pb")))
+    assert features == expected_features()
+
+
+def test_missing_geometry_is_null():
+    features = list(geobuf_reader.iter_features(DATA.joinpath("availability-cells.pb")))
+    unlocated = [f for f in features if f["properties"]["status"] == "blacklisted"]
+    assert unlocated == [{"type": "Feature", "geometry": None, "properties": {"status": "blacklisted"}}]
+
+
+def test_write_geojson_is_compact(tmp_path):
+    features = expected_features()
+    path = tmp_path.joinpath("cells.geojson")
+    geobuf_reader.write_geojson(iter(features), path)
+    collection = {"type": "FeatureCollection", "features": features}
+    assert path.read_text() == json.dumps(collection, separators=(",", ":"))
+
+
+def test_write_geojson_empty(tmp_path):
+    path = tmp_path.joinpath("cells.geojson")
+    geobuf_reader.write_geojson(iter([]), path)
+    assert json.loads(path.read_text()) == {"type": "FeatureCollection", "features": []}
@@ -0,0 +1,307 @@
+import time
+import types
+import random
+import ipaddress
+
+import pandas as pd
+import pytest
+
+import context
+import geoip_pop
+
+
+FEED = """149.19.108.0/24,US,US-WA,Seattle,
+150.228.0.0/24,US,US-WA,Seattle,
+2605:59c8:1000::/48,US,US-CA,Los Angeles,
+98.97.0.0/24,US,US-NY,New York,
+not-a-cidr,US,US-NY,New York,
+"""
+POPS = """149.19.108.0/24,sttlwax1,
+2605:59c8:1000::/40,lsancax1,
+98.97.0.0/24,nwyynyx1,
+"""
+# 150.228.* is never queried, the other missing addresses time out
+PTRS = {
+    "149.19.108.0": ("customer.sttlwax1.pop.starlinkisp.net.", 3600),
+    # a negative answer without an SOA TTL
+    "2605:59c8:1000::": ("", 0),
+}
+
+
+class Feeds:
+    """Serves feed.csv and pops.csv with an ETag."""
+
+    def __init__(self):
+        self.bodies = {"/feed.csv": FEED, "/pops.csv": POPS}
+
+    def __call__(self, request):
+        body = self.bodies[request.path]
+        etag = f'"{hash(body)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag}, body
+
+
+@pytest.fixture
+def pipeline(stand_in_server, monkeypatch):
+    feeds = Feeds()
+    server = stand_in_server(feeds)
+    monkeypatch.setattr(geoip_pop, "GEOIP_FEED", f"{server.url}/feed.csv")
+    monkeypatch.setattr(geoip_pop, "POP_FEED", f"{server.url}/pops.csv")
+    # no pause between queries
+    monkeypatch.setattr(geoip_pop, "time", types.SimpleNamespace(sleep=lambda s: None, time=time.time))
+
+    queries = []
+
+    def dig(ip):
+        queries.append(str(ip))
+        return PTRS.get(str(ip))
+
+    monkeypatch.setattr(geoip_pop, "dig_ptr_record", dig)
+
+    joins = []
+    join_feed = geoip_pop.join_feed
+
+    def count_joins(cidrs=None, **kwargs):
+        joins.append(cidrs)
+        return join_feed(cidrs, **kwargs)
+
+    monkeypatch.setattr(geoip_pop, "join_feed", count_joins)
+    return types.SimpleNamespace(feeds=feeds, queries=queries, joins=joins)
+
+
+def published(data_dir) -> dict:
+    """Modification time of every file the geoip job publishes."""
+    return {
+        str(path.relative_to(data_dir)): path.stat().st_mtime_ns
+        for path in sorted(data_dir.rglob("*"))
+        if path.is_file()
+    }
+
+
+def test_unchanged_feed_skips_the_update(pipeline, data_dir, capsys):
+    geoip_pop.refresh_geoip_pop()
+    result = pd.read_csv(context.data_path(geoip_pop.GEOIP_LATEST_FILE), keep_default_na=False)
+    assert list(result.columns)[-1] == "match_type"
+    ptrs = dict(zip(result["cidr"], result["dns_ptr"]))
+    assert ptrs["149.19.108.0/24"] == "customer.sttlwax1.pop.starlinkisp.net."
+    assert ptrs["98.97.0.0/24"] == ""
+    assert len(pipeline.joins) == 1
+    # 98.97.0.0 timed out on every attempt
+    assert pipeline.queries.count("98.97.0.0") == 100
+    assert "150.228.0.0" not in pipeline.queries
+
+    pipeline.queries.clear()
+    before = published(data_dir)
+    assert {"geoip/geoip-latest.json", "geoip/geoip-latest.bin"} <= before.keys()
+    capsys.readouterr()
+
+    geoip_pop.refresh_geoip_pop()
+
+    assert "Feeds and PTR records unchanged; skipping update." in capsys.readouterr().out
+    assert len(pipeline.joins) == 1
+    assert pipeline.queries == []
+    assert published(data_dir) == before
+
+
+def test_failed_run_is_repeated(pipeline, monkeypatch):
+    geoip_pop.refresh_geoip_pop()
+
+    pipeline.feeds.bodies["/feed.csv"] = FEED.replace("Seattle", "Tacoma")
+    update_dns_ptr = geoip_pop.update_dns_ptr
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("resolver down")
+
+    monkeypatch.setattr(geoip_pop, "update_dns_ptr", fail)
+    with pytest.raises(RuntimeError):
+        geoip_pop.refresh_geoip_pop()
+    assert "Tacoma" not in context.data_path(geoip_pop.FEED_LATEST_FILE).read_text()
+
+    monkeypatch.setattr(geoip_pop, "update_dns_ptr", update_dns_ptr)
+    geoip_pop.refresh_geoip_pop()
+    result = pd.read_csv(context.data_path(geoip_pop.GEOIP_LATEST_FILE), keep_default_na=False)
+    assert dict(zip(result["cidr"], result["city"]))["149.19.108.0/24"] == "Tacoma"
+    assert "Tacoma" in context.data_path(geoip_pop.FEED_LATEST_FILE).read_text()
+    assert "Tacoma" in context.data_path("geoip/geoip-latest.json").read_text()
+
+
+def test_exports_catch_up_after_a_failed_run(pipeline):
+    geoip_pop.refresh_geoip_pop()
+    # a run that wrote the CSV and failed before exporting it
+    context.data_path("geoip/geoip-latest.json").unlink()
+    context.data_path("geoip/geoip-latest.bin").unlink()
+
+    geoip_pop.refresh_geoip_pop()
+    assert pipeline.joins == [None]
+    assert context.data_path("geoip/geoip-latest.json").exists()
+    assert context.data_path("geoip/geoip-latest.bin").exists()
+
+
+def test_expired_negative_entries_are_retried(pipeline, monkeypatch):
+    geoip_pop.refresh_geoip_pop()
+    pipeline.queries.clear()
+
+    monkeypatch.setattr(geoip_pop, "PTR_CACHE_NEGATIVE_TTL", 0)
+    cache = geoip_pop.PTRCache(context.state_path(geoip_pop.PTR_CACHE_FILE))
+    entries = cache.get_many(["98.97.0.0/24", "149.19.108.0/24"])
+    cache.put_many([(cidr, ptr, at, 0) for cidr, (ptr, at, ttl) in entries.items() if cidr == "98.97.0.0/24"])
+    cache.close()
+
+    geoip_pop.refresh_geoip_pop()
+    assert len(pipeline.joins) == 2
+    assert pipeline.joins[-1] == {"98.97.0.0/24"}
+    assert set(pipeline.queries) == {"98.97.0.0"}
+
+
+def test_pop_change_marks_overlapping_feed_rows(pipeline):
+    geoip_pop.refresh_geoip_pop()
+
+    # the /40 PoP prefix covers the /48 feed row, the feed itself is unchanged
+    pipeline.feeds.bodies["/pops.csv"] = POPS.replace("lsancax1", "lsancax2")
+    geoip_pop.refresh_geoip_pop()
+    assert pipeline.joins[-1] == {"2605:59c8:1000::/48"}
+    result = pd.read_csv(context.data_path(geoip_pop.GEOIP_LATEST_FILE), keep_default_na=False)
+    assert dict(zip(result["cidr"], result["pop"]))["2605:59c8:1000::/48"] == "lsancax2"
+
+
+def parse_network(cidr):
+    try:
+        return ipaddress.ip_network(cidr, strict=False)
+    except ValueError:
+        return None
+
+
+def brute_force_match(feed_cidrs, pop_cidrs):
+    """match_prefixes() with ip_network.subnet_of() on every pair."""
+    pops = []
+    for i, cidr in enumerate(pop_cidrs):
+        network = parse_network(cidr)
+        if network is not None and network not in [p for _, p in pops]:
+            pops.append((i, network))
+    result = []
+    for cidr in feed_cidrs:
+        feed = parse_network(cidr)
+        same = [(i, p) for i, p in pops if feed is not None and p.version == feed.version]
+        covering = [(i, p) for i, p in same if feed.subnet_of(p)]
+        inside = [(i, p) for i, p in same if p.subnet_of(feed)]
+        if covering:
+            i, p = max(covering, key=lambda c: c[1].prefixlen)
+            result.append((i, geoip_pop.MATCH_EXACT if p == feed else geoip_pop.MATCH_COVERING))
+        elif inside:
+            i, _ = min(inside, key=lambda c: (c[1].prefixlen, c[0]))
+            result.append((i, geoip_pop.MATCH_PARTIAL))
+        else:
+            result.append((-1, None))
+    return result
+
+
+def random_cidrs(rng, n):
+    cidrs = []
+    for _ in range(n):
+        if rng.random() < 0.5:
+            # a small space, so prefixes nest and repeat
+            address = ipaddress.IPv4Address(0x0A000000 | rng.getrandbits(12) << 8 | rng.getrandbits(8))
+            cidrs.append(f"{address}/{rng.randint(8, 32)}")
+        else:
+            address = ipaddress.IPv6Address(
+                0x260559C8 << 96 | rng.getrandbits(8) << 88 | rng.getrandbits(4) << 60 | rng.getrandbits(60)
+            )
+            cidrs.append(f"{address}/{rng.randint(32, 128)}")
+    return cidrs
+
+
+def test_match_prefixes():
+    feed = [
+        "10.0.0.0/24",  # equal, in another notation
+        "10.1.2.0/24",  # inside two PoP prefixes, the /16 wins
+        "10.2.0.0/16",  # PoP prefixes inside it, the largest wins
+        "2605:59c8:1000::/48",  # inside the /40
+        "2605:59c8:2000::1/128",  # longer than /64, inside the /96
+        "2605:59c8:3000::/64",  # contains a /100 and a /112
+        "192.168.0.0/24",
+        "not-a-cidr",
+        "::ffff:10.0.0.0/120",  # not the IPv4 10.0.0.0/24
+    ]
+    pops = [
+        "10.0.0.5/24",
+        "10.0.0.0/15",
+        "10.1.0.0/16",
+        "10.2.3.0/24",
+        "10.2.4.0/24",
+        "10.2.0.0/20",
+        "2605:59c8:1000::/40",
+        "2605:59c8:2000::/96",
+        "2605:59c8:3000::/112",
+        "2605:59c8:3000::/100",
+        "10.1.0.0/16",  # a duplicate is ignored
+    ]
+    matched, match_type = geoip_pop.match_prefixes(feed, pops)
+    assert list(zip(matched.tolist(), match_type.tolist())) == [
+        (0, "exact"),
+        (2, "covering"),
+        (5, "partial"),
+        (6, "covering"),
+        (7, "covering"),
+        (9, "partial"),
+        (-1, None),
+        (-1, None),
+        (-1, None),
+    ]
+    assert list(zip(matched.tolist(), match_type.tolist())) == brute_force_match(feed, pops)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_match_prefixes_against_subnet_of(seed):
+    rng = random.Random(seed)
+    feed, pops = random_cidrs(rng, 300), random_cidrs(rng, 100)
+    matched, match_type = geoip_pop.match_prefixes(feed, pops)
+    assert list(zip(matched.tolist(), match_type.tolist())) == brute_force_match(feed, pops)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_covering_pairs_against_subnet_of(seed):
+    rng = random.Random(seed)
+    inner_cidrs, outer_cidrs = random_cidrs(rng, 200), random_cidrs(rng, 50)
+    pairs = geoip_pop.covering_pairs(geoip_pop.prefix_ranges(inner_cidrs), geoip_pop.prefix_ranges(outer_cidrs))
+    expected = {
+        (i, j)
+        for i, inner in enumerate(map(parse_network, inner_cidrs))
+        for j, outer in enumerate(map(parse_network, outer_cidrs))
+        if inner.version == outer.version and inner.subnet_of(outer)
+    }
+    assert set(zip(pairs["inner"], pairs["outer"])) == expected
+    lengths = {
+        (i, j): (parse_network(inner_cidrs[i]).prefixlen, parse_network(outer_cidrs[j]).prefixlen)
+        for i, j in expected
+    }
+    # lengths are in the 128 bit space, IPv4 is offset by 96
+    for inner, outer, inner_length, outer_length in pairs.itertuples(index=False):
+        offset = 96 if ":" not in inner_cidrs[inner] else 0
+        assert (inner_length - offset, outer_length - offset) == lengths[(inner, outer)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_overlapping_cidrs_against_subnet_of(seed):
+    rng = random.Random(seed)
+    feed, pops = random_cidrs(rng, 200), random_cidrs(rng, 20)
+    expected = {
+        cidr
+        for cidr, network in zip(feed, map(parse_network, feed))
+        for pop in map(parse_network, pops)
+        if network.version == pop.version and (network.subnet_of(pop) or pop.subnet_of(network))
+    }
+    assert geoip_pop.overlapping_cidrs(feed, pops) == expected
+
+
+def test_prefix_ranges():
+    ranges = geoip_pop.prefix_ranges(["10.0.0.1/24", "bad", "10.0.0.0/33", "2605:59c8::1/127", "10.0.0.7"])
+    assert ranges.index.tolist() == [0, 3, 4]
+    assert ranges["family"].tolist() == [4, 6, 4]
+    assert ranges["length"].tolist() == [120, 127, 128]
+    # host bits are cleared, IPv4 is mapped into ::ffff:0:0/96
+    assert int(ranges["low"].iloc[0]) == 0xFFFF_0A000000
+    assert int(ranges["high"].iloc[1]) == 0x2605_59C8_0000_0000
+    assert int(ranges["low"].iloc[1]) == 0
+    assert int(ranges["low"].iloc[2]) == 0xFFFF_0A000007
+    assert geoip_pop.prefix_ranges([]).empty
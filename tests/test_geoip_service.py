@@ -0,0 +1,229 @@
+import json
+import asyncio
+import threading
+
+import pytest
+
+import geoip_service
+
+
+POPS = "149.19.108.0/24,sttlwax1,US-WA\n2605:59c8:2700::/40,sttlwax1,US-WA\n14.1.64.0/24,mnlaphl1,PH-00\n"
+GEOIP = (
+    "cidr,country,region,city,pop,code,dns_ptr,match_type\n"
+    "149.19.108.0/24,US,US-WA,Seattle,sttlwax1,US-WA,customer.sttlwax1.pop.starlinkisp.net.,exact\n"
+)
+
+
+@pytest.fixture
+def service(data_dir):
+    pop_file = data_dir.joinpath(geoip_service.POP_LATEST_FILE)
+    geoip_file = data_dir.joinpath(geoip_service.GEOIP_LATEST_FILE)
+    pop_file.parent.mkdir(parents=True)
+    geoip_file.parent.mkdir(parents=True)
+    pop_file.write_text(POPS)
+    geoip_file.write_text(GEOIP)
+    return geoip_service.GeoIPService(reload_interval=0.01)
+
+
+def serve(service, client):
+    """Run client(port) against the service listening on a free port."""
+
+    async def run():
+        server = await service.start("127.0.0.1", 0)
+        try:
+            return await client(server.sockets[0].getsockname()[1])
+        finally:
+            service.watcher.cancel()
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(asyncio.wait_for(run(), 10))
+
+
+async def exchange(port: int, data: bytes) -> list[tuple[int, dict, object]]:
+    """Send raw bytes and read responses until the server closes the connection."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    await writer.drain()
+    responses = []
+    try:
+        while status_line := await reader.readline():
+            headers = {}
+            while (line := await reader.readline()) != b"\r\n":
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.lower()] = value.strip()
+            body = await reader.readexactly(int(headers["content-length"]))
+            responses.append((int(status_line.split()[1]), headers, json.loads(body)))
+    finally:
+        writer.close()
+    return responses
+
+
+def request(method: str, target: str, body=None) -> bytes:
+    data = b"" if body is None else json.dumps(body).encode("utf-8")
+    head = f"{method} {target} HTTP/1.1\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n"
+    return head.encode("latin-1") + data
+
+
+async def call(port: int, method: str, target: str, body=None) -> tuple[int, object]:
+    [(status, _, payload)] = await exchange(port, request(method, target, body))
+    return status, payload
+
+
+def test_lookups(service):
+    async def client(port):
+        status, payload = await call(port, "GET", "/lookup?ip=149.19.108.7")
+        assert status == 200
+        assert payload == {
+            "ip": "149.19.108.7",
+            "pop": "sttlwax1",
+            "code": "US-WA",
+            "country": "US",
+            "region": "US-WA",
+            "city": "Seattle",
+            "dns_ptr": "customer.sttlwax1.pop.starlinkisp.net.",
+        }
+
+        ips = ["2605:59c8:2700::1", " 14.1.64.1 ", "10.0.0.1", "not-an-ip"]
+        for body in [ips, {"ips": ips}]:
+            status, payload = await call(port, "POST", "/lookup", body)
+            assert status == 200
+            assert [r.get("pop") for r in payload] == ["sttlwax1", "mnlaphl1", None, None]
+            assert payload[1]["ip"] == "14.1.64.1" and payload[1]["city"] is None
+            assert payload[3] == {"ip": "not-an-ip", "error": "invalid IP address"}
+
+        assert await call(port, "GET", "/prefixes?pop=sttlwax1") == (
+            200, {"pop": "sttlwax1", "prefixes": ["149.19.108.0/24", "2605:59c8:2700::/40"]}
+        )
+        assert await call(port, "GET", "/pops") == (200, {"mnlaphl1": 1, "sttlwax1": 2})
+        status, payload = await call(port, "GET", "/metrics")
+        assert payload["counters"]["requests.batch"] == 2
+        assert payload["counters"]["lookups"] == 9
+
+    serve(service, client)
+
+
+def test_bad_requests(service, monkeypatch):
+    monkeypatch.setattr(geoip_service, "MAX_BATCH", 2)
+
+    async def client(port):
+        for method, target, body, status in [
+            ("GET", "/lookup", None, 400),
+            ("POST", "/lookup", {"addresses": []}, 400),
+            ("POST", "/lookup", "149.19.108.7", 400),
+            ("POST", "/lookup", ["149.19.108.7"] * 3, 413),
+            ("PUT", "/lookup", [], 405),
+            ("POST", "/pops", [], 405),
+            ("GET", "/prefixes?pop=nwyynyx1", None, 404),
+            ("GET", "/nowhere", None, 404),
+        ]:
+            assert (await call(port, method, target, body))[0] == status
+
+        [(status, headers, payload)] = await exchange(
+            port, b"POST /lookup HTTP/1.1\r\nContent-Length: 3\r\nConnection: close\r\n\r\n{{{"
+        )
+        assert (status, payload) == (400, {"error": "body is not JSON"})
+        assert headers["content-type"] == "application/json"
+        # the connection is closed after a request that cannot be parsed
+        for data in [
+            b"GET /lookup\r\n\r\n",
+            b"GET /health HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+            b"GET /health HTTP/1.1\r\nContent-Length: 999999999999\r\n\r\n",
+        ]:
+            [(status, headers, _)] = await exchange(port, data + request("GET", "/health"))
+            assert status in (400, 413)
+            assert headers["connection"] == "close"
+
+    serve(service, client)
+
+
+def test_keep_alive(service):
+    async def client(port):
+        pipelined = (
+            b"GET /lookup?ip=149.19.108.7 HTTP/1.1\r\n\r\n"
+            b'POST /lookup HTTP/1.1\r\ncontent-length: 16\r\n\r\n["14.1.64.1"]   '
+            + request("GET", "/health")
+        )
+        responses = await exchange(port, pipelined)
+        assert [status for status, _, _ in responses] == [200, 200, 200]
+        assert [headers["connection"] for _, headers, _ in responses] == ["keep-alive", "keep-alive", "close"]
+        assert responses[1][2][0]["pop"] == "mnlaphl1"
+
+        # HTTP/1.0 closes by default
+        [(_, headers, _)] = await exchange(port, b"GET /health HTTP/1.0\r\n\r\n")
+        assert headers["connection"] == "close"
+
+    serve(service, client)
+
+
+def test_batch_does_not_block_other_requests(service, monkeypatch):
+    entered = threading.Event()
+    release = threading.Event()
+    lookup_many = geoip_service.Snapshot.lookup_many
+
+    def slow_lookup_many(self, ips):
+        entered.set()
+        release.wait(5)
+        return lookup_many(self, ips)
+
+    monkeypatch.setattr(geoip_service.Snapshot, "lookup_many", slow_lookup_many)
+
+    async def client(port):
+        batch = asyncio.create_task(call(port, "POST", "/lookup", ["149.19.108.7"]))
+        assert await asyncio.to_thread(entered.wait, 5)
+        # answered while the batch is still being looked up
+        status, payload = await call(port, "GET", "/health")
+        assert status == 200 and payload["status"] == "ok"
+        assert not batch.done()
+        release.set()
+        status, payload = await batch
+        assert payload[0]["pop"] == "sttlwax1"
+
+    try:
+        serve(service, client)
+    finally:
+        release.set()
+
+
+def test_hot_reload(service, data_dir):
+    pop_file = data_dir.joinpath(geoip_service.POP_LATEST_FILE)
+    geoip_file = data_dir.joinpath(geoip_service.GEOIP_LATEST_FILE)
+
+    async def wait_for_pop(port, ip, pop):
+        for _ in range(500):
+            status, payload = await call(port, "GET", f"/lookup?ip={ip}")
+            if payload["pop"] == pop:
+                return payload
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"{ip} still at {payload['pop']}")
+
+    async def client(port):
+        loaded_at = (await call(port, "GET", "/health"))[1]["loaded_at"]
+
+        # Seattle moves to Tacoma and the details go away
+        pop_file.write_text(POPS.replace("149.19.108.0/24,sttlwax1", "149.19.108.0/24,tcmawax1"))
+        geoip_file.unlink()
+        payload = await wait_for_pop(port, "149.19.108.7", "tcmawax1")
+        assert payload["city"] is None
+        assert (await call(port, "GET", "/health"))[1]["loaded_at"] > loaded_at
+        assert (await call(port, "GET", "/pops"))[1] == {"mnlaphl1": 1, "sttlwax1": 1, "tcmawax1": 1}
+
+        # a missing pops file keeps the current data
+        pop_file.unlink()
+        await asyncio.sleep(0.1)
+        assert (await call(port, "GET", "/lookup?ip=149.19.108.7"))[1]["pop"] == "tcmawax1"
+
+        # so does a file that fails to load
+        pop_file.write_bytes(b"\xff\xfe\xfa")
+        for _ in range(500):
+            counters = (await call(port, "GET", "/metrics"))[1]["counters"]
+            if counters.get("reload.failures"):
+                break
+            await asyncio.sleep(0.01)
+        assert counters["reloads"] == 1
+        assert (await call(port, "GET", "/lookup?ip=149.19.108.7"))[1]["pop"] == "tcmawax1"
+
+        pop_file.write_text(POPS)
+        await wait_for_pop(port, "149.19.108.7", "sttlwax1")
+
+    serve(service, client)
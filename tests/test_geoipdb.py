@@ -0,0 +1,168 @@
+import random
+import struct
+
+from ipaddress import ip_address
+
+import pytest
+
+import geoipdb
+from util import PrefixIndex
+
+from test_prefix_index import probes, random_prefixes
+
+
+def row(cidr, pop, city="Seattle"):
+    return {
+        "cidr": cidr,
+        "country": "US",
+        "region": "US-WA",
+        "city": city,
+        "pop": pop,
+        "code": "US-WA",
+        "dns_ptr": f"customer.{pop}.pop.starlinkisp.net.",
+    }
+
+
+def write(tmp_path, rows):
+    path = tmp_path.joinpath("geoip.bin")
+    path.write_bytes(geoipdb.build(rows))
+    return path
+
+
+def test_round_trip(tmp_path):
+    rows = [
+        row("149.19.108.0/24", "sttlwax1"),
+        row("149.19.108.128/25", "tkyojpn1", city="Tokyo"),
+        row("2605:59c8:2700::/40", "sttlwax1"),
+        row("2605:59c8:2700:ff00::/56", "nwyynyx1", city="New York"),
+        {"cidr": "98.97.0.0/24", "country": "PH", "city": "Manila"},
+    ]
+    with geoipdb.GeoIPDB(write(tmp_path, rows)) as db:
+        assert db.counts == {"ipv4": 3, "ipv6": 3, "records": 4, "strings": 14}
+        assert len(db) == 6
+        assert db.lookup("149.19.108.1") == {k: v for k, v in rows[0].items() if k != "cidr"}
+        assert db.lookup("149.19.108.200")["pop"] == "tkyojpn1"
+        assert db.lookup("2605:59c8:2700:ff00::1")["city"] == "New York"
+        assert db.lookup("2605:59c8:2701::1")["pop"] == "sttlwax1"
+        # missing columns are empty strings
+        assert db.lookup("98.97.0.1") == {
+            "country": "PH", "region": "", "city": "Manila", "pop": "", "code": "", "dns_ptr": ""
+        }
+        assert db.lookup("10.0.0.1") is None
+        assert db.lookup("not-an-ip") is None
+
+
+def test_range_edges(tmp_path):
+    rows = [
+        row("0.0.0.0/32", "first"),
+        row("255.255.255.255/32", "last"),
+        row("10.0.0.0/8", "sttlwax1"),
+        row("10.1.0.0/16", "tkyojpn1"),
+        row("::/128", "first"),
+        row("ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128", "last"),
+        # straddles the boundary of the high and low 64 bits
+        row("2605:59c8:0:ffff::/64", "sttlwax1"),
+    ]
+    with geoipdb.GeoIPDB(write(tmp_path, rows)) as db:
+        pops = {
+            "0.0.0.0": "first",
+            "0.0.0.1": None,
+            "255.255.255.255": "last",
+            "255.255.255.254": None,
+            "9.255.255.255": None,
+            "10.0.0.0": "sttlwax1",
+            "10.0.255.255": "sttlwax1",
+            "10.1.0.0": "tkyojpn1",
+            "10.1.255.255": "tkyojpn1",
+            "10.2.0.0": "sttlwax1",
+            "10.255.255.255": "sttlwax1",
+            "11.0.0.0": None,
+            "::": "first",
+            "::1": None,
+            "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff": "last",
+            "2605:59c8:0:fffe:ffff:ffff:ffff:ffff": None,
+            "2605:59c8:0:ffff::": "sttlwax1",
+            "2605:59c8:0:ffff:ffff:ffff:ffff:ffff": "sttlwax1",
+            "2605:59c8:1::": None,
+        }
+        assert {ip: (db.lookup(ip) or {}).get("pop") for ip in pops} == pops
+
+
+@pytest.mark.parametrize("family, cidr, other", [(4, "149.19.108.0/24", "2605:59c8::1"), (6, "2605:59c8::/32", "149.19.108.1")])
+def test_empty_family(tmp_path, family, cidr, other):
+    with geoipdb.GeoIPDB(write(tmp_path, [row(cidr, "sttlwax1")])) as db:
+        assert db.counts["ipv4" if family == 4 else "ipv6"] == 1
+        assert db.counts["ipv6" if family == 4 else "ipv4"] == 0
+        assert db.lookup(other) is None
+
+    with geoipdb.GeoIPDB(write(tmp_path, [])) as db:
+        assert db.counts == {"ipv4": 0, "ipv6": 0, "records": 0, "strings": 1}
+        assert db.lookup("149.19.108.1") is None
+        assert db.lookup("2605:59c8::1") is None
+
+
+def test_layout(tmp_path):
+    data = geoipdb.build([row("149.19.108.0/24", "sttlwax1"), row("2605:59c8::/32", "sttlwax1")])
+    magic, version, ipv4, ipv6, records, strings = geoipdb.HEADER.unpack_from(data)
+    assert (magic, version, ipv4, ipv6, records, strings) == (geoipdb.MAGIC, 1, 1, 1, 1, 6)
+
+    layout = geoipdb._layout(ipv4, ipv6, records, strings)
+    assert all(offset % 8 == 0 for offset, _ in layout.values())
+
+    def section(name, fmt):
+        offset, size = layout[name]
+        return list(struct.unpack_from(f"<{size // struct.calcsize(fmt)}{fmt}", data, offset))
+
+    assert section("v4_starts", "I") == [int(ip_address("149.19.108.0"))]
+    assert section("v4_ends", "I") == [int(ip_address("149.19.108.255"))]
+    assert section("v6_start_high", "Q") == [0x260559C8 << 32]
+    assert section("v6_end_low", "Q") == [2**64 - 1]
+    assert section("v4_records", "I") == section("v6_records", "I") == [0]
+    offsets = section("string_offsets", "I")
+    blob = data[layout["strings"][0] :]
+    assert len(blob) == offsets[-1]
+    assert [blob[a:b].decode() for a, b in zip(offsets, offsets[1:])] == [
+        "", "US", "US-WA", "Seattle", "sttlwax1", "customer.sttlwax1.pop.starlinkisp.net."
+    ]
+    assert section("records", "I") == [1, 2, 3, 4, 2, 5]
+
+
+def test_invalid_files(tmp_path):
+    path = tmp_path.joinpath("geoip.bin")
+    data = geoipdb.build([row("149.19.108.0/24", "sttlwax1")])
+    for content, message in [
+        (b"", "truncated"),
+        (b"x" * len(data), "not a GeoIPDB file"),
+        (data.replace(struct.pack("<I", 1), struct.pack("<I", 2), 1), "unsupported version 2"),
+        (data[: geoipdb.HEADER.size + 8], "truncated"),
+    ]:
+        path.write_bytes(content or b"\0")
+        with pytest.raises(geoipdb.GeoIPDBError, match=message):
+            geoipdb.GeoIPDB(path)
+
+
+def test_export(data_dir):
+    csv_path = data_dir.joinpath(geoipdb.GEOIP_CSV_FILE)
+    assert not geoipdb.export()
+
+    csv_path.parent.mkdir(parents=True)
+    csv_path.write_text(
+        "cidr,country,region,city,pop,code,dns_ptr,match_type\n"
+        "149.19.108.0/24,US,US-WA,Seattle,sttlwax1,US-WA,customer.sttlwax1.pop.starlinkisp.net.,exact\n"
+    )
+    assert geoipdb.export()
+    assert not geoipdb.export()
+    with geoipdb.GeoIPDB() as db:
+        assert db.lookup("149.19.108.7")["pop"] == "sttlwax1"
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_against_prefix_index(tmp_path, seed):
+    rng = random.Random(seed)
+    cidrs = random_prefixes(rng, 200)
+    rows = [row(cidr, f"pop{rng.randrange(20)}") for cidr in cidrs]
+    index = PrefixIndex(cidrs, [r["pop"] for r in rows])
+
+    ips = probes(cidrs) + [str(ip_address(0x0A000000 | rng.getrandbits(16))) for _ in range(200)]
+    with geoipdb.GeoIPDB(write(tmp_path, rows)) as db:
+        assert [(db.lookup(ip) or {}).get("pop") for ip in ips] == index.lookup_many(ips)
@@ -0,0 +1,102 @@
+import archive
+import history
+
+
+HEADER = "cidr,country,region,city,pop,code,dns_ptr,match_type\n"
+ROWS = [
+    "149.19.108.0/24,US,US-WA,Seattle,sttlwax1,US-WA,customer.sttlwax1.pop.starlinkisp.net.,exact",
+    "14.1.64.0/24,PH,PH-00,Manila,mnlaphl1,PH-00,customer.mnlaphl1.pop.starlinkisp.net.,exact",
+    "98.97.0.0/24,US,US-NY,New York,nwyynyx1,US-NY,,exact",
+]
+
+
+def snapshot(*rows: str) -> str:
+    return HEADER + "".join(row + "\n" for row in rows)
+
+
+def build(geoip_archive: archive.DatasetArchive):
+    geoip_archive.append("20250101-0000", snapshot(*ROWS))
+    # Manila moves to another PoP
+    geoip_archive.append("20250201-0000", snapshot(ROWS[0], ROWS[1].replace("mnlaphl1", "tkyojpn1"), ROWS[2]))
+    # New York is gone, Seattle only changes match_type
+    geoip_archive.append("20250301-0000", snapshot(ROWS[0].replace("exact", "covering"), ROWS[1].replace("mnlaphl1", "tkyojpn1")))
+
+
+def test_log_matches_the_index_built_in_memory(tmp_path):
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    log = tmp_path.joinpath("geoip-history.jsonl")
+    build(geoip_archive)
+    assert history.append_history(log, geoip_archive) == 3
+    assert history.append_history(log, geoip_archive) == 0
+
+    loaded = history.HistoryIndex.load(log)
+    expected = history.update_history(history.HistoryIndex(), geoip_archive)
+    assert loaded.events == expected.events
+    assert loaded.intervals == expected.intervals
+    assert loaded.applied == expected.applied == 3
+    assert loaded.at("14.1.64.0/24", "20250115-0000")["pop"] == "mnlaphl1"
+    assert loaded.at("98.97.0.0/24") == dict.fromkeys(history.ATTRIBUTES)
+    assert loaded.changes("20250301-0000", "20250301-0000", cidr="149.19.108.0/24") == []
+
+
+def test_append_only_reads_the_rows_that_differ(tmp_path, monkeypatch):
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    log = tmp_path.joinpath("geoip-history.jsonl")
+    geoip_archive.append("20250101-0000", snapshot(*ROWS))
+    history.append_history(log, geoip_archive)
+    before = log.read_bytes()
+
+    geoip_archive.append("20250201-0000", snapshot(ROWS[0], ROWS[1].replace("mnlaphl1", "tkyojpn1"), ROWS[2]))
+    read = []
+    read_lines = geoip_archive.read_lines
+
+    def record(ids):
+        read.append(set(ids))
+        return read_lines(ids)
+
+    monkeypatch.setattr(geoip_archive, "read_lines", record)
+    history.append_history(log, geoip_archive)
+
+    # the old and the new Manila row, not the whole snapshot
+    assert read == [{1, 3}]
+    assert log.read_bytes().startswith(before)
+    changes = history.HistoryIndex.load(log).changes("20250201-0000", "20250201-0000")
+    assert [(c.cidr, c.attribute, c.old, c.new) for c in changes] == [
+        ("14.1.64.0/24", "pop", "mnlaphl1", "tkyojpn1"),
+        (
+            "14.1.64.0/24",
+            "dns_ptr",
+            "customer.mnlaphl1.pop.starlinkisp.net.",
+            "customer.tkyojpn1.pop.starlinkisp.net.",
+        ),
+    ]
+
+
+def test_torn_line_is_written_again(tmp_path):
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    log = tmp_path.joinpath("geoip-history.jsonl")
+    build(geoip_archive)
+    history.append_history(log, geoip_archive)
+    complete = log.read_bytes()
+
+    # an append interrupted halfway through the last line
+    lines = complete.splitlines(keepends=True)
+    log.write_bytes(b"".join(lines[:-1]) + lines[-1][:20])
+    assert history.HistoryIndex.load(log).applied == 2
+
+    assert history.append_history(log, geoip_archive) == 1
+    assert log.read_bytes() == complete
+
+
+def test_changes_of_a_cidr(tmp_path):
+    geoip_archive = archive.DatasetArchive("geoip", tmp_path)
+    build(geoip_archive)
+    index = history.update_history(history.HistoryIndex(), geoip_archive)
+    for cidr in ["149.19.108.0/24", "14.1.64.0/24", "98.97.0.0/24", "10.0.0.0/8"]:
+        for start, end in [("20250101-0000", "20250301-0000"), ("20250115-0000", "20250201-0000")]:
+            assert index.changes(start, end, cidr=cidr) == [
+                e for e in index.changes(start, end) if e.cidr == cidr
+            ]
+    removed = index.changes("20250301-0000", "20250301-0000", cidr="98.97.0.0/24")
+    assert [c.attribute for c in removed] == history.ATTRIBUTES
+    assert all(c.new is None for c in removed)
@@ -0,0 +1,18 @@
+import pytest
+
+import benchmark
+
+
+# run.py is imported every hour before any job starts, the job modules load pandas
+RUN_IMPORT_BUDGET = 0.5
+MODULE_IMPORT_BUDGET = 5.0
+
+
+def test_import_run_is_cheap_and_offline():
+    # a fresh interpreter with the network disabled and an empty DATA_DIR
+    assert benchmark.check_import("run", RUN_IMPORT_BUDGET)
+
+
+@pytest.mark.parametrize("module", [m for m in benchmark.IMPORT_MODULES if m != "run"])
+def test_import_job_modules_offline(module):
+    assert benchmark.check_import(module, MODULE_IMPORT_BUDGET, repeat=1)
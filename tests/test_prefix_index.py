@@ -0,0 +1,123 @@
+import random
+
+from ipaddress import ip_address, ip_network
+
+import pytest
+
+from util import PrefixIndex
+
+
+def parse_networks(cidrs, values):
+    """The valid prefixes with their values, the first of duplicates."""
+    networks = {}
+    for cidr, value in zip(cidrs, values):
+        try:
+            network = ip_network(cidr, strict=False)
+        except ValueError:
+            continue
+        networks.setdefault(network, value)
+    return list(networks.items())
+
+
+def brute_force_lookup(networks, ip):
+    """The value of the longest prefix containing ip."""
+    address = ip_address(ip)
+    best = None
+    for network, value in networks:
+        if network.version == address.version and address in network:
+            if best is None or network.prefixlen > best[0]:
+                best = (network.prefixlen, value)
+    return best[1] if best else None
+
+
+def random_prefixes(rng, n):
+    cidrs = []
+    for _ in range(n):
+        if rng.random() < 0.5:
+            address = 0x0A000000 | rng.getrandbits(16)
+            cidrs.append(f"{ip_address(address)}/{rng.randint(16, 32)}")
+        else:
+            address = 0x260559C8 << 96 | rng.getrandbits(16) << 80 | rng.getrandbits(16)
+            cidrs.append(f"{ip_address(address)}/{rng.choice([32, 40, 48, 64, 96, 112, 120, 128])}")
+    return cidrs
+
+
+def probes(cidrs):
+    """Both ends of every prefix and the addresses just outside them."""
+    ips = []
+    for cidr in cidrs:
+        network = ip_network(cidr, strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
+        address = type(network.network_address)
+        for value in [first - 1, first, last, last + 1]:
+            if 0 <= value < 2**network.max_prefixlen:
+                ips.append(str(address(value)))
+    return ips
+
+
+def test_nested_prefixes():
+    index = PrefixIndex(["10.0.0.0/8", "10.1.0.0/16", "10.1.1.0/24"], ["a", "b", "c"])
+    starts, ends, values = index.ranges(4)
+    assert [(str(ip_address(s)), str(ip_address(e)), v) for s, e, v in zip(starts, ends, values)] == [
+        ("10.0.0.0", "10.0.255.255", "a"),
+        ("10.1.0.0", "10.1.0.255", "b"),
+        ("10.1.1.0", "10.1.1.255", "c"),
+        ("10.1.2.0", "10.1.255.255", "b"),
+        ("10.2.0.0", "10.255.255.255", "a"),
+    ]
+    assert index.lookup("10.1.1.7") == "c"
+    assert index.lookup("10.1.2.0") == "b"
+    assert index.lookup("11.0.0.0") is None
+
+
+def test_adjacent_ranges_of_the_same_value_merge():
+    pop = {"pop": "sttlwax1"}
+    index = PrefixIndex(["10.0.0.0/25", "10.0.0.128/25", "10.0.1.0/24"], [pop, pop, dict(pop)])
+    starts, ends, values = index.ranges(4)
+    # merged by identity, an equal copy is a different value
+    assert len(starts) == 2
+    assert (starts[0], ends[0]) == (int(ip_address("10.0.0.0")), int(ip_address("10.0.0.255")))
+
+    # a nested prefix with the value of its parent leaves no seam
+    index = PrefixIndex(["10.0.0.0/16", "10.0.5.0/24"], [pop, pop])
+    assert len(index) == 1
+
+
+def test_duplicates_keep_the_first():
+    index = PrefixIndex(["10.0.0.0/24", "10.0.0.9/24", "2605:59c8::/32", "2605:59c8:0::/32"], [1, 2, 3, 4])
+    assert index.lookup("10.0.0.1") == 1
+    assert index.lookup("2605:59c8::1") == 3
+    assert len(index) == 2
+
+
+def test_families_are_separate():
+    index = PrefixIndex(["0.0.0.0/0", "::/0"], ["v4", "v6"])
+    assert index.lookup("1.2.3.4") == "v4"
+    assert index.lookup("2001:db8::1") == "v6"
+    # an IPv4-mapped address is an IPv6 address
+    assert PrefixIndex(["10.0.0.0/8"], ["v4"]).lookup("::ffff:10.0.0.1") is None
+    assert index.lookup_many(["1.2.3.4", "::1", "not-an-ip", ""]) == ["v4", "v6", None, None]
+
+
+def test_invalid_cidrs_are_skipped(capsys):
+    index = PrefixIndex(["10.0.0.0/33", "not-a-cidr", "", "10.0.0.0/24"], [1, 2, 3, 4])
+    assert index.lookup("10.0.0.1") == 4
+    assert len(index) == 1
+    assert "Invalid CIDR: not-a-cidr" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_against_brute_force(seed):
+    rng = random.Random(seed)
+    cidrs = random_prefixes(rng, 200)
+    values = [rng.randrange(20) for _ in cidrs]
+    index = PrefixIndex(cidrs, values)
+
+    for version in [4, 6]:
+        starts, ends, _ = index.ranges(version)
+        assert all(s <= e for s, e in zip(starts, ends))
+        assert all(e < s for e, s in zip(ends, starts[1:]))
+
+    ips = probes(cidrs) + [str(ip_address(0x0A000000 | rng.getrandbits(16))) for _ in range(200)]
+    networks = parse_networks(cidrs, values)
+    assert index.lookup_many(ips) == [brute_force_lookup(networks, ip) for ip in ips]
@@ -0,0 +1,217 @@
+import socket
+import struct
+import asyncio
+import ipaddress
+
+import pytest
+
+import ptr_resolver
+from ptr_resolver import (
+    FLAG_QR,
+    FLAG_RD,
+    FLAG_TC,
+    RCODE_NXDOMAIN,
+    RCODE_SERVFAIL,
+    TYPE_PTR,
+    TYPE_SOA,
+    CLASS_IN,
+    ResponseCodeError,
+    encode_name,
+    parse_response,
+)
+
+# offset of the question name in a message, for compression pointers
+QNAME = b"\xc0\x0c"
+
+
+def record(rtype: int, ttl: int, rdata: bytes) -> bytes:
+    return QNAME + struct.pack("!HHIH", rtype, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+def ptr_record(name: str, ttl: int) -> bytes:
+    return record(TYPE_PTR, ttl, encode_name(name))
+
+
+def soa_record(ttl: int, minimum: int) -> bytes:
+    rdata = encode_name("ns.example.") + encode_name("hostmaster.example.")
+    rdata += struct.pack("!IIIII", 1, 3600, 600, 86400, minimum)
+    return record(TYPE_SOA, ttl, rdata)
+
+
+def response(query: bytes, rcode: int = 0, answers=(), authority=(), truncated=False) -> bytes:
+    qid = struct.unpack("!H", query[:2])[0]
+    flags = FLAG_QR | FLAG_RD | rcode | (FLAG_TC if truncated else 0)
+    header = struct.pack("!HHHHHH", qid, flags, 1, len(answers), len(authority), 0)
+    return header + query[12:] + b"".join(answers) + b"".join(authority)
+
+
+def query_name(query: bytes) -> str:
+    labels = []
+    offset = 12
+    while query[offset]:
+        length = query[offset]
+        labels.append(query[offset + 1 : offset + 1 + length].decode("ascii"))
+        offset += 1 + length
+    return ".".join(labels) + "."
+
+
+class StandIn:
+    """
+    Localhost DNS server. answers maps a reverse name to a list of handlers,
+    one per query (the last one repeats), each turning a query into the reply
+    bytes or None to stay silent.
+    """
+
+    def __init__(self, answers: dict):
+        self.answers = answers
+        self.queries: dict[str, int] = {}
+        self.tcp_queries = 0
+
+    def reply(self, query: bytes, tcp: bool) -> bytes | None:
+        name = query_name(query)
+        count = self.queries.get(name, 0)
+        self.queries[name] = count + 1
+        handlers = self.answers[name]
+        return handlers[min(count, len(handlers) - 1)](query, tcp)
+
+    def datagram_received(self, data, addr):
+        reply = self.reply(data, tcp=False)
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    async def handle_tcp(self, reader, writer):
+        self.tcp_queries += 1
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+        reply = self.reply(await reader.readexactly(length), tcp=True)
+        writer.write(struct.pack("!H", len(reply)) + reply)
+        await writer.drain()
+        writer.close()
+
+    async def __aenter__(self) -> tuple[str, int]:
+        loop = asyncio.get_running_loop()
+        # one port for UDP and TCP, like a real server
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        self.tcp = await asyncio.start_server(self.handle_tcp, sock=sock)
+        self.udp, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=("127.0.0.1", port))
+        return "127.0.0.1", port
+
+    async def __aexit__(self, *exc):
+        self.udp.close()
+        self.tcp.close()
+        await self.tcp.wait_closed()
+
+
+def name(ip: str) -> str:
+    return ipaddress.ip_address(ip).reverse_pointer + "."
+
+
+def answer(ptr: str, ttl: int):
+    return lambda query, tcp: response(query, answers=[ptr_record(ptr, ttl)])
+
+
+def rcode(code: int, authority=()):
+    return lambda query, tcp: response(query, rcode=code, authority=list(authority))
+
+
+def resolve(answers: dict, ips: list[str], **kwargs):
+    async def run():
+        stand_in = StandIn(answers)
+        async with stand_in as server:
+            ips_ = [ipaddress.ip_address(ip) for ip in ips]
+            records = await ptr_resolver.resolve_many(ips_, server=server, **kwargs)
+        return records, stand_in
+
+    return asyncio.run(run())
+
+
+def test_ptr_answer():
+    records, _ = resolve(
+        {
+            name("149.19.108.1"): [answer("customer.sttlwax1.pop.starlinkisp.net.", 300)],
+            name("2605:59c8:1000::1"): [answer("customer.lsancax1.pop.starlinkisp.net.", 600)],
+        },
+        ["149.19.108.1", "2605:59c8:1000::1"],
+    )
+    assert records == [
+        ("customer.sttlwax1.pop.starlinkisp.net.", 300),
+        ("customer.lsancax1.pop.starlinkisp.net.", 600),
+    ]
+
+
+def test_negative_answers_use_soa_ttl():
+    records, _ = resolve(
+        {
+            name("10.0.0.1"): [rcode(0, [soa_record(900, 60)])],
+            name("10.0.0.2"): [rcode(RCODE_NXDOMAIN, [soa_record(30, 3600)])],
+        },
+        ["10.0.0.1", "10.0.0.2"],
+    )
+    assert records == [("", 60), ("", 30)]
+
+
+def test_servfail_is_retried():
+    records, stand_in = resolve(
+        {name("10.0.0.3"): [rcode(RCODE_SERVFAIL), answer("host.example.", 120)]},
+        ["10.0.0.3"],
+    )
+    assert records == [("host.example.", 120)]
+    assert stand_in.queries[name("10.0.0.3")] == 2
+
+
+def test_persistent_servfail_is_not_an_empty_answer():
+    records, stand_in = resolve(
+        {name("10.0.0.4"): [rcode(RCODE_SERVFAIL)]},
+        ["10.0.0.4"],
+        timeout=5.0,
+    )
+    assert records == [None]
+    assert stand_in.queries[name("10.0.0.4")] == ptr_resolver.SERVFAIL_RETRIES + 1
+
+
+def test_truncated_answer_falls_back_to_tcp():
+    def truncated(query, tcp):
+        if tcp:
+            return response(query, answers=[ptr_record("long.example.", 60)])
+        return response(query, truncated=True)
+
+    records, stand_in = resolve({name("10.0.0.5"): [truncated]}, ["10.0.0.5"])
+    assert records == [("long.example.", 60)]
+    assert stand_in.tcp_queries == 1
+
+
+def test_timeout_returns_none():
+    records, _ = resolve(
+        {name("10.0.0.6"): [lambda query, tcp: None]},
+        ["10.0.0.6"],
+        timeout=0.2,
+    )
+    assert records == [None]
+
+
+def test_concurrency_keeps_order():
+    ips = [f"10.1.0.{i}" for i in range(1, 101)]
+    records, _ = resolve(
+        {name(ip): [answer(f"host{i}.example.", i)] for i, ip in enumerate(ips)},
+        ips,
+        concurrency=8,
+    )
+    assert records == [(f"host{i}.example.", i) for i in range(len(ips))]
+
+
+def test_parse_response_rejects_error_rcodes():
+    query = ptr_resolver.build_query("1.0.0.10.in-addr.arpa.", 42)
+    with pytest.raises(ResponseCodeError) as e:
+        parse_response(response(query, rcode=RCODE_SERVFAIL), 42)
+    assert e.value.rcode == RCODE_SERVFAIL
+    assert parse_response(response(query, rcode=RCODE_NXDOMAIN), 42) == ("", 0)
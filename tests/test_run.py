@@ -0,0 +1,22 @@
+import context
+import run
+
+
+def test_move_legacy_state(data_dir):
+    ctx = context.current()
+    data_dir.joinpath("cache").mkdir(parents=True)
+    data_dir.joinpath("cache/ptr-cache.sqlite3").write_text("published")
+    data_dir.joinpath("cache/http-validators.json").write_text("published")
+    data_dir.joinpath("metrics").mkdir()
+    data_dir.joinpath("metrics/run-20250101-0000.json").write_text("{}")
+    data_dir.joinpath("geoip").mkdir()
+    ctx.state_path("cache").mkdir(parents=True)
+    ctx.state_path("cache/http-validators.json").write_text("restored")
+
+    run.move_legacy_state(ctx)
+
+    assert sorted(p.name for p in data_dir.iterdir()) == ["geoip"]
+    assert ctx.state_path("cache/ptr-cache.sqlite3").read_text() == "published"
+    # the restored state is newer than the published copy
+    assert ctx.state_path("cache/http-validators.json").read_text() == "restored"
+    assert ctx.state_path("metrics/run-20250101-0000.json").exists()
@@ -0,0 +1,129 @@
+import time
+import threading
+
+import pytest
+
+from scheduler import Job, Scheduler
+
+
+class Recorder:
+    """Jobs that record when they start and finish."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def job(self, name, seconds=0.0, error=None, **kwargs):
+        def func():
+            with self.lock:
+                self.events.append(("start", name))
+            time.sleep(seconds)
+            with self.lock:
+                self.events.append(("end", name))
+            if error is not None:
+                raise error
+
+        return Job(name, func, **kwargs)
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+
+def test_dependencies_run_first():
+    recorder = Recorder()
+    jobs = [
+        recorder.job("map", inputs=["geoip/geoip-latest.json", "peeringdb"], outputs=["map"]),
+        recorder.job("geoip", 0.05, inputs=["pop"], outputs=["feed", "pop", "geoip/geoip-latest.json"]),
+        recorder.job("peeringdb", 0.1, outputs=["peeringdb"]),
+        # reads a file already in the data directory
+        recorder.job("bgp", inputs=["bgp/previous.csv"], outputs=["bgp"]),
+    ]
+    scheduler = Scheduler(jobs)
+    assert scheduler.dependencies == {"map": {"geoip", "peeringdb"}, "geoip": set(), "peeringdb": set(), "bgp": set()}
+
+    results = scheduler.run()
+    assert {n: r.status for n, r in results.items()} == dict.fromkeys(["geoip", "peeringdb", "bgp", "map"], "ok")
+    assert recorder.index("start", "map") > recorder.index("end", "geoip")
+    assert recorder.index("start", "map") > recorder.index("end", "peeringdb")
+    # independent jobs overlap
+    assert recorder.index("start", "peeringdb") < recorder.index("end", "geoip")
+    assert scheduler.critical_path(results) == ["peeringdb", "map"]
+
+
+def test_max_workers():
+    recorder = Recorder()
+    Scheduler([recorder.job(str(i), 0.01) for i in range(4)], max_workers=1).run()
+    assert recorder.events == [(event, str(i)) for i in range(4) for event in ["start", "end"]]
+
+
+def test_invalid_graphs():
+    noop = Recorder().job
+    with pytest.raises(ValueError, match="Duplicate job names"):
+        Scheduler([noop("a"), noop("a")])
+    with pytest.raises(ValueError, match="x is an output of both a and b"):
+        Scheduler([noop("a", outputs=["x"]), noop("b", outputs=["x"])])
+    with pytest.raises(ValueError, match="Dependency cycle"):
+        Scheduler([noop("a", inputs=["y"], outputs=["x"]), noop("b", inputs=["x"], outputs=["y"])])
+    # a job reading its own output does not wait for itself
+    assert Scheduler([noop("a", inputs=["x"], outputs=["x"])]).dependencies == {"a": set()}
+
+
+def test_failure_skips_the_dependents():
+    recorder = Recorder()
+    jobs = [
+        recorder.job("geoip", error=RuntimeError("feed unavailable"), outputs=["geoip"]),
+        recorder.job("map", inputs=["geoip"], outputs=["map"]),
+        recorder.job("report", inputs=["map"]),
+        recorder.job("bgp", 0.05, error=SystemExit(2), outputs=["bgp"]),
+        recorder.job("peeringdb", 0.1, outputs=["peeringdb"]),
+    ]
+    results = Scheduler(jobs).run()
+    assert {n: r.status for n, r in results.items()} == {
+        "geoip": "failed",
+        "map": "skipped",
+        "report": "skipped",
+        "bgp": "failed",
+        "peeringdb": "ok",
+    }
+    assert results["geoip"].error == "RuntimeError: feed unavailable"
+    assert results["bgp"].error == "SystemExit: 2"
+    assert results["map"].error == "depends on geoip"
+    assert results["report"].error == "depends on map"
+    assert ("start", "map") not in recorder.events
+
+
+def test_timeout_aborts_the_run():
+    release = threading.Event()
+    writes = []
+
+    def stuck():
+        writes.append("half")
+        release.wait(5)
+        # the abandoned thread carries on once it is unblocked
+        writes.append("rest")
+
+    recorder = Recorder()
+    jobs = [
+        Job("atlas", stuck, outputs=["atlas"], timeout=0.1),
+        recorder.job("map", inputs=["atlas"]),
+        recorder.job("peeringdb", 0.3, outputs=["peeringdb"], timeout=5),
+        recorder.job("bgp", 0.3),
+        recorder.job("latency"),
+    ]
+    try:
+        start = time.monotonic()
+        results = Scheduler(jobs, max_workers=3).run()
+        elapsed = time.monotonic() - start
+    finally:
+        release.set()
+
+    assert results["atlas"].status == "timeout"
+    assert results["atlas"].error == "timed out after 0.1s"
+    # running jobs are waited for, nothing new is started
+    assert results["peeringdb"].status == results["bgp"].status == "ok"
+    assert results["map"].status == results["latency"].status == "skipped"
+    assert results["latency"].error == "run aborted, atlas timed out"
+    assert ("start", "latency") not in recorder.events
+    # returned without waiting for the abandoned thread
+    assert writes[0] == "half"
+    assert elapsed < 5
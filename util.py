@@ -1,36 +1,267 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from bisect import bisect_right
 from ipaddress import ip_network, ip_address
+from pathlib import Path
+from typing import Callable
 import pandas as pd
 
+import context
+
 
 POP_FEED_URL = "https://geoip.starlinkisp.net/pops.csv"
 
+# relative to the state directory of the run
+OUTPUT_DIGESTS_FILE = "cache/output-digests.json"
+
+
+class PrefixIndex:
+    """
+    Longest-prefix-match index over a list of CIDRs.
+
+    Nested prefixes are flattened into disjoint integer ranges per address
+    family. Each range carries the value of the most specific prefix covering
+    it, so a lookup is a single binary search.
+    """
+
+    def __init__(self, cidrs: list, values: list):
+        prefixes: dict = {4: {}, 6: {}}
+        for cidr, value in zip(cidrs, values):
+            try:
+                network = ip_network(str(cidr).strip(), strict=False)
+            except ValueError:
+                print(f"Invalid CIDR: {cidr}")
+                continue
+            key = (int(network.network_address), network.prefixlen)
+            # keep the first occurrence of a duplicated prefix
+            if key not in prefixes[network.version]:
+                prefixes[network.version][key] = (
+                    int(network.broadcast_address),
+                    value,
+                )
+
+        self._tables = {
+            version: self._flatten(table) for version, table in prefixes.items()
+        }
+
+    @staticmethod
+    def _flatten(table: dict) -> tuple[list, list, list]:
+        # CIDRs are either nested or disjoint, so sorting by (start, prefixlen)
+        # visits every prefix right after all prefixes that contain it.
+        starts: list = []
+        ends: list = []
+        values: list = []
+
+        def emit(start: int, end: int, value):
+            if start > end:
+                return
+            if ends and ends[-1] + 1 == start and values[-1] is value:
+                ends[-1] = end
+                return
+            starts.append(start)
+            ends.append(end)
+            values.append(value)
+
+        stack: list = []
+        cursor = 0
+        for start, prefixlen in sorted(table):
+            end, value = table[(start, prefixlen)]
+            while stack and stack[-1][0] < start:
+                outer_end, outer_value = stack.pop()
+                emit(cursor, outer_end, outer_value)
+                cursor = outer_end + 1
+            if stack:
+                emit(cursor, start - 1, stack[-1][1])
+            stack.append((end, value))
+            cursor = start
+        while stack:
+            outer_end, outer_value = stack.pop()
+            emit(cursor, outer_end, outer_value)
+            cursor = outer_end + 1
+
+        return starts, ends, values
+
+    def __len__(self) -> int:
+        return sum(len(starts) for starts, _, _ in self._tables.values())
+
+    def ranges(self, version: int) -> tuple[list, list, list]:
+        """The sorted, disjoint (starts, ends, values) of one address family."""
+        return self._tables[version]
+
+    def lookup(self, ip_str: str):
+        try:
+            ip = ip_address(str(ip_str).strip())
+        except ValueError:
+            return None
+        return self._lookup_int(ip.version, int(ip))
+
+    def _lookup_int(self, version: int, ip: int):
+        starts, ends, values = self._tables[version]
+        i = bisect_right(starts, ip) - 1
+        if i >= 0 and ip <= ends[i]:
+            return values[i]
+        return None
+
+    def lookup_many(self, ips) -> list:
+        results = []
+        for ip_str in ips:
+            try:
+                ip = ip_address(str(ip_str).strip())
+            except ValueError:
+                results.append(None)
+                continue
+            results.append(self._lookup_int(ip.version, int(ip)))
+        return results
+
 
 class GEOIP:
-    def __init__(self):
+    def __init__(self, source: str | Path | None = None):
+        """source is a pops.csv URL or local path, the live feed by default."""
         pop_feed_header = "cidr,pop,code"
 
         self.pop_df = pd.read_csv(
-            POP_FEED_URL,
+            source or POP_FEED_URL,
             header=None,
             names=pop_feed_header.split(","),
             index_col=False,
         )
-        cidrs = self.pop_df["cidr"].tolist()
-        networks = [ip_network(c) for c in cidrs]
-        self.networks = list(zip(networks, self.pop_df["pop"].tolist(), cidrs))
+        self.index = PrefixIndex(
+            self.pop_df["cidr"].tolist(), self.pop_df["pop"].tolist()
+        )
 
     def get_pop_by_ip(self, ip_str: str) -> str:
         try:
-            ip = ip_address(ip_str)
+            ip_address(ip_str)
         except ValueError:
             print(f"Invalid IP address: {ip_str}")
             return ""
 
-        for network, pop, cidr in self.networks:
-            if ip in network:
-                print(f"IP {ip} found in CIDR {cidr}, POP: {pop}")
-                return str(pop)
-        return ""
+        pop = self.index.lookup(ip_str)
+        if pop is None:
+            return ""
+        return str(pop)
+
+    def lookup_many(self, ips) -> list[str]:
+        return ["" if pop is None else str(pop) for pop in self.index.lookup_many(ips)]
+
+
+class HashingWriter:
+    """
+    Binary file wrapper that hashes everything written to it. str is encoded
+    as UTF-8, so it can be handed to DataFrame.to_csv or json.dump.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+
+class OutputDigests:
+    """
+    SHA-256 and size of every file written by write_if_changed(), keyed by
+    path. A file whose size no longer matches is hashed again.
+    """
+
+    def __init__(self, path: Path | None = None):
+        # None follows the data directory of the current run
+        self.fixed_path = None if path is None else Path(path)
+        self.lock = threading.Lock()
+        self.entries: dict[str, dict] | None = None
+        self.loaded_from: Path | None = None
+
+    @property
+    def path(self) -> Path:
+        return self.fixed_path or context.state_path(OUTPUT_DIGESTS_FILE)
+
+    def _load(self) -> dict[str, dict]:
+        path = self.path
+        if self.entries is None or self.loaded_from != path:
+            self.entries = {}
+            self.loaded_from = path
+            if path.exists():
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+        return self.entries
+
+    def get(self, path: Path) -> str | None:
+        if not path.exists():
+            return None
+        size = path.stat().st_size
+        with self.lock:
+            entry = self._load().get(str(path))
+        if entry is not None and entry["size"] == size:
+            return entry["sha256"]
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def put(self, path: Path, sha256: str, size: int):
+        with self.lock:
+            entries = self._load()
+            entries[str(path)] = {"sha256": sha256, "size": size}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+output_digests = OutputDigests()
+
+
+def write_if_changed(
+    path: Path | str,
+    write: Callable[[HashingWriter], object],
+    archive: Path | str | None = None,
+) -> bool:
+    """
+    Serialize once with write(f) into a temporary file next to path, hashing
+    while it streams. If the digest equals the one of the previous output,
+    drop the temporary file and return False. Otherwise rename it over path,
+    hard-link (or copy) it to archive and return True.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            writer = HashingWriter(f)
+            write(writer)
+        digest = writer.sha256.hexdigest()
+        if digest == output_digests.get(path):
+            os.remove(tmp)
+            return False
+        os.replace(tmp, path)
+    except BaseException:
+        if tmp.exists():
+            os.remove(tmp)
+        raise
+    output_digests.put(path, digest, writer.size)
+
+    if archive is not None:
+        archive = Path(archive)
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        if archive.exists():
+            os.remove(archive)
+        try:
+            # path is only ever replaced by rename, so the link stays intact
+            os.link(path, archive)
+        except OSError:
+            shutil.copyfile(path, archive)
+    return True
 
 
 if __name__ == "__main__":